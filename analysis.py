@@ -1,35 +1,111 @@
+# Heavy libraries (torch, transformers, sentence_transformers, sklearn) are imported inside the
+# functions that need them, so the NLTK-based metrics can be used without paying for them.
+import os
+import sys
+import threading
 import nltk
 import numpy as np
-import streamlit as st
 from collections import Counter
 import string
-from sentence_transformers import SentenceTransformer
-from sklearn.decomposition import PCA
-from sklearn.metrics.pairwise import cosine_distances
-import torch
-from transformers import GPT2LMHeadModel, GPT2TokenizerFast
 import nltk.downloader
+from caching import cache_data, cache_resource
+import approximate
+import inference_backends
+import profiling
+import reference_index
+import scheduler
+import tagging
+from tagging import POS_CATEGORIES
+from document import Document, hash_text, parse_document
+import perplexity
+
+# Documents are keyed by their content hash, so the full text is never re-hashed per metric.
+# Raw strings hash to the same value, so a text and its Document share cache entries.
+# (Bytes, not str: st.cache_data would otherwise feed the returned str back into the str hash func.)
+_DOC_HASH_FUNCS = {
+    Document: lambda doc: doc.content_hash.encode(),
+    str: lambda text: hash_text(text).encode(),
+}
+
+PERPLEXITY_MODEL_NAME = 'distilgpt2'
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+# fp32 / int8 / compile / onnx, see inference_backends.py
+INFERENCE_BACKEND = inference_backends.selected_backend()
+# Cache keys include the backend, since quantized results differ slightly from fp32
+PERPLEXITY_MODEL_TAG = f"{PERPLEXITY_MODEL_NAME}:{INFERENCE_BACKEND}"
+EMBEDDING_MODEL_TAG = f"{EMBEDDING_MODEL_NAME}:{INFERENCE_BACKEND}"
+# Persisted results are keyed by the model they came from; the NLTK metrics depend on its tokenizer/tagger
+_NLTK_MODEL_TAG = f"nltk-{nltk.__version__}:{tagging.selected_tagger()}"
 
 # Helper to download nltk data silently
-@st.cache_resource
+NLTK_RESOURCES = {
+    "tokenizers/punkt": "punkt",
+    "tokenizers/punkt_tab": "punkt_tab", # Python 3.13 必備
+    "taggers/averaged_perceptron_tagger": "averaged_perceptron_tagger", # 舊版 (保險起見保留)
+    "taggers/averaged_perceptron_tagger_eng": "averaged_perceptron_tagger_eng", # <--- 新增這一行！NLTK 3.9+ 必備
+    "corpora/stopwords": "stopwords"
+}
+_nltk_ready = threading.Event()
+_nltk_lock = threading.Lock()
+
 def download_nltk_data():
-    resources = {
-        "tokenizers/punkt": "punkt",
-        "tokenizers/punkt_tab": "punkt_tab", # Python 3.13 必備
-        "taggers/averaged_perceptron_tagger": "averaged_perceptron_tagger", # 舊版 (保險起見保留)
-        "taggers/averaged_perceptron_tagger_eng": "averaged_perceptron_tagger_eng", # <--- 新增這一行！NLTK 3.9+ 必備
-        "corpora/stopwords": "stopwords"
-    }
-    for resource_path, resource_id in resources.items():
-        try:
-            # 嘗試尋找資源
-            nltk.data.find(resource_path)
-        except LookupError:
-            # 找不到就下載
-            nltk.download(resource_id, quiet=True)
+    """
+    Makes sure the NLTK resources are installed. Every metric calls this first, so after the first
+    success it only checks a flag; until then (e.g. while offline) each call probes and retries.
+
+    Returns:
+        - missing (list): Resources that are still not available (empty once ready).
+    """
+    if _nltk_ready.is_set():
+        return []
+    with _nltk_lock:
+        if _nltk_ready.is_set():
+            return []
+        with profiling.stage("nltk.check"):
+            missing = []
+            for resource_path, resource_id in NLTK_RESOURCES.items():
+                try:
+                    # 嘗試尋找資源
+                    nltk.data.find(resource_path)
+                except LookupError:
+                    # 找不到就下載
+                    nltk.download(resource_id, quiet=True)
+                    try:
+                        nltk.data.find(resource_path)
+                    except LookupError:
+                        missing.append(resource_id)
+        if not missing:
+            _nltk_ready.set()
+        return missing
+
+# Documents count against the result cache's memory budget like any result, but are not persisted
+@cache_data(hash_funcs=_DOC_HASH_FUNCS, max_entries=16, persist=False)
+def load_document(text: str) -> Document:
+    """
+    Parses a text into a shared Document (sentences, tokens, POS tags, content hash).
+    Every metric below accepts the result, so the text is tokenized and tagged once per analysis.
+    """
+    download_nltk_data()
+    return parse_document(text)
+
+def _as_document(doc) -> Document:
+    """Accepts either a Document or a raw string, for callers that still pass text."""
+    if isinstance(doc, Document):
+        return doc
+    return load_document(doc)
 
-@st.cache_data
-def calculate_burstiness(text: str):
+def burstiness_from_lengths(sent_lengths: list):
+    """
+    Returns:
+        - burstiness_score (float): The coefficient of variation of `sent_lengths`.
+    """
+    mean_length = np.mean(sent_lengths)
+    std_dev = np.std(sent_lengths)
+    return std_dev / mean_length if mean_length > 0 else 0
+
+@cache_data(hash_funcs=_DOC_HASH_FUNCS, model=_NLTK_MODEL_TAG)
+@profiling.profiled("metric.burstiness")
+def calculate_burstiness(doc: Document):
     """
     Calculates the burstiness of a text, defined as the coefficient of variation of sentence lengths.
     
@@ -37,28 +113,38 @@ def calculate_burstiness(text: str):
         - burstiness_score (float): The calculated burstiness.
         - sent_lengths (list): A list of sentence lengths (number of words).
     """
-    download_nltk_data()
-    
-    sentences = nltk.sent_tokenize(text)
+    doc = _as_document(doc)
     
-    if not sentences:
+    if not doc.sentences:
         return 0, []
 
-    # Using word_tokenize for more accurate word counts per sentence
-    sent_lengths = [len(nltk.word_tokenize(s)) for s in sentences]
+    # Sentence lengths come from the word_tokenize pass done once in parse_document
+    sent_lengths = doc.sentence_lengths
     
     if not sent_lengths:
         return 0, []
 
-    mean_length = np.mean(sent_lengths)
-    std_dev = np.std(sent_lengths)
-    
-    burstiness_score = std_dev / mean_length if mean_length > 0 else 0
-    
-    return burstiness_score, sent_lengths
+    return burstiness_from_lengths(sent_lengths), sent_lengths
+
+def stylometry_from_counts(n_types: int, n_tokens: int, pos_counts: dict):
+    """
+    Builds the stylometry result from aggregate counts.
+
+    Returns:
+        - ttr (float): n_types / n_tokens.
+        - pos_dist (dict): The percentage of tags in each of POS_CATEGORIES.
+    """
+    if not n_tokens:
+        return 0, {}
+
+    ttr = n_types / n_tokens
+    total_tags = sum(pos_counts.values())
+    pos_dist = {k: (pos_counts.get(k, 0) / total_tags) * 100 for k in POS_CATEGORIES} if total_tags > 0 else {}
+    return ttr, pos_dist
 
-@st.cache_data
-def calculate_stylometry(text: str):
+@cache_data(hash_funcs=_DOC_HASH_FUNCS, model=_NLTK_MODEL_TAG)
+@profiling.profiled("metric.stylometry")
+def calculate_stylometry(doc: Document):
     """
     Calculates stylometric features: Type-Token Ratio (TTR) and POS distribution.
 
@@ -66,216 +152,513 @@ def calculate_stylometry(text: str):
         - ttr (float): The Type-Token Ratio.
         - pos_dist (dict): A dictionary with the distribution of major POS tags.
     """
-    download_nltk_data()
+    doc = _as_document(doc)
     
-    # Use word_tokenize for TTR and POS tagging
-    tokens = nltk.word_tokenize(text.lower())
+    # Lowercased tokens for TTR, POS tags were computed on the same tokens
+    tokens = doc.lower_tokens
     
     if not tokens:
         return 0, {}
 
-    # Calculate TTR
-    ttr = len(set(tokens)) / len(tokens) if len(tokens) > 0 else 0
+    # Simplify tags to major categories (one table lookup per distinct tag)
+    pos_counts = tagging.category_counts(doc.pos_tags)
+    return stylometry_from_counts(len(set(tokens)), len(tokens), pos_counts)
 
-    # POS Tagging and Distribution
-    pos_tags = nltk.pos_tag(tokens)
-    
-    # Simplify tags to major categories
-    pos_counts = {
-        "Noun": 0, "Verb": 0, "Adjective": 0, "Adverb": 0, 
-        "Pronoun": 0, "Preposition": 0, "Conjunction": 0, "Determiner": 0,
-        "Other": 0
+@cache_resource
+def load_stopwords():
+    download_nltk_data()
+    return frozenset(nltk.corpus.stopwords.words('english'))
+
+_PUNCTUATION = frozenset(string.punctuation)
+
+def zipf_tokens(tokens, stop_words: frozenset = None):
+    """The lowercased tokens counted for Zipf's law: alphabetic words that are not stopwords."""
+    if stop_words is None:
+        stop_words = load_stopwords()
+    return [
+        token for token in tokens 
+        if token.isalpha() and token not in stop_words and token not in _PUNCTUATION
+    ]
+
+# Number of log-spaced rank bins in the plotted Zipf summary
+ZIPF_BINS = 40
+ZIPF_TOP_WORDS = 10
+
+def fit_zipf(ranks: np.ndarray, frequencies: np.ndarray):
+    """
+    Fits log10(frequency) = intercept - exponent * log10(rank) by least squares.
+    Fitted on the log-binned curve, so the long tail of words seen once does not outweigh the head.
+
+    Returns:
+        - exponent (float), intercept (float), r_squared (float); all None with fewer than 3 points.
+    """
+    if len(frequencies) < 3:
+        return None, None, None
+    x = np.log10(np.asarray(ranks, dtype=np.float64))
+    y = np.log10(np.asarray(frequencies, dtype=np.float64))
+    x_mean, y_mean = x.mean(), y.mean()
+    dx = x - x_mean
+    slope = float(np.dot(dx, y - y_mean) / np.dot(dx, dx))
+    intercept = float(y_mean - slope * x_mean)
+    ss_res = float(np.sum((y - (intercept + slope * x)) ** 2))
+    ss_tot = float(np.sum((y - y_mean) ** 2))
+    r_squared = 1.0 - ss_res / ss_tot if ss_tot > 0 else 1.0
+    return -slope, intercept, r_squared
+
+def log_bin_ranks(frequencies: np.ndarray, n_bins: int = ZIPF_BINS):
+    """
+    Aggregates the rank/frequency curve into log-spaced rank bins.
+
+    Returns:
+        - A dictionary of arrays: rank (geometric mean rank of each bin), frequency (mean frequency),
+          rank_start / rank_end (inclusive rank range) and count (ranks per bin).
+    """
+    n = len(frequencies)
+    edges = np.geomspace(1, n + 1, min(n_bins, n) + 1).astype(np.int64)
+    edges = np.unique(np.concatenate(([1], edges, [n + 1])))
+    starts = edges[:-1] - 1
+    counts = np.diff(edges)
+    log_ranks = np.log(np.arange(1, n + 1, dtype=np.float64))
+    return {
+        "rank": np.exp(np.add.reduceat(log_ranks, starts) / counts),
+        "frequency": np.add.reduceat(frequencies.astype(np.float64), starts) / counts,
+        "rank_start": edges[:-1],
+        "rank_end": edges[1:] - 1,
+        "count": counts,
     }
-    
-    for _, tag in pos_tags:
-        if tag.startswith('NN'):
-            pos_counts["Noun"] += 1
-        elif tag.startswith('VB'):
-            pos_counts["Verb"] += 1
-        elif tag.startswith('JJ'):
-            pos_counts["Adjective"] += 1
-        elif tag.startswith('RB'):
-            pos_counts["Adverb"] += 1
-        elif tag.startswith('PRP') or tag.startswith('WP'):
-            pos_counts["Pronoun"] += 1
-        elif tag.startswith('IN'):
-            pos_counts["Preposition"] += 1
-        elif tag.startswith('CC'):
-            pos_counts["Conjunction"] += 1
-        elif tag.startswith('DT') or tag.startswith('WDT'):
-            pos_counts["Determiner"] += 1
-        else:
-            pos_counts["Other"] += 1
-            
-    # Convert counts to percentages
-    total_tags = len(pos_tags)
-    pos_dist = {k: (v / total_tags) * 100 for k, v in pos_counts.items()} if total_tags > 0 else {}
-    
-    return ttr, pos_dist
 
-@st.cache_data
-def calculate_zipf(text: str):
+def zipf_from_counts(freqs: dict):
     """
-    Calculates word frequency distribution for Zipf's Law analysis.
-    
+    Builds the Zipf result from word frequencies. Ties are ordered alphabetically, so the result
+    does not depend on the order in which the counts were accumulated.
+
     Returns:
-        - A dictionary containing ranks, frequencies, and words.
+        - A dictionary with vocab_size, n_tokens, frequencies (array, by rank), top_words, the fitted
+          exponent / intercept / r_squared and a log-binned summary for plotting (binned),
+          or None if there are no words.
     """
-    download_nltk_data()
-    
-    # Tokenize, remove punctuation and stopwords
-    tokens = nltk.word_tokenize(text.lower())
-    stop_words = set(nltk.corpus.stopwords.words('english'))
-    punct = set(string.punctuation)
-    
-    clean_tokens = [
-        token for token in tokens 
-        if token.isalpha() and token not in stop_words and token not in punct
-    ]
-    
-    if not clean_tokens:
+    if not freqs:
         return None
 
-    # Calculate frequencies
-    freqs = Counter(clean_tokens)
-    sorted_freqs = freqs.most_common()
+    words = np.array(list(freqs.keys()))
+    counts = np.fromiter(freqs.values(), dtype=np.int64, count=len(freqs))
+    order = np.lexsort((words, -counts))
+    frequencies = counts[order]
+    binned = log_bin_ranks(frequencies)
+    exponent, intercept, r_squared = fit_zipf(binned["rank"], binned["frequency"])
+
+    return {
+        "vocab_size": len(frequencies),
+        "n_tokens": int(frequencies.sum()),
+        "frequencies": frequencies,
+        "top_words": words[order[:ZIPF_TOP_WORDS]].tolist(),
+        "exponent": exponent,
+        "intercept": intercept,
+        "r_squared": r_squared,
+        "binned": binned,
+    }
+
+# Version 2: log-binned curve and fitted exponent instead of the full word/rank lists
+@cache_data(hash_funcs=_DOC_HASH_FUNCS, model=_NLTK_MODEL_TAG, version=2)
+@profiling.profiled("metric.zipf")
+def calculate_zipf(doc: Document):
+    """
+    Calculates word frequency distribution for Zipf's Law analysis.
     
-    ranks = list(range(1, len(sorted_freqs) + 1))
-    frequencies = [count for _, count in sorted_freqs]
-    words = [word for word, _ in sorted_freqs]
+    Returns:
+        - A dictionary with the rank/frequency curve, its fitted Zipf exponent and goodness of fit,
+          and a log-binned summary (see zipf_from_counts).
+    """
+    doc = _as_document(doc)
     
-    return {"ranks": ranks, "frequencies": frequencies, "words": words}
+    # Remove punctuation and stopwords, then count
+    return zipf_from_counts(Counter(zipf_tokens(doc.lower_tokens)))
 
 # --- Semantic Drift ---
-@st.cache_resource
+@cache_resource
+@profiling.profiled("model.load.embedding")
 def load_embedding_model():
-    """Loads the sentence-transformer model and caches it."""
-    return SentenceTransformer('all-MiniLM-L6-v2')
+    """Loads the sentence-transformer model (with the DETECTOR_BACKEND inference backend) and caches it."""
+    return inference_backends.load_embedding_model(EMBEDDING_MODEL_NAME, INFERENCE_BACKEND)
 
-@st.cache_data
-def calculate_semantic_drift(text: str):
+@cache_resource
+def load_embedding_cache():
     """
-    Calculates semantic drift and variance using sentence embeddings.
+    Loads the process-wide sentence embedding cache.
+    Size and optional on-disk persistence come from DETECTOR_EMBEDDING_CACHE_SIZE / DETECTOR_EMBEDDING_CACHE_PATH.
+    """
+    from embedding_cache import DEFAULT_MAX_ENTRIES, SentenceEmbeddingCache
+    return SentenceEmbeddingCache(
+        EMBEDDING_MODEL_TAG,
+        max_entries=int(os.environ.get("DETECTOR_EMBEDDING_CACHE_SIZE", DEFAULT_MAX_ENTRIES)),
+        path=os.environ.get("DETECTOR_EMBEDDING_CACHE_PATH"),
+    )
+
+# Sentences sent to the encoder per call; bounds the encoder's intermediate memory on long documents
+ENCODE_CHUNK = 1024
+# Above these sentence counts, PCA switches to a randomized SVD and then to IncrementalPCA
+PCA_RANDOMIZED_MIN = 2000
+PCA_INCREMENTAL_MIN = 50000
+DRIFT_WINDOW = 10
+
+@profiling.profiled("semantic.encode")
+def encode_sentences(sentences: list, chunk_size: int = ENCODE_CHUNK):
+    """
+    Encodes sentences chunk by chunk into one preallocated float32 array.
 
     Returns:
-        - A dictionary containing avg_drift, variance, and pca_data.
+        - embeddings (np.ndarray): (n_sentences, dim) float32 embeddings.
     """
-    download_nltk_data()
     model = load_embedding_model()
+    cache = load_embedding_cache()
+    embeddings = None
+    for start in range(0, len(sentences), chunk_size):
+        # Only sentences missing from the cache reach the encoder; in the app it runs in a scheduler slot
+        with scheduler.slot():
+            chunk = cache.encode(model, sentences[start:start + chunk_size])
+        if embeddings is None:
+            embeddings = np.empty((len(sentences), chunk.shape[1]), dtype=np.float32)
+        embeddings[start:start + len(chunk)] = chunk
+    return embeddings
+
+def adjacent_drifts(embeddings: np.ndarray):
+    """Cosine distance between every pair of adjacent sentence embeddings, in one vectorized pass."""
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    normed = embeddings / np.maximum(norms, 1e-12)
+    similarity = np.einsum("ij,ij->i", normed[:-1], normed[1:])
+    return np.clip(1.0 - similarity, 0.0, 2.0)
+
+def rolling_stats(values: np.ndarray, window: int = DRIFT_WINDOW):
+    """
+    Rolling mean and variance over a sliding window, via cumulative sums.
+
+    Returns:
+        - mean (np.ndarray), var (np.ndarray): One value per full window position.
+    """
+    window = max(1, min(window, len(values)))
+    values = values.astype(np.float64)
+    csum = np.concatenate(([0.0], np.cumsum(values)))
+    csum_sq = np.concatenate(([0.0], np.cumsum(values ** 2)))
+    total = csum[window:] - csum[:-window]
+    total_sq = csum_sq[window:] - csum_sq[:-window]
+    mean = total / window
+    var = np.maximum(total_sq / window - mean ** 2, 0.0)
+    return mean, var
+
+@profiling.profiled("semantic.pca")
+def project_2d(embeddings: np.ndarray):
+    """
+    Reduces embeddings to 2D for plotting. Exact PCA for ordinary documents, randomized PCA for
+    long ones and IncrementalPCA (fitted chunk by chunk) for very long ones.
+    """
+    from sklearn.decomposition import PCA, IncrementalPCA
+
+    n = len(embeddings)
+    if n >= PCA_INCREMENTAL_MIN:
+        pca = IncrementalPCA(n_components=2, batch_size=ENCODE_CHUNK * 4)
+        for start in range(0, n, pca.batch_size):
+            pca.partial_fit(embeddings[start:start + pca.batch_size])
+        return np.vstack([
+            pca.transform(embeddings[start:start + pca.batch_size]) for start in range(0, n, pca.batch_size)
+        ]).astype(np.float32)
+    if n >= PCA_RANDOMIZED_MIN:
+        pca = PCA(n_components=2, svd_solver="randomized", random_state=0)
+    else:
+        pca = PCA(n_components=2)
+    return pca.fit_transform(embeddings).astype(np.float32)
+
+def drift_summary(embeddings: np.ndarray, window: int = DRIFT_WINDOW):
+    """
+    The drift statistics of a document's sentence embeddings (everything but the 2D projection).
+
+    Returns:
+        - A dictionary containing avg_drift, variance, the per-pair drifts and their rolling
+          mean/variance over `window` sentence pairs (drift_window).
+    """
+    # Calculate drift (distance between adjacent sentences)
+    drifts = adjacent_drifts(embeddings)
+    avg_drift = float(np.mean(drifts)) if len(drifts) else 0
+    window_mean, window_var = rolling_stats(drifts, window)
     
-    sentences = nltk.sent_tokenize(text)
+    # Calculate overall variance of embeddings
+    variance = float(np.mean(np.var(embeddings, axis=0, dtype=np.float64)))
     
-    if len(sentences) < 2:
-        return None
+    return {
+        "avg_drift": avg_drift,
+        "variance": variance,
+        "drifts": drifts.astype(np.float32),
+        "drift_window": {
+            "size": min(window, len(drifts)),
+            "mean": window_mean.astype(np.float32),
+            "var": window_var.astype(np.float32),
+        },
+    }
 
-    # Generate embeddings
-    embeddings = model.encode(sentences)
+# Version 2 added drifts / drift_window; version 3 keeps sentence_spans instead of the sentences
+@cache_data(hash_funcs=_DOC_HASH_FUNCS, model=EMBEDDING_MODEL_TAG, version=3)
+def calculate_semantic_drift(doc: Document, window: int = DRIFT_WINDOW):
+    """
+    Calculates semantic drift and variance using sentence embeddings.
+
+    Returns:
+        - A dictionary containing avg_drift, variance, pca_data (x, y and the sentence_spans they
+          belong to), the per-pair drifts and their rolling mean/variance over `window` sentence
+          pairs (drift_window). See semantic_sentences for the sentence texts.
+    """
+    doc = _as_document(doc)
     
-    # Calculate drift (distance between adjacent sentences)
-    drifts = [
-        cosine_distances([embeddings[i]], [embeddings[i+1]])[0][0] 
-        for i in range(len(embeddings) - 1)
-    ]
-    avg_drift = np.mean(drifts) if drifts else 0
+    sentences = list(doc.sentences)
     
-    # Calculate overall variance of embeddings
-    variance = np.mean(np.var(embeddings, axis=0))
+    if len(sentences) < 2:
+        return None
+
+    # Generate embeddings; sentences seen before (boilerplate) come from the cache
+    embeddings = encode_sentences(sentences)
+    result = drift_summary(embeddings, window)
     
     # Reduce to 2D with PCA for plotting
-    pca = PCA(n_components=2)
-    pca_result = pca.fit_transform(embeddings)
+    pca_result = project_2d(embeddings)
     
-    pca_data = {
+    # Character offsets instead of copies of the sentences, so the cached result does not hold the text twice
+    result["pca_data"] = {
         "x": pca_result[:, 0],
         "y": pca_result[:, 1],
-        "sentences": sentences
+        "sentence_spans": np.asarray(doc.sentence_spans, dtype=np.int32).reshape(-1, 2),
     }
     
-    return {
-        "avg_drift": avg_drift,
-        "variance": variance,
-        "pca_data": pca_data
-    }
+    return result
+
+def semantic_sentences(text: str, semantic_data: dict):
+    """
+    Adds the sentence texts to a calculate_semantic_drift result, which only keeps their offsets.
+
+    Returns:
+        - A copy of `semantic_data` whose pca_data also has sentences (slices of `text`), or None.
+    """
+    if not semantic_data:
+        return semantic_data
+    pca_data = semantic_data["pca_data"]
+    sentences = [text[start:end] for start, end in pca_data["sentence_spans"].tolist()]
+    return {**semantic_data, "pca_data": {**pca_data, "sentences": sentences}}
+
+@profiling.profiled("metric.semantic_approx")
+def estimate_semantic_drift(doc: Document, max_pairs: int = None, time_budget: float = None, seed: int = 0):
+    """
+    Approximate calculate_semantic_drift for long documents: embeds only the sentences of a random
+    sample of adjacent pairs (DETECTOR_APPROX_PAIRS by default) within `time_budget` seconds.
+    Not cached, since the sample depends on the time available; the embeddings are.
+
+    Returns:
+        - A dictionary with avg_drift, variance and their bootstrap intervals (see
+          approximate.approximate_drift), or None for fewer than 2 sentences.
+    """
+    doc = _as_document(doc)
+    return approximate.approximate_drift(
+        encode_sentences, list(doc.sentences), max_pairs or approximate.selected_pairs(), time_budget, seed=seed
+    )
+
+# --- Reference corpus ---
+# (path, error) pairs already reported, so a broken index is logged once rather than per analysis
+_reference_errors = set()
+
+@cache_resource
+def _open_reference_index(path: str):
+    return reference_index.ReferenceIndex(path, model=EMBEDDING_MODEL_TAG)
+
+def load_reference_index():
+    """
+    Opens the reference index at DETECTOR_REFERENCE_INDEX (see reference_index.py) once per process.
+    Appends made later by other processes are picked up on the next lookup.
+
+    Returns:
+        - The ReferenceIndex, or None if no index is configured, it has not been built yet or it
+          cannot be opened (e.g. it was built with another embedding model; logged once to stderr).
+    """
+    path = os.environ.get(reference_index.INDEX_ENV_VAR)
+    if not path or not os.path.exists(os.path.join(path, "meta.json")):
+        return None
+    try:
+        return _open_reference_index(path)
+    except (OSError, ValueError, KeyError) as e:
+        # E.g. built with another embedding model: the score falls back to the heuristics.
+        # Failures are not cached, so a rebuilt index is picked up on the next lookup.
+        if (path, str(e)) not in _reference_errors:
+            _reference_errors.add((path, str(e)))
+            print(f"Reference index disabled: {e}", file=sys.stderr)
+        return None
+
+@profiling.profiled("metric.reference")
+def calculate_reference_matches(doc: Document):
+    """
+    Looks up every sentence in the reference corpus of known AI and human text.
+    Not cached per document: the index grows, and the sentence embeddings are cached already.
+
+    Returns:
+        - A dictionary with coverage, ai_fraction, human_fraction, max_similarity and the best
+          matches (see reference_index.match_sentences), or None without a reference index.
+    """
+    index = load_reference_index()
+    if index is None:
+        return None
+    doc = _as_document(doc)
+    sentences = list(doc.sentences)
+    if not sentences:
+        return reference_index.match_sentences(index, [], None)
+    embeddings = encode_sentences(sentences)
+    # The lookup is a large matrix product, so it shares the model slots (after encoding, which takes its own)
+    with scheduler.slot():
+        return reference_index.match_sentences(index, sentences, embeddings)
 
 # --- Perplexity ---
-@st.cache_resource
+@cache_resource
+@profiling.profiled("model.load.perplexity")
 def load_perplexity_model():
-    """Loads the GPT-2 model and tokenizer for perplexity calculation."""
-    return GPT2LMHeadModel.from_pretrained('distilgpt2'), GPT2TokenizerFast.from_pretrained('distilgpt2')
+    """Loads the GPT-2 model and tokenizer (with the DETECTOR_BACKEND inference backend) for perplexity calculation."""
+    return inference_backends.load_perplexity_model(PERPLEXITY_MODEL_NAME, INFERENCE_BACKEND)
+
+@cache_resource
+def load_window_cache():
+    """
+    Loads the process-wide cache of per-window NLLs (size from DETECTOR_WINDOW_CACHE_SIZE).
+    Re-analysing an edited text only runs the windows that changed through GPT-2.
+    """
+    return perplexity.WindowCache(
+        int(os.environ.get("DETECTOR_WINDOW_CACHE_SIZE", perplexity.DEFAULT_WINDOW_CACHE_SIZE))
+    )
 
-@st.cache_data
-def calculate_perplexity(text: str):
+@cache_data(hash_funcs=_DOC_HASH_FUNCS, model=PERPLEXITY_MODEL_TAG)
+def calculate_perplexity(doc: Document, stride: int = perplexity.DEFAULT_STRIDE,
+                         batch_size: int = perplexity.DEFAULT_BATCH_SIZE):
     """
     Calculates perplexity of a text using a sliding window approach with GPT-2.
+    Windows are packed into attention-masked batches of `batch_size` per forward pass.
+
+    Returns:
+        - avg_ppl (float): exp of the mean window NLL.
+        - ppl_scores (list): The perplexity of each window.
     """
+    # Only the raw text is needed, so a string is scored without waiting for the NLTK parse
+    text = doc.text if isinstance(doc, Document) else doc
     model, tokenizer = load_perplexity_model()
-    
-    encodings = tokenizer(text, return_tensors='pt')
-    
-    max_length = model.config.n_positions
-    stride = 512
-    seq_len = encodings.input_ids.size(1)
-
-    nlls = []
-    prev_end_loc = 0
-    for begin_loc in range(0, seq_len, stride):
-        end_loc = min(begin_loc + max_length, seq_len)
-        trg_len = end_loc - prev_end_loc
-        input_ids = encodings.input_ids[:, begin_loc:end_loc]
-        target_ids = input_ids.clone()
-        target_ids[:, :-trg_len] = -100
-
-        with torch.no_grad():
-            outputs = model(input_ids, labels=target_ids)
-            neg_log_likelihood = outputs.loss
-
-        nlls.append(neg_log_likelihood)
-        prev_end_loc = end_loc
-        if end_loc == seq_len:
-            break
-            
-    ppl_scores = [torch.exp(nll) for nll in nlls]
-    avg_ppl = torch.exp(torch.stack(nlls).mean()).item() if nlls else 0
-    
-    # Convert tensors to numbers for plotting
-    ppl_scores_float = [score.item() for score in ppl_scores]
+    return perplexity.perplexity_for_texts(
+        model, tokenizer, [text], stride=stride, batch_size=batch_size, cache=load_window_cache()
+    )[0]
+
+@cache_data(hash_funcs=_DOC_HASH_FUNCS, model=PERPLEXITY_MODEL_TAG)
+def calculate_token_surprisal(doc: Document, stride: int = perplexity.DEFAULT_STRIDE,
+                              batch_size: int = perplexity.DEFAULT_BATCH_SIZE):
+    """
+    Calculates perplexity like calculate_perplexity, keeping the NLL of every GPT-2 token from the
+    same forward passes (windows are shared with calculate_perplexity through the window cache).
+
+    Returns:
+        - A dictionary with avg_ppl, ppl_scores, token_nlls (float32 array) and token_offsets
+          (int32 array of character offsets); see perplexity.surprisal_for_texts.
+    """
+    text = doc.text if isinstance(doc, Document) else doc
+    model, tokenizer = load_perplexity_model()
+    return perplexity.surprisal_for_texts(
+        model, tokenizer, [text], stride=stride, batch_size=batch_size, cache=load_window_cache()
+    )[0]
 
-    return avg_ppl, ppl_scores_float
+@profiling.profiled("metric.perplexity_approx")
+def estimate_perplexity(doc: Document, max_windows: int = None, time_budget: float = None,
+                        stride: int = perplexity.DEFAULT_STRIDE, batch_size: int = perplexity.DEFAULT_BATCH_SIZE,
+                        seed: int = 0):
+    """
+    Approximate calculate_perplexity for long texts: scores a random sample of the windows
+    (DETECTOR_APPROX_WINDOWS by default) within `time_budget` seconds. Not cached, since the sample
+    depends on the time available; the sampled windows go through the window cache.
+
+    Returns:
+        - A dictionary with avg_ppl, its bootstrap interval avg_ppl_ci and the sampled windows
+          (see approximate.approximate_perplexity).
+    """
+    text = doc.text if isinstance(doc, Document) else doc
+    model, tokenizer = load_perplexity_model()
+    return approximate.approximate_perplexity(
+        model, tokenizer, text, max_windows or approximate.selected_windows(), time_budget,
+        stride=stride, batch_size=batch_size, cache=load_window_cache(), seed=seed,
+    )
+
+def sentence_surprisal(doc: Document, surprisal: dict):
+    """
+    Adds per-sentence perplexity to a calculate_token_surprisal result, using the sentence offsets of `doc`.
+
+    Returns:
+        - A copy of `surprisal` with sentence_ppl (list, NaN for a sentence without scored tokens),
+          token_sentence (int32 array, the sentence index of each token) and the text and sentences
+          they refer to.
+    """
+    doc = _as_document(doc)
+    sentence_ppl, token_sentence = perplexity.sentence_perplexities(
+        surprisal["token_nlls"], surprisal["token_offsets"], doc.sentence_spans
+    )
+    return {**surprisal, "sentence_ppl": sentence_ppl.tolist(), "token_sentence": token_sentence,
+            "text": doc.text, "sentences": doc.sentences}
+
+def calculate_perplexity_batch(docs: list, stride: int = perplexity.DEFAULT_STRIDE,
+                               batch_size: int = perplexity.DEFAULT_BATCH_SIZE):
+    """
+    Calculates perplexity for many documents at once; windows from different documents share forward passes.
+
+    Returns:
+        - A list of (avg_ppl, ppl_scores) tuples, in the same order as `docs`.
+    """
+    model, tokenizer = load_perplexity_model()
+    texts = [doc.text if isinstance(doc, Document) else doc for doc in docs]
+    return perplexity.perplexity_for_texts(model, tokenizer, texts, stride=stride, batch_size=batch_size)
 
 # --- Final Score Calculation ---
+# Weights for each metric (TTR and Zipf both measure vocabulary spread, so they share TTR's former weight)
+# POS shares are deliberately not scored: they depend on the tagging backend (DETECTOR_TAGGER, see tagging.py)
+SCORE_WEIGHTS = {
+    'ppl': 0.4,
+    'burstiness': 0.2,
+    'ttr': 0.1,
+    'drift': 0.2,
+    'zipf': 0.1
+}
+# Components computed from the NLTK parse alone (milliseconds); ppl and drift need GPT-2 / MiniLM
+CHEAP_COMPONENTS = ('burstiness', 'ttr', 'zipf')
+
+def score_components(metrics: dict):
+    """
+    Normalizes each metric to 0-1, where 1 is more "AI-like". Missing metrics get a neutral default.
+    These are heuristics and can be fine-tuned.
+    """
+    return {
+        # Perplexity: Lower is more AI-like. Assume avg human PPL is ~60, AI is ~30.
+        'ppl': 1 - min(metrics.get('avg_perplexity', 60) / 60, 1.0),
+        # Burstiness: Lower is more AI-like. Assume human B is ~0.8, AI is ~0.5.
+        'burstiness': 1 - min(metrics.get('burstiness', 0.5) / 0.8, 1.0),
+        # TTR: Very low or very high can be AI. We'll simplify: lower is more AI.
+        'ttr': 1 - min(metrics.get('ttr', 0.5) / 0.5, 1.0),
+        # Semantic Drift: Lower is more AI-like. Assume human drift is ~0.4, AI is ~0.2.
+        'drift': 1 - min(metrics.get('avg_drift', 0.2) / 0.4, 1.0),
+        # Zipf exponent: Steeper (a thinner long tail of rare words) is more AI-like. Assume human s is ~1.0, AI is ~1.3.
+        'zipf': min(max((metrics.get('zipf_exponent', 1.0) - 1.0) / 0.3, 0.0), 1.0),
+    }
+
 def calculate_final_score(metrics: dict):
     """
     Calculates a heuristic 'AI Likelihood' score based on all metrics.
     This is a simplified model and can be expanded.
     """
-    # Normalize scores (0-1, where 1 is more "AI-like")
-    # These are heuristics and can be fine-tuned.
-    
-    # Perplexity: Lower is more AI-like. Assume avg human PPL is ~60, AI is ~30.
-    ppl_score = 1 - min(metrics.get('avg_perplexity', 60) / 60, 1.0)
-    
-    # Burstiness: Lower is more AI-like. Assume human B is ~0.8, AI is ~0.5.
-    burstiness_score = 1 - min(metrics.get('burstiness', 0.5) / 0.8, 1.0)
-    
-    # TTR: Very low or very high can be AI. We'll simplify: lower is more AI.
-    ttr_score = 1 - min(metrics.get('ttr', 0.5) / 0.5, 1.0)
-    
-    # Semantic Drift: Lower is more AI-like. Assume human drift is ~0.4, AI is ~0.2.
-    drift_score = 1 - min(metrics.get('avg_drift', 0.2) / 0.4, 1.0)
-    
-    # Weights for each metric
-    weights = {
-        'ppl': 0.4,
-        'burstiness': 0.2,
-        'ttr': 0.2,
-        'drift': 0.2
-    }
-    
-    final_score = (
-        ppl_score * weights['ppl'] +
-        burstiness_score * weights['burstiness'] +
-        ttr_score * weights['ttr'] +
-        drift_score * weights['drift']
-    )
-    
-    return final_score * 100 # Return as a percentage
\ No newline at end of file
+    components = score_components(metrics)
+    final_score = sum(components[name] * weight for name, weight in SCORE_WEIGHTS.items())
+    # Near-duplicates of the reference corpus outweigh the heuristics for the share of sentences they cover
+    coverage = metrics.get('reference_coverage')
+    if coverage:
+        final_score = (1 - coverage) * final_score + metrics['reference_ai_fraction']
+    return final_score * 100 # Return as a percentage
+
+def calculate_partial_score(metrics: dict):
+    """
+    The final score restricted to CHEAP_COMPONENTS, with their weights rescaled to sum to 1.
+    Used by cascade mode (cascade.py) to decide whether GPT-2 and MiniLM are needed at all.
+    """
+    components = score_components(metrics)
+    total_weight = sum(SCORE_WEIGHTS[name] for name in CHEAP_COMPONENTS)
+    partial = sum(components[name] * SCORE_WEIGHTS[name] for name in CHEAP_COMPONENTS)
+    return partial / total_weight * 100
@@ -1,17 +1,407 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import functools
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import caching
 import analysis
+import approximate
+import cascade
+import incremental
 import plotting
+import profiling
+import scheduler
+import tagging
 import ui
+import warmup
 import numpy as np
 
+# Inside the app, models are cached with st.cache_resource and results in caching.py's budgeted store
+caching.set_backend("streamlit")
+# DETECTOR_METRICS_PORT serves the profiling metrics for Prometheus (started once per process)
+profiling.start_metrics_server_from_env()
+# Sessions share the models: bound concurrent forward passes and their torch threads (see scheduler.py)
+scheduler.enable()
+# Load the models and NLTK data in the background as soon as the process starts (once per process)
+warmup.start()
+
+# GPT-2, MiniLM and the NLTK metrics run side by side
+MAX_WORKERS = 4
+# Seconds between progress updates (queue position) while waiting for results
+POLL_INTERVAL = 0.5
+
+def display_final_score(final_score):
+    st.header("綜合 AI 疑似度 (Comprehensive AI Likelihood)")
+
+    # Determine color based on score
+    if final_score < 40:
+        color = "green"
+    elif final_score < 70:
+        color = "orange"
+    else:
+        color = "red"
+
+    # Custom HTML for larger text and color
+    st.markdown(f"""
+    <style>
+    .big-font {{
+        font-size:32px !important;
+        font-weight: bold;
+        color: {color};
+    }}
+    </style>
+    <p class="big-font">{final_score:.2f}%</p>
+    """, unsafe_allow_html=True)
+
+    st.progress(int(final_score))
+    st.info("此分數為綜合所有指標的啟發式評估，分數越高，由 AI 生成的可能性越大。僅供參考。")
+
+# Chart tabs in display order: metric name -> tab label
+CHART_TABS = {
+    "perplexity": "1. Perplexity",
+    "burstiness": "2. 句長分布 (Burstiness)",
+    "stylometry": "3. 詞性分布 (POS)",
+    "zipf": "4. Zipf's Law",
+    "semantic": "5. 語意軌跡 (Semantic)",
+    "reference": "6. 參考語料比對 (Reference Corpus)",
+}
+
+def reserve_layout():
+    """
+    Reserves every slot up front so results can arrive in any order.
+
+    Returns:
+        - status_area, score_area: Placeholders for the progress message and the final score.
+        - cards (dict): Metric name -> column for its metric card.
+        - tabs (dict): Metric name -> tab for its chart.
+    """
+    status_area = st.empty()
+    score_area = st.container()
+    st.divider()
+
+    st.header("各項指標細節 (Metric Details)")
+    cards = dict(zip(["perplexity", "burstiness", "stylometry", "semantic"], st.columns(4)))
+    st.divider()
+
+    # With on_change="rerun" only the selected tab is built and sent; switching tabs re-runs the
+    # script, which then redraws the saved results (see show_saved_results)
+    tabs = dict(zip(CHART_TABS, st.tabs(list(CHART_TABS.values()), key="chart_tab", on_change="rerun")))
+    return status_area, score_area, cards, tabs
+
+def display_result(name: str, result, cards: dict, tabs: dict, all_metrics: dict):
+    """Shows the metric card of one result and, if its tab is the selected one, its chart."""
+    tab = tabs[name]
+    # .open is None when the tabs do not track their state; then every chart is drawn
+    show_chart = tab.open is not False
+
+    if name == "perplexity" and result.get("approximate"):
+        avg_ppl = result["avg_ppl"]
+        all_metrics['avg_perplexity'] = avg_ppl
+        low, high = result["avg_ppl_ci"]
+        with cards[name]:
+            st.metric(label="Avg. Perplexity (≈)", value=f"{avg_ppl:.2f}", help=f"95% CI {low:.2f} – {high:.2f}")
+        if show_chart:
+            with tab:
+                st.subheader("1. Perplexity (困惑度) 抽樣視窗 (Sampled Windows)")
+                with profiling.stage("figure.perplexity"):
+                    perplexity_fig = plotting.plot_perplexity(result["ppl_scores"], avg_ppl)
+                st.plotly_chart(perplexity_fig, use_container_width=True)
+                st.caption(f"近似模式：抽樣 {result['windows_scored']}/{result['windows_total']} 個視窗，95% 信賴區間 {low:.2f} – {high:.2f} "
+                           f"(Approximate mode: sampled windows, bootstrap 95% interval)")
+
+    elif name == "perplexity":
+        avg_ppl = result["avg_ppl"]
+        all_metrics['avg_perplexity'] = avg_ppl
+        with cards[name]:
+            st.metric(label="Avg. Perplexity", value=f"{avg_ppl:.2f}")
+        if show_chart:
+            with tab:
+                st.subheader("1. Perplexity (困惑度) 時間序列圖")
+                with profiling.stage("figure.perplexity"):
+                    perplexity_fig = plotting.plot_perplexity(result["ppl_scores"], avg_ppl)
+                    sentence_fig = plotting.plot_sentence_perplexity(result["sentence_ppl"], result["sentences"], avg_ppl)
+                st.plotly_chart(perplexity_fig, use_container_width=True)
+                st.info("Perplexity 衡量模型對文本的「驚訝程度」。AI 生成的文本通常更可預測，因此 Perplexity 較低且平穩。")
+                # Same forward passes as the series above: the token NLLs are mapped onto the sentences
+                st.plotly_chart(sentence_fig, use_container_width=True)
+                with st.expander("逐詞驚訝度熱圖 (Token Surprisal Heatmap)"):
+                    st.caption("顏色越深代表 GPT-2 越能預測該詞 (Darker = more predictable, more AI-like)；滑鼠停留可查看 NLL。")
+                    with profiling.stage("figure.heatmap"):
+                        heatmap = plotting.token_heatmap_html(result["text"], result["token_nlls"], result["token_offsets"])
+                    # As raw HTML, not Markdown: a blank line in the text would end the <div> and the rest
+                    # would be parsed as Markdown (headings, lists, code blocks)
+                    st.html(heatmap)
+
+    elif name == "burstiness":
+        burstiness_score, sent_lengths = result
+        all_metrics['burstiness'] = burstiness_score
+        with cards[name]:
+            st.metric(label="Burstiness", value=f"{burstiness_score:.4f}")
+        if show_chart:
+            with tab:
+                st.subheader("2. 句長分布 (Sentence Length Distribution)")
+                with profiling.stage("figure.burstiness"):
+                    burstiness_fig = plotting.plot_burstiness(sent_lengths)
+                st.plotly_chart(burstiness_fig, use_container_width=True)
+                st.info("人類寫作的句子長度通常變化較大 (高 Burstiness)，而 AI 生成的文本則更趨於一致 (低 Burstiness)。")
+
+    elif name == "stylometry":
+        ttr_score, pos_dist = result
+        all_metrics['ttr'] = ttr_score
+        with cards[name]:
+            st.metric(label="Lexical Diversity (TTR)", value=f"{ttr_score:.4f}")
+        if show_chart:
+            with tab:
+                st.subheader("3. 詞性分布 (Part-of-Speech Distribution)")
+                with profiling.stage("figure.stylometry"):
+                    pos_fig = plotting.plot_pos_distribution(pos_dist)
+                st.plotly_chart(pos_fig, use_container_width=True)
+                if tagging.selected_tagger() != "perceptron":
+                    st.caption(f"詞性標註器 (POS tagger): {tagging.selected_tagger()}，結果與預設 perceptron 不可直接比較 "
+                               "(faster but less accurate; shares are not comparable with the default tagger)")
+
+    elif name == "zipf":
+        zipf_data = result
+        if zipf_data and zipf_data["exponent"] is not None:
+            all_metrics['zipf_exponent'] = zipf_data["exponent"]
+        if show_chart:
+            with tab:
+                st.subheader("4. Zipf's Law (長尾分布)")
+                with profiling.stage("figure.zipf"):
+                    zipf_fig = plotting.plot_zipf(zipf_data)
+                st.plotly_chart(zipf_fig, use_container_width=True)
+                if zipf_data and zipf_data["exponent"] is not None:
+                    st.caption(f"擬合指數 (Fitted exponent) s = {zipf_data['exponent']:.3f}，R² = {zipf_data['r_squared']:.3f}（詞彙量 Vocabulary: {zipf_data['vocab_size']:,}）")
+                st.info("此圖比較了文本的實際詞頻分布（藍點）與理想的 Zipf 曲線（紅線）。AI 生成的文本可能缺乏低頻的「長尾」詞彙。")
+
+    elif name == "semantic" and result and result.get("approximate"):
+        all_metrics['avg_drift'] = result["avg_drift"]
+        low, high = result["avg_drift_ci"]
+        with cards[name]:
+            st.metric(label="Semantic Drift (≈)", value=f"{result['avg_drift']:.4f}", help=f"95% CI {low:.4f} – {high:.4f}")
+        if show_chart:
+            with tab:
+                st.subheader("5. 語意軌跡 (Semantic Trajectory)")
+                st.caption(f"近似模式：抽樣 {result['pairs_sampled']}/{result['pairs_total']} 組相鄰句，語意漂移 95% 信賴區間 {low:.4f} – {high:.4f}；"
+                           f"未計算軌跡圖 (Approximate mode: sampled sentence pairs; the trajectory needs every sentence)")
+
+    elif name == "semantic":
+        semantic_data = result
+        if semantic_data:
+            all_metrics['avg_drift'] = semantic_data.get('avg_drift')
+            with cards[name]:
+                st.metric(label="Semantic Drift", value=f"{semantic_data['avg_drift']:.4f}")
+        if show_chart:
+            with tab:
+                st.subheader("5. 語意軌跡 (Semantic Trajectory)")
+                with profiling.stage("figure.semantic"):
+                    semantic_fig = plotting.plot_semantic_drift(semantic_data)
+                st.plotly_chart(semantic_fig, use_container_width=True)
+                st.info("此圖將每個句子視覺化為 2D 空間中的一個點。AI 生成的文本可能有更平滑、可預測的軌跡。")
+
+    elif name == "reference":
+        reference = result
+        if reference and reference["coverage"]:
+            all_metrics['reference_coverage'] = reference["coverage"]
+            all_metrics['reference_ai_fraction'] = reference["ai_fraction"]
+        if show_chart:
+            with tab:
+                st.subheader("6. 參考語料比對 (Reference Corpus Matches)")
+                if reference is None:
+                    st.caption("未設定或無法開啟參考語料庫 (No usable reference index: build one with reference_index.py and set DETECTOR_REFERENCE_INDEX; "
+                               "an index that cannot be opened, e.g. one built with another embedding model, is reported in the server log)")
+                    return
+                st.caption(f"{reference['coverage']:.0%} 的句子與參考語料高度相似：AI {reference['ai_fraction']:.0%}，人類 {reference['human_fraction']:.0%} "
+                           f"(Sentences with a near-duplicate in the reference corpus: AI / human)")
+                if reference["matches"]:
+                    st.dataframe(
+                        [
+                            {
+                                "相似度 (similarity)": round(m["similarity"], 3),
+                                "標籤 (label)": m["label"],
+                                "句子 (sentence)": m["sentence"],
+                                "參考句 (reference)": m["reference"],
+                                "來源 (source)": m["source"],
+                            }
+                            for m in reference["matches"]
+                        ],
+                        use_container_width=True,
+                    )
+                st.info("與已確認的 AI 生成文本近乎重複的句子，比上述啟發式指標更可靠；被比對到的句子比例會直接計入綜合分數。")
+
+def display_score(score_area, all_metrics: dict, cascade_info: dict = None):
+    """Shows the final score, or in cascade mode the partial score when the text was not escalated."""
+    if cascade_info and not cascade_info["escalated"]:
+        final_score = cascade_info["partial_score"]
+    else:
+        final_score = analysis.calculate_final_score(all_metrics)
+
+    with score_area:
+        # Handle potential NaN score if metrics are zero or invalid
+        if final_score is None or np.isnan(final_score):
+            st.warning("Could not reliably compute a final score, likely due to very short or unusual input text. Score has been defaulted to 0.")
+            final_score = 0
+        display_final_score(final_score)
+        if cascade_info:
+            low, high = cascade_info["band"]
+            if cascade_info["escalated"]:
+                st.caption(f"快速篩選：低成本指標分數 {cascade_info['partial_score']:.1f} 落在不確定區間 {low:g}–{high:g}，已升級為完整分析 "
+                           f"(Cascade: partial score inside the uncertainty band, escalated to the full pipeline)")
+            else:
+                st.caption(f"快速篩選：低成本指標分數 {cascade_info['partial_score']:.1f} 在不確定區間 {low:g}–{high:g} 之外，已跳過 Perplexity 與語意漂移 "
+                           f"(Cascade: confident on the cheap metrics alone; perplexity and semantic drift skipped)")
+            stats = cascade.escalation_stats()
+            st.caption(f"本程序升級率 (Escalation rate in this process): {stats['escalation_rate']:.0%} of {stats['decisions']:,}")
+
+def display_error(name: str, message: str, cards: dict, tabs: dict):
+    """Reports a metric that failed on its card (or, for metrics without a card, on its chart tab)."""
+    text = f"{CHART_TABS[name]} 計算失敗 (failed): {message}"
+    if name in cards:
+        with cards[name]:
+            st.error(text)
+    if name not in cards or tabs[name].open is not False:
+        with tabs[name]:
+            st.error(text)
+
+def display_skipped(tabs: dict, ran):
+    """Marks the charts of metrics that cascade mode did not run (`ran`: the names of those that did)."""
+    for name in ("perplexity", "semantic", "reference"):
+        if name not in ran and tabs[name].open is not False:
+            with tabs[name]:
+                st.caption("快速篩選模式已跳過此指標 (Skipped in cascade mode)")
+
+def run_analysis(text_input: str, cascade_band: tuple = None, approx_budget: float = None):
+    """
+    Schedules every metric on a worker pool and renders each metric card and chart as soon as its result is ready.
+    The final score is filled in once all metrics are in. The results are kept in st.session_state
+    so that switching chart tabs can redraw them without analysing again.
+
+    With `cascade_band` (cascade mode, see cascade.py) the cheap NLTK metrics run first, and perplexity
+    and semantic drift only run if their partial score falls inside the band.
+
+    With `approx_budget` (approximate mode, see approximate.py) perplexity and semantic drift are
+    estimated from sampled windows and sentence pairs within that many seconds each.
+    """
+    status_area, score_area, cards, tabs = reserve_layout()
+
+    # --- 1. Run all analyses concurrently ---
+    all_metrics = {}
+    results = {}
+    errors = {}
+    cascade_info = None
+    # Collects the stage timings of this analysis from every thread it runs on
+    trace = profiling.Trace()
+    profiling.set_trace(trace)
+    # Remembers this session's previous text, so re-analysing an edit only recomputes what changed
+    analyzer = st.session_state.setdefault("incremental_analyzer", incremental.IncrementalAnalyzer())
+    # Worker threads need this session's script context to use st.cache_resource
+    ctx = get_script_run_ctx()
+    # Model calls from this session's workers are tagged with the session, for the queue position below
+    session_id = ctx.session_id if ctx else None
+    if approx_budget is None:
+        score_perplexity = analyzer.surprisal
+        score_semantic = analysis.calculate_semantic_drift
+    else:
+        score_perplexity = functools.partial(analysis.estimate_perplexity, time_budget=approx_budget)
+        score_semantic = functools.partial(analysis.estimate_semantic_drift, time_budget=approx_budget)
+    with ThreadPoolExecutor(
+        max_workers=MAX_WORKERS,
+        initializer=lambda: (add_script_run_ctx(threading.current_thread(), ctx), profiling.set_trace(trace),
+                             scheduler.set_owner(session_id)),
+    ) as pool:
+        futures = {}
+        if cascade_band is None:
+            # Perplexity only needs the raw text, so GPT-2 starts while NLTK is still parsing
+            futures[pool.submit(score_perplexity, text_input)] = "perplexity"
+
+        status_area.info("正在解析文本... (Parsing text...)")
+        # Tokenize and tag once (only the edited sentences on a re-run); every other metric reuses the same Document
+        doc = analyzer.update_document(text_input)
+        if cascade_band is None:
+            futures[pool.submit(score_semantic, doc)] = "semantic"
+            futures[pool.submit(analysis.calculate_reference_matches, doc)] = "reference"
+        futures[pool.submit(analyzer.burstiness)] = "burstiness"
+        futures[pool.submit(analyzer.stylometry)] = "stylometry"
+        futures[pool.submit(analyzer.zipf)] = "zipf"
+        status_area.info(f"正在深度分析文本... 已完成 0/{len(futures)} 項指標 (Performing deep analysis... 0/{len(futures)} metrics done)")
+
+        # --- 2. Display each metric as soon as it is ready ---
+        pending = set(futures)
+        while pending:
+            finished, pending = wait(pending, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    # One failing metric is reported on its own card; the score uses neutral defaults for it
+                    errors[name] = f"{type(e).__name__}: {e}"
+                    display_error(name, errors[name], cards, tabs)
+                    continue
+                # Approximate results have no token NLLs or projection to map, so they are shown as they are
+                if name == "perplexity" and approx_budget is None:
+                    # Token NLLs -> sentences needs the parse, which is done by now
+                    results[name] = analysis.sentence_surprisal(doc, results[name])
+                elif name == "semantic" and approx_budget is None:
+                    results[name] = analysis.semantic_sentences(doc.text, results[name])
+                display_result(name, results[name], cards, tabs, all_metrics)
+
+            if cascade_band is not None and cascade_info is None and {"burstiness", "stylometry", "zipf"} <= results.keys() | errors.keys():
+                # All cheap metrics are in: decide whether GPT-2 and MiniLM are needed
+                partial_score = analysis.calculate_partial_score(all_metrics)
+                escalated = cascade.needs_escalation(partial_score, cascade_band)
+                cascade.record_decision(escalated)
+                cascade_info = {"partial_score": partial_score, "escalated": escalated, "band": cascade_band}
+                if escalated:
+                    for future, name in ((pool.submit(score_perplexity, text_input), "perplexity"),
+                                         (pool.submit(score_semantic, doc), "semantic"),
+                                         (pool.submit(analysis.calculate_reference_matches, doc), "reference")):
+                        futures[future] = name
+                        pending.add(future)
+
+            done = len(futures) - len(pending)
+            position = scheduler.position(session_id)
+            if position:
+                status_area.info(f"模型忙碌中，排隊第 {position} 位... 已完成 {done}/{len(futures)} 項指標 (Models busy with other sessions: queue position {position}, {done}/{len(futures)} metrics done)")
+            else:
+                status_area.info(f"正在深度分析文本... 已完成 {done}/{len(futures)} 項指標 (Performing deep analysis... {done}/{len(futures)} metrics done)")
+
+    st.session_state["analysis_results"] = {"text": text_input, "results": results, "errors": errors, "cascade": cascade_info}
+    if cascade_info:
+        display_skipped(tabs, results.keys() | errors.keys())
+
+    # --- 3. Calculate and display the Final Score ---
+    display_score(score_area, all_metrics, cascade_info)
+
+    status_area.success("分析完成！(Analysis Complete!)")
+    profiling.set_trace(None)
+
+    if profiling.enabled():
+        ui.display_profiling_panel(trace)
+
+def show_saved_results(saved: dict):
+    """Redraws the last analysis from st.session_state (e.g. after a chart tab was switched)."""
+    _, score_area, cards, tabs = reserve_layout()
+    all_metrics = {}
+    errors = saved.get("errors", {})
+    for name in CHART_TABS:
+        if name in saved["results"]:
+            display_result(name, saved["results"][name], cards, tabs, all_metrics)
+        elif name in errors:
+            display_error(name, errors[name], cards, tabs)
+    if saved["cascade"]:
+        display_skipped(tabs, saved["results"].keys() | errors.keys())
+    display_score(score_area, all_metrics, saved["cascade"])
+
 def main():
     st.set_page_config(layout="wide", page_title="Advanced AI Text Detector")
-    
+
     # Use columns for a cleaner layout
     col1, col2 = st.columns([1, 2])
 
     with col1:
         ui.display_sidebar()
+        ui.display_warmup_status()
         # ui.display_test_samples()
 
     with col2:
@@ -19,118 +409,29 @@ def main():
         st.header("請在此處輸入您要分析的文本")
         text_input = st.text_area("Text to analyze", height=250, label_visibility="collapsed", placeholder="貼上文本於此 (Paste text here)...")
 
-        if st.button("開始分析 (Analyze)"):
-            if text_input:
-                # This is a long process, so the spinner is important
-                with st.spinner("正在深度分析文本...過程可能需要數分鐘，請耐心等候... (Performing deep analysis... this may take several minutes, please wait...)"):
-                    
-                    # --- 1. Run all analyses ---
-                    all_metrics = {}
-                    
-                    avg_ppl, ppl_scores = analysis.calculate_perplexity(text_input)
-                    all_metrics['avg_perplexity'] = avg_ppl
-                    
-                    burstiness_score, sent_lengths = analysis.calculate_burstiness(text_input)
-                    all_metrics['burstiness'] = burstiness_score
-                    
-                    ttr_score, pos_dist = analysis.calculate_stylometry(text_input)
-                    all_metrics['ttr'] = ttr_score
-                    
-                    zipf_data = analysis.calculate_zipf(text_input)
-                    
-                    semantic_data = analysis.calculate_semantic_drift(text_input)
-                    if semantic_data:
-                        all_metrics['avg_drift'] = semantic_data.get('avg_drift')
-
-                    # --- 2. Calculate Final Score ---
-                    final_score = analysis.calculate_final_score(all_metrics)
-
-                    # Handle potential NaN score if metrics are zero or invalid
-                    if final_score is None or np.isnan(final_score):
-                        st.warning("Could not reliably compute a final score, likely due to very short or unusual input text. Score has been defaulted to 0.")
-                        final_score = 0
-
-                    st.success("分析完成！(Analysis Complete!)")
-                    st.divider()
-
-                    # --- 3. Display Final Score ---
-                    st.header("綜合 AI 疑似度 (Comprehensive AI Likelihood)")
-                    
-                    # Determine color based on score
-                    if final_score < 40:
-                        color = "green"
-                    elif final_score < 70:
-                        color = "orange"
-                    else:
-                        color = "red"
-                    
-                    # Custom HTML for larger text and color
-                    st.markdown(f"""
-                    <style>
-                    .big-font {{
-                        font-size:32px !important;
-                        font-weight: bold;
-                        color: {color};
-                    }}
-                    </style>
-                    <p class="big-font">{final_score:.2f}%</p>
-                    """, unsafe_allow_html=True)
-                    
-                    st.progress(int(final_score))
-                    st.info("此分數為綜合所有指標的啟發式評估，分數越高，由 AI 生成的可能性越大。僅供參考。")
-
-                    st.divider()
-
-                    # --- 4. Display Individual Metrics ---
-                    st.header("各項指標細節 (Metric Details)")
-                    res_col1, res_col2, res_col3, res_col4 = st.columns(4)
-                    with res_col1:
-                        st.metric(label="Avg. Perplexity", value=f"{avg_ppl:.2f}")
-                    with res_col2:
-                        st.metric(label="Burstiness", value=f"{burstiness_score:.4f}")
-                    with res_col3:
-                        st.metric(label="Lexical Diversity (TTR)", value=f"{ttr_score:.4f}")
-                    if semantic_data:
-                        with res_col4:
-                            st.metric(label="Semantic Drift", value=f"{semantic_data['avg_drift']:.4f}")
-                    
-                    st.divider()
-
-                    # --- 5. Display Plots ---
-                    st.subheader("1. Perplexity (困惑度) 時間序列圖")
-                    perplexity_fig = plotting.plot_perplexity(ppl_scores, avg_ppl)
-                    st.plotly_chart(perplexity_fig, use_container_width=True)
-                    st.info("Perplexity 衡量模型對文本的「驚訝程度」。AI 生成的文本通常更可預測，因此 Perplexity 較低且平穩。")
-
-                    st.divider()
-
-                    st.subheader("2. 句長分布 (Sentence Length Distribution)")
-                    burstiness_fig = plotting.plot_burstiness(sent_lengths)
-                    st.plotly_chart(burstiness_fig, use_container_width=True)
-                    st.info("人類寫作的句子長度通常變化較大 (高 Burstiness)，而 AI 生成的文本則更趨於一致 (低 Burstiness)。")
-                    
-                    st.divider()
+        cascade_mode = st.toggle(
+            "快速篩選模式 (Cascade mode)",
+            help="先計算低成本指標；僅在分數落於不確定區間時才執行 GPT-2 與 MiniLM "
+                 "(Cheap metrics first; perplexity and semantic drift only for texts that are too close to call)",
+        )
 
-                    st.subheader("3. 詞性分布 (Part-of-Speech Distribution)")
-                    pos_fig = plotting.plot_pos_distribution(pos_dist)
-                    st.plotly_chart(pos_fig, use_container_width=True)
-                    
-                    st.divider()
-
-                    st.subheader("4. Zipf's Law (長尾分布)")
-                    zipf_fig = plotting.plot_zipf(zipf_data)
-                    st.plotly_chart(zipf_fig, use_container_width=True)
-                    st.info("此圖比較了文本的實際詞頻分布（藍點）與理想的 Zipf 曲線（紅線）。AI 生成的文本可能缺乏低頻的「長尾」詞彙。")
-
-                    st.divider()
-
-                    st.subheader("5. 語意軌跡 (Semantic Trajectory)")
-                    semantic_fig = plotting.plot_semantic_drift(semantic_data)
-                    st.plotly_chart(semantic_fig, use_container_width=True)
-                    st.info("此圖將每個句子視覺化為 2D 空間中的一個點。AI 生成的文本可能有更平滑、可預測的軌跡。")
+        approx_mode = st.toggle(
+            "近似模式 (Approximate mode)",
+            help=f"長文本專用：以抽樣的視窗與句對估計 Perplexity 與語意漂移，附 95% 信賴區間，每項最多約 {approximate.selected_budget():g} 秒 "
+                 "(For very long texts: perplexity and semantic drift estimated from samples, with 95% intervals, within a time budget)",
+        )
 
+        if st.button("開始分析 (Analyze)"):
+            if text_input:
+                run_analysis(text_input, cascade.selected_band() if cascade_mode else None,
+                             approximate.selected_budget() if approx_mode else None)
             else:
                 st.warning("請輸入文本以進行分析 (Please enter text to analyze)")
+        else:
+            # Any other re-run (switching a chart tab, ...) keeps showing the last results for this text
+            saved = st.session_state.get("analysis_results")
+            if saved and saved["text"] == text_input:
+                show_saved_results(saved)
 
 
 
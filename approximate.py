@@ -0,0 +1,323 @@
+# Approximate analysis for very long texts: perplexity and semantic drift estimated from a random
+# sample of GPT-2 windows and adjacent sentence pairs, with bootstrap confidence intervals.
+#
+# Exact perplexity runs every stride window through GPT-2 and exact drift embeds every sentence;
+# on book-length texts that is nearly all of the cost, while the averages barely move when only a
+# few hundred windows or pairs are used. Here the windows (pairs) are visited in a random order
+# and scored batch by batch until the sample size (DETECTOR_APPROX_WINDOWS / DETECTOR_APPROX_PAIRS)
+# is reached or the time budget (DETECTOR_APPROX_BUDGET seconds) runs out, so stopping at any point
+# still leaves a uniform random sample. The budget covers the model calls; tokenizing and parsing
+# the text are not sampled. The intervals are percentile bootstraps, narrowed by the finite
+# population correction, so a sample that covers every window (pair) has a zero-width interval.
+#
+# Usage (error against exact mode): scores a corpus both ways and reports the relative error of
+# the estimates, how often the exact value falls inside the interval and the speed-up:
+#   python approximate.py corpus.jsonl --limit 20 --budget 2
+#   python approximate.py texts/ --windows 16 --pairs 128
+import argparse
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+import perplexity
+import profiling
+
+WINDOWS_ENV_VAR = "DETECTOR_APPROX_WINDOWS"
+PAIRS_ENV_VAR = "DETECTOR_APPROX_PAIRS"
+BUDGET_ENV_VAR = "DETECTOR_APPROX_BUDGET"
+DEFAULT_WINDOWS = 32
+DEFAULT_PAIRS = 256
+DEFAULT_BUDGET = 2.0  # seconds, used by the app's approximate mode
+BOOTSTRAP_RESAMPLES = 1000
+CONFIDENCE = 0.95
+# Adjacent sentence pairs embedded per encoder call
+PAIR_CHUNK = 64
+# Resample weights generated at once (resamples x sample size); bounds the bootstrap's memory
+BOOTSTRAP_BLOCK = 2**20
+
+
+def selected_windows():
+    return int(os.environ.get(WINDOWS_ENV_VAR, DEFAULT_WINDOWS))
+
+
+def selected_pairs():
+    return int(os.environ.get(PAIRS_ENV_VAR, DEFAULT_PAIRS))
+
+
+def selected_budget():
+    return float(os.environ.get(BUDGET_ENV_VAR, DEFAULT_BUDGET))
+
+
+def _deadline(time_budget: float = None):
+    return time.monotonic() + time_budget if time_budget else None
+
+
+def _expired(deadline):
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def _resample_weights(n: int, n_resamples: int, rng):
+    """Yields blocks of bootstrap weights: each row holds how often each of the n values was drawn, divided by n."""
+    block = max(1, BOOTSTRAP_BLOCK // max(n, 1))
+    for start in range(0, n_resamples, block):
+        rows = min(block, n_resamples - start)
+        yield rng.multinomial(n, np.full(n, 1.0 / n), size=rows) / n
+
+
+def _interval(estimate: float, replicates: np.ndarray, n: int, population: int, confidence: float):
+    """Percentile interval of the bootstrap replicates, scaled by the finite population correction."""
+    alpha = (1.0 - confidence) / 2
+    low, high = np.quantile(replicates, [alpha, 1.0 - alpha])
+    fpc = math.sqrt((population - n) / (population - 1)) if population and population > 1 else 1.0
+    return float(estimate - (estimate - low) * fpc), float(estimate + (high - estimate) * fpc)
+
+
+def bootstrap_mean_ci(values, population: int = None, n_resamples: int = BOOTSTRAP_RESAMPLES,
+                      confidence: float = CONFIDENCE, seed: int = 0):
+    """
+    Confidence interval of the mean of `values`, a sample drawn without replacement from `population` values.
+
+    Returns:
+        - low (float), high (float): The interval; (nan, nan) for an empty sample.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    if not n:
+        return float("nan"), float("nan")
+    estimate = float(values.mean())
+    if n == 1 or population == n:
+        return estimate, estimate
+    rng = np.random.default_rng(seed)
+    replicates = np.concatenate([w @ values for w in _resample_weights(n, n_resamples, rng)])
+    return _interval(estimate, replicates, n, population, confidence)
+
+
+def bootstrap_variance_ci(embeddings: np.ndarray, population: int = None, n_resamples: int = BOOTSTRAP_RESAMPLES,
+                          confidence: float = CONFIDENCE, seed: int = 0):
+    """
+    Confidence interval of the mean per-dimension variance of sampled embeddings (the statistic of
+    analysis.drift_summary). Each resample is two weighted sums, so it is one matrix product per block.
+
+    Returns:
+        - low (float), high (float): The interval; (nan, nan) for fewer than 2 embeddings.
+    """
+    x = np.asarray(embeddings, dtype=np.float64)
+    n, dim = x.shape if x.ndim == 2 else (0, 0)
+    if n < 2:
+        return float("nan"), float("nan")
+    sq_norms = np.einsum("ij,ij->i", x, x)
+    # mean over dims of var(x[:, d]) = (mean of |x|^2 - |mean of x|^2) / dim
+    estimate = float((sq_norms.mean() - x.mean(axis=0) @ x.mean(axis=0)) / dim)
+    if population == n:
+        return estimate, estimate
+    rng = np.random.default_rng(seed)
+    replicates = []
+    for w in _resample_weights(n, n_resamples, rng):
+        means = w @ x
+        replicates.append((w @ sq_norms - np.einsum("ij,ij->i", means, means)) / dim)
+    return _interval(estimate, np.concatenate(replicates), n, population, confidence)
+
+
+# --- Perplexity ---
+def approximate_perplexity(model, tokenizer, text: str, max_windows: int = DEFAULT_WINDOWS,
+                           time_budget: float = None, stride: int = perplexity.DEFAULT_STRIDE,
+                           batch_size: int = perplexity.DEFAULT_BATCH_SIZE,
+                           cache: perplexity.WindowCache = None, seed: int = 0):
+    """
+    Estimates the perplexity of perplexity.perplexity_for_texts from a uniform random sample of its
+    windows: at most `max_windows`, fewer if `time_budget` seconds run out first (at least one batch
+    is always scored).
+
+    Returns:
+        - A dictionary with avg_ppl (exp of the mean sampled window NLL), avg_ppl_ci (the interval,
+          mapped through exp from the bootstrap interval of the mean NLL), windows (the sampled
+          window indices, in document order), ppl_scores (their perplexities), windows_scored,
+          windows_total, exact (True if every window was scored) and approximate (True).
+    """
+    deadline = _deadline(time_budget)
+    with profiling.stage("perplexity.tokenize"):
+        ids = tokenizer(text)["input_ids"]
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    layout = perplexity.plan_windows(len(ids), model.config.n_positions, stride)
+    order = np.random.default_rng(seed).permutation(len(layout))[:max(1, max_windows)]
+
+    sampled, nlls = [], []
+    for start in range(0, len(order), batch_size):
+        chunk = order[start:start + batch_size].tolist()
+        windows = [(ids[layout[i][0]:layout[i][1]], layout[i][2]) for i in chunk]
+        nlls.extend(perplexity.score_windows(model, windows, batch_size=batch_size,
+                                             pad_token_id=pad_token_id, cache=cache))
+        sampled.extend(chunk)
+        if _expired(deadline):
+            break
+
+    if not nlls:
+        return {"avg_ppl": 0, "avg_ppl_ci": (0, 0), "windows": [], "ppl_scores": [], "windows_scored": 0,
+                "windows_total": 0, "exact": True, "approximate": True}
+    nlls = np.asarray(nlls, dtype=np.float64)
+    low, high = bootstrap_mean_ci(nlls, population=len(layout), seed=seed)
+    by_position = np.argsort(sampled)
+    return {
+        "avg_ppl": float(np.exp(nlls.mean())),
+        "avg_ppl_ci": (float(np.exp(low)), float(np.exp(high))),
+        "windows": np.asarray(sampled)[by_position].tolist(),
+        "ppl_scores": np.exp(nlls[by_position]).tolist(),
+        "windows_scored": len(sampled),
+        "windows_total": len(layout),
+        "exact": len(sampled) == len(layout),
+        "approximate": True,
+    }
+
+
+# --- Semantic drift ---
+def approximate_drift(encode, sentences: list, max_pairs: int = DEFAULT_PAIRS, time_budget: float = None,
+                      seed: int = 0):
+    """
+    Estimates semantic drift from a uniform random sample of adjacent sentence pairs: at most
+    `max_pairs`, fewer if `time_budget` seconds run out first. Only the sentences of sampled pairs
+    are embedded, with `encode` (a list of sentences -> float32 array, e.g. analysis.encode_sentences).
+
+    Returns:
+        - A dictionary with avg_drift and variance (as in analysis.drift_summary, over the sampled
+          pairs and sentences), their intervals avg_drift_ci and variance_ci, pairs_sampled,
+          pairs_total, sentences_encoded, exact and approximate (True); None for fewer than 2 sentences.
+    """
+    n_pairs = len(sentences) - 1
+    if n_pairs < 1:
+        return None
+    deadline = _deadline(time_budget)
+    order = np.random.default_rng(seed).permutation(n_pairs)[:max(1, max_pairs)]
+
+    rows = {}  # sentence index -> row of `matrix`
+    matrix = None
+    drifts = []
+    for start in range(0, len(order), PAIR_CHUNK):
+        chunk = order[start:start + PAIR_CHUNK]
+        needed = sorted({int(j) for i in chunk for j in (i, i + 1)} - rows.keys())
+        if needed:
+            vectors = encode([sentences[j] for j in needed])
+            if matrix is None:
+                matrix = np.empty((min(len(sentences), 2 * len(order)), vectors.shape[1]), dtype=np.float32)
+            base = len(rows)
+            matrix[base:base + len(needed)] = vectors
+            rows.update((j, base + k) for k, j in enumerate(needed))
+        first = matrix[[rows[int(i)] for i in chunk]]
+        second = matrix[[rows[int(i) + 1] for i in chunk]]
+        norms = np.maximum(np.linalg.norm(first, axis=1) * np.linalg.norm(second, axis=1), 1e-12)
+        similarity = np.einsum("ij,ij->i", first, second) / norms
+        drifts.append(np.clip(1.0 - similarity, 0.0, 2.0))
+        if _expired(deadline):
+            break
+
+    drifts = np.concatenate(drifts).astype(np.float64)
+    matrix = matrix[:len(rows)]
+    drift_ci = bootstrap_mean_ci(drifts, population=n_pairs, seed=seed)
+    variance_ci = bootstrap_variance_ci(matrix, population=len(sentences), seed=seed)
+    variance = float(np.mean(np.var(matrix, axis=0, dtype=np.float64)))
+    return {
+        "avg_drift": float(drifts.mean()),
+        "avg_drift_ci": drift_ci,
+        "variance": variance,
+        "variance_ci": variance_ci,
+        "pairs_sampled": len(drifts),
+        "pairs_total": n_pairs,
+        "sentences_encoded": len(rows),
+        "exact": len(drifts) == n_pairs,
+        "approximate": True,
+    }
+
+
+# --- Error against exact mode ---
+def compare_with_exact(text: str, max_windows: int, max_pairs: int, time_budget: float = None, seed: int = 0):
+    """
+    Scores one text exactly and approximately, without the window and embedding caches (so the
+    timings are not helped by each other's results).
+
+    Returns:
+        - A dictionary with the exact and approximate values, the intervals, the time each mode took
+          and how many windows / pairs were sampled.
+    """
+    import analysis
+    from document import parse_document
+
+    model, tokenizer = analysis.load_perplexity_model()
+    embedder = analysis.load_embedding_model()
+
+    def encode(batch):
+        return np.asarray(embedder.encode(batch, convert_to_numpy=True), dtype=np.float32)
+
+    sentences = list(parse_document(text).sentences)
+    start = time.perf_counter()
+    exact_ppl, _ = perplexity.perplexity_for_texts(model, tokenizer, [text])[0]
+    exact_drift = analysis.drift_summary(encode(sentences)) if len(sentences) > 1 else None
+    exact_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    # Each estimate gets the budget; the app runs them side by side
+    ppl = approximate_perplexity(model, tokenizer, text, max_windows, time_budget, seed=seed)
+    drift = approximate_drift(encode, sentences, max_pairs, time_budget, seed=seed)
+    approx_time = time.perf_counter() - start
+    return {
+        "exact_ppl": exact_ppl, "ppl": ppl["avg_ppl"], "ppl_ci": ppl["avg_ppl_ci"],
+        "windows": (ppl["windows_scored"], ppl["windows_total"]),
+        "exact_drift": exact_drift["avg_drift"] if exact_drift else None,
+        "drift": drift["avg_drift"] if drift else None, "drift_ci": drift["avg_drift_ci"] if drift else None,
+        "pairs": (drift["pairs_sampled"], drift["pairs_total"]) if drift else (0, 0),
+        "exact_time": exact_time, "approx_time": approx_time,
+    }
+
+
+def _within(value, interval):
+    return interval[0] - 1e-9 <= value <= interval[1] + 1e-9
+
+
+def main(argv=None):
+    from score_corpus import open_reader
+
+    parser = argparse.ArgumentParser(description="Compare approximate (sampled) perplexity and drift with exact mode.")
+    parser.add_argument("input", help="A .jsonl, .json (array), .csv or .parquet file, or a directory of .txt files")
+    parser.add_argument("--windows", type=int, default=selected_windows(), help="Perplexity windows to sample")
+    parser.add_argument("--pairs", type=int, default=selected_pairs(), help="Adjacent sentence pairs to sample")
+    parser.add_argument("--budget", type=float, default=None, help="Time budget per estimate in seconds")
+    parser.add_argument("--limit", type=int, default=None, help="Only use the first N texts")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--text-field", default="text")
+    parser.add_argument("--id-field", default="id")
+    args = parser.parse_args(argv)
+
+    import analysis
+
+    analysis.download_nltk_data()
+    rows = []
+    print(f"{'id':>12}  {'windows':>11}  {'ppl exact':>10}  {'ppl approx':>10}  {'rel err':>8}  "
+          f"{'pairs':>11}  {'drift err':>9}  {'speed-up':>8}")
+    for i, record in enumerate(open_reader(args.input, args.text_field, args.id_field)):
+        if args.limit is not None and i >= args.limit:
+            break
+        row = compare_with_exact(record["text"], args.windows, args.pairs, args.budget, args.seed)
+        rows.append(row)
+        rel_err = abs(row["ppl"] - row["exact_ppl"]) / row["exact_ppl"] if row["exact_ppl"] else 0.0
+        drift_err = abs(row["drift"] - row["exact_drift"]) if row["drift"] is not None else float("nan")
+        print(f"{str(record['id'])[:12]:>12}  {row['windows'][0]:>5}/{row['windows'][1]:<5}  {row['exact_ppl']:>10.2f}  "
+              f"{row['ppl']:>10.2f}  {rel_err:>8.2%}  {row['pairs'][0]:>5}/{row['pairs'][1]:<5}  {drift_err:>9.4f}  "
+              f"{row['exact_time'] / row['approx_time']:>7.1f}x")
+
+    if not rows:
+        print("No texts found", file=sys.stderr)
+        return 1
+    ppl_errors = [abs(r["ppl"] - r["exact_ppl"]) / r["exact_ppl"] for r in rows if r["exact_ppl"]]
+    drift_rows = [r for r in rows if r["drift"] is not None]
+    print(f"\n{len(rows)} texts; perplexity: mean relative error {np.mean(ppl_errors):.2%}, "
+          f"exact value inside the {CONFIDENCE:.0%} interval for {np.mean([_within(r['exact_ppl'], r['ppl_ci']) for r in rows]):.0%}")
+    if drift_rows:
+        print(f"semantic drift: mean absolute error {np.mean([abs(r['drift'] - r['exact_drift']) for r in drift_rows]):.4f}, "
+              f"exact value inside the interval for {np.mean([_within(r['exact_drift'], r['drift_ci']) for r in drift_rows]):.0%}")
+    print(f"time: exact {sum(r['exact_time'] for r in rows):.1f}s, approximate {sum(r['approx_time'] for r in rows):.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,385 @@
+# Offline benchmark suite for the metrics in analysis.py and for the app's analysis pipeline.
+#
+# Usage:
+#   python benchmark.py --sizes 1k,10k,100k --save-baseline benchmark_baseline.json
+#   python benchmark.py --sizes 1k,10k,100k --baseline benchmark_baseline.json --threshold 0.2
+#   python benchmark.py --sizes 1M --metrics parse,burstiness,stylometry,zipf --model-size full
+#
+# Texts are synthetic (Zipf-distributed pseudo-words mixed with English function words) and the
+# models are randomly initialised stand-ins for distilgpt2 and all-MiniLM-L6-v2 built from their
+# configs, so nothing is downloaded. "--model-size full" uses the real architectures' dimensions,
+# "tiny" (the default) shrinks them so large corpora finish quickly. NLTK data must be installed.
+#
+# Every (metric, size) is run --repeat times without caches; the median latency, throughput in
+# words per second and peak RSS growth are reported. With --baseline the run exits with status 1
+# if any latency or peak memory is more than --threshold above the stored baseline.
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import caching
+import analysis
+import plotting
+import profiling
+from document import parse_document
+from incremental import IncrementalAnalyzer
+
+METRICS = ("parse", "burstiness", "stylometry", "zipf", "semantic_drift", "perplexity", "pipeline")
+DEFAULT_SIZES = "1k,10k,100k"
+DEFAULT_THRESHOLD = 0.2
+# Differences below these are treated as noise, whatever the ratio
+MIN_LATENCY_DELTA = 0.01  # seconds
+MIN_MEMORY_DELTA = 16.0  # MB
+
+FUNCTION_WORDS = (
+    "the", "a", "an", "of", "and", "or", "but", "to", "in", "on", "at", "by", "for", "with", "from",
+    "is", "was", "are", "were", "be", "it", "he", "she", "they", "we", "you", "this", "that", "which",
+    "not", "very", "quickly", "often", "has", "had", "will", "can",
+)
+SYLLABLES = tuple(c + v for c in "bdfgklmnprstvz" for v in "aeiou")
+PUNCTUATION = (".", "?", "!", ",", ";", ":")
+
+# Model dimensions of the stand-ins; "full" matches distilgpt2 and all-MiniLM-L6-v2
+MODEL_SIZES = {
+    "tiny": {
+        "gpt2": dict(n_layer=2, n_head=2, n_embd=128),
+        "bert": dict(num_hidden_layers=2, num_attention_heads=2, hidden_size=128, intermediate_size=512),
+    },
+    "full": {
+        "gpt2": dict(n_layer=6, n_head=12, n_embd=768),
+        "bert": dict(num_hidden_layers=6, num_attention_heads=12, hidden_size=384, intermediate_size=1536),
+    },
+}
+
+
+# --- Synthetic corpora ---
+def parse_size(size: str) -> int:
+    """'1k' -> 1000, '1M' -> 1000000."""
+    size = size.strip()
+    multiplier = {"k": 1_000, "m": 1_000_000}.get(size[-1:].lower(), 1)
+    return int(float(size[:-1] if multiplier > 1 else size) * multiplier)
+
+
+def pseudo_words(vocab_size: int):
+    """Unique alphabetic pseudo-words ("ba", "bake", ...), one per rank."""
+    words = []
+    for i in range(vocab_size):
+        parts = []
+        n = i + 1
+        while n:
+            n, r = divmod(n, len(SYLLABLES))
+            parts.append(SYLLABLES[r])
+        words.append("".join(parts))
+    return words
+
+
+def synthetic_corpus(n_words: int, vocab_size: int = 20_000, seed: int = 0) -> str:
+    """
+    Generates a text of about `n_words` words. Content words follow a Zipf distribution, about a third
+    of the words are English function words, and sentence lengths are log-normal (mean ~16 words).
+    """
+    rng = np.random.default_rng(seed)
+    vocab = np.array(pseudo_words(vocab_size), dtype=object)
+    probs = 1.0 / np.arange(1, vocab_size + 1) ** 1.1
+    words = vocab[rng.choice(vocab_size, size=n_words, p=probs / probs.sum())]
+    function = rng.random(n_words) < 0.35
+    words[function] = np.array(FUNCTION_WORDS, dtype=object)[rng.integers(len(FUNCTION_WORDS), size=int(function.sum()))]
+
+    sentences = []
+    start = 0
+    while start < n_words:
+        length = int(np.clip(rng.lognormal(2.7, 0.45), 3, 60))
+        sentence = list(words[start:start + length])
+        sentence[0] = sentence[0].capitalize()
+        if len(sentence) > 6 and rng.random() < 0.3:
+            sentence[len(sentence) // 2] += ","
+        sentences.append(" ".join(sentence) + rng.choice([".", ".", ".", "?", "!"]))
+        start += length
+    return " ".join(sentences)
+
+
+# --- Stand-in models ---
+def build_tokenizer(vocab_size: int = 20_000):
+    """A word-level tokenizer over the synthetic vocabulary, standing in for the GPT-2 and MiniLM tokenizers."""
+    from tokenizers import Tokenizer, models, normalizers, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+
+    vocab = ["<pad>", "<unk>", "<eos>", *PUNCTUATION, *FUNCTION_WORDS, *pseudo_words(vocab_size)]
+    tok = Tokenizer(models.WordLevel({w: i for i, w in enumerate(dict.fromkeys(vocab))}, unk_token="<unk>"))
+    tok.normalizer = normalizers.Lowercase()
+    tok.pre_tokenizer = pre_tokenizers.Whitespace()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tok, pad_token="<pad>", unk_token="<unk>", eos_token="<eos>", model_max_length=sys.maxsize
+    )
+
+
+class StandInEncoder:
+    """A randomly initialised BERT encoder with mean pooling, exposing SentenceTransformer.encode."""
+
+    def __init__(self, tokenizer, **config):
+        from transformers import BertConfig, BertModel
+
+        self.tokenizer = tokenizer
+        self.model = BertModel(BertConfig(vocab_size=len(tokenizer), max_position_embeddings=512, **config)).eval()
+        self.dim = self.model.config.hidden_size
+
+    def encode(self, sentences: list, batch_size: int = 32, convert_to_numpy: bool = True, **kwargs):
+        import torch
+
+        out = []
+        with torch.no_grad():
+            for start in range(0, len(sentences), batch_size):
+                batch = self.tokenizer(
+                    sentences[start:start + batch_size], padding=True, truncation=True, max_length=256,
+                    return_tensors="pt", return_token_type_ids=False,
+                )
+                hidden = self.model(**batch).last_hidden_state
+                mask = batch["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+                out.append(((hidden * mask).sum(1) / mask.sum(1).clamp(min=1)).numpy())
+        return np.concatenate(out) if out else np.zeros((0, self.dim), dtype=np.float32)
+
+
+def install_stand_in_models(model_size: str = "tiny", seed: int = 0):
+    """Replaces analysis.load_perplexity_model / load_embedding_model with random, offline stand-ins."""
+    import torch
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    torch.manual_seed(seed)
+    dims = MODEL_SIZES[model_size]
+    tokenizer = build_tokenizer()
+    gpt2 = GPT2LMHeadModel(GPT2Config(
+        vocab_size=len(tokenizer), n_positions=1024, bos_token_id=tokenizer.eos_token_id,
+        eos_token_id=tokenizer.eos_token_id, **dims["gpt2"],
+    )).eval()
+    encoder = StandInEncoder(tokenizer, **dims["bert"])
+    analysis.load_perplexity_model = lambda: (gpt2, tokenizer)
+    analysis.load_embedding_model = lambda: encoder
+
+
+# --- Measurement ---
+class PeakMemory:
+    """
+    Samples the process RSS in a background thread and records the peak growth over the block.
+    Unsupported (peak_mb stays None) where /proc/self/statm does not exist.
+    """
+
+    INTERVAL = 0.002
+
+    def __enter__(self):
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._start = self._peak = profiling.rss_bytes()
+        if self._start is None:
+            self._thread = None
+            return self
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.INTERVAL):
+            self._peak = max(self._peak, profiling.rss_bytes())
+
+    def __exit__(self, *exc):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._peak = max(self._peak, profiling.rss_bytes())
+            self.peak_mb = (self._peak - self._start) / 2**20
+        return False
+
+
+def _reset_caches():
+    """Drops every in-process cache, so each repetition measures the cold path."""
+    for cached in (analysis.load_document, analysis.load_embedding_cache, analysis.load_window_cache):
+        cached.clear()
+
+
+def run_pipeline(text: str):
+    """
+    The work app.run_analysis does for a fresh session, without Streamlit: every metric on a
+    worker pool, the final score, and the Plotly figures and the token heatmap.
+    """
+    analyzer = IncrementalAnalyzer()
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        ppl = pool.submit(analyzer.surprisal, text)
+        doc = analyzer.update_document(text)
+        semantic = pool.submit(analysis.calculate_semantic_drift, doc)
+        reference = pool.submit(analysis.calculate_reference_matches, doc)
+        burstiness = pool.submit(analyzer.burstiness)
+        stylometry = pool.submit(analyzer.stylometry)
+        zipf = pool.submit(analyzer.zipf)
+
+        surprisal = analysis.sentence_surprisal(doc, ppl.result())
+        avg_ppl, ppl_scores = surprisal["avg_ppl"], surprisal["ppl_scores"]
+        burstiness_score, sent_lengths = burstiness.result()
+        ttr, pos_dist = stylometry.result()
+        semantic_data = analysis.semantic_sentences(text, semantic.result())
+        metrics = {"avg_perplexity": avg_ppl, "burstiness": burstiness_score, "ttr": ttr}
+        if semantic_data:
+            metrics["avg_drift"] = semantic_data["avg_drift"]
+        zipf_data = zipf.result()
+        if zipf_data and zipf_data["exponent"] is not None:
+            metrics["zipf_exponent"] = zipf_data["exponent"]
+        reference_data = reference.result()
+        if reference_data is not None:
+            metrics["reference_coverage"] = reference_data["coverage"]
+            metrics["reference_ai_fraction"] = reference_data["ai_fraction"]
+
+        plotting.plot_perplexity(ppl_scores, avg_ppl)
+        plotting.plot_sentence_perplexity(surprisal["sentence_ppl"], surprisal["sentences"], avg_ppl)
+        plotting.token_heatmap_html(text, surprisal["token_nlls"], surprisal["token_offsets"])
+        plotting.plot_burstiness(sent_lengths)
+        plotting.plot_pos_distribution(pos_dist)
+        plotting.plot_zipf(zipf_data)
+        plotting.plot_semantic_drift(semantic_data)
+    return analysis.calculate_final_score(metrics)
+
+
+def _metric_call(metric: str, text: str, doc):
+    if metric == "parse":
+        return lambda: parse_document(text)
+    if metric == "pipeline":
+        return lambda: run_pipeline(text)
+    func = getattr(analysis, f"calculate_{metric}").__wrapped__
+    return lambda: func(doc)
+
+
+def measure(metric: str, text: str, doc, n_words: int, repeat: int = 3):
+    """
+    Returns:
+        - A dictionary with the median latency (s), throughput (words/s) and peak RSS growth (MB).
+    """
+    call = _metric_call(metric, text, doc)
+    latencies = []
+    peaks = []
+    for _ in range(repeat):
+        _reset_caches()
+        with PeakMemory() as mem:
+            start = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - start)
+        if mem.peak_mb is not None:
+            peaks.append(mem.peak_mb)
+    latency = statistics.median(latencies)
+    return {
+        "metric": metric,
+        "words": n_words,
+        "latency_s": latency,
+        "throughput_wps": n_words / latency if latency > 0 else None,
+        "peak_mem_mb": max(peaks) if peaks else None,
+    }
+
+
+def run_benchmarks(sizes: list, metrics: list, repeat: int = 3, model_size: str = "tiny"):
+    """
+    Returns:
+        - A dictionary with run metadata and a "results" map keyed by "<metric>@<size>".
+    """
+    import torch
+
+    caching.set_backend("none")
+    caching.set_result_store(None)
+    analysis.download_nltk_data()
+    install_stand_in_models(model_size)
+
+    results = {}
+    for size in sizes:
+        n_words = parse_size(size)
+        text = synthetic_corpus(n_words)
+        doc = parse_document(text)
+        # Warm the models (lazy initialisation, allocator) outside the timed runs
+        if any(m in metrics for m in ("perplexity", "semantic_drift", "pipeline")):
+            run_pipeline(synthetic_corpus(200, seed=1))
+        for metric in metrics:
+            key = f"{metric}@{size}"
+            results[key] = measure(metric, text, doc, n_words, repeat)
+            r = results[key]
+            mem = f"{r['peak_mem_mb']:8.1f} MB" if r["peak_mem_mb"] is not None else "       - MB"
+            print(f"{key:>24}  {r['latency_s']:9.3f} s  {r['throughput_wps']:12,.0f} words/s  {mem}", flush=True)
+
+    return {
+        "meta": {
+            "model_size": model_size,
+            "repeat": repeat,
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float = DEFAULT_THRESHOLD):
+    """
+    Returns:
+        - A list of regression messages (empty if every shared benchmark is within `threshold`).
+    """
+    if baseline.get("meta", {}).get("model_size") != current["meta"]["model_size"]:
+        print("warning: baseline was recorded with a different --model-size", file=sys.stderr)
+    regressions = []
+    for key, result in current["results"].items():
+        base = baseline.get("results", {}).get(key)
+        if base is None:
+            continue
+        checks = [("latency_s", MIN_LATENCY_DELTA, "s"), ("peak_mem_mb", MIN_MEMORY_DELTA, "MB")]
+        for field, min_delta, unit in checks:
+            new, old = result.get(field), base.get(field)
+            if new is None or old is None:
+                continue
+            if new - old > min_delta and new > old * (1 + threshold):
+                regressions.append(f"{key} {field}: {old:.3f} -> {new:.3f} {unit} (+{(new / old - 1) if old else float('inf'):.0%})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the detector metrics on synthetic corpora, offline.")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Comma-separated corpus sizes in words, e.g. 1k,10k,1M")
+    parser.add_argument("--metrics", default=",".join(METRICS), help=f"Comma-separated subset of {', '.join(METRICS)}")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark; the median latency is reported")
+    parser.add_argument("--model-size", choices=sorted(MODEL_SIZES), default="tiny")
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--save-baseline", metavar="PATH", help="Write the results as the new baseline")
+    parser.add_argument("--baseline", metavar="PATH", help="Fail if results regress against this baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Allowed relative regression (default 0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    metrics = [m.strip() for m in args.metrics.split(",") if m.strip()]
+    unknown = set(metrics) - set(METRICS)
+    if unknown:
+        parser.error(f"unknown metrics: {', '.join(sorted(unknown))}")
+    sizes = [s.strip() for s in args.sizes.split(",") if s.strip()]
+
+    current = run_benchmarks(sizes, metrics, repeat=args.repeat, model_size=args.model_size)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(current, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.threshold:.0%}:")
+            for message in regressions:
+                print(f"  {message}")
+            return 1
+        print(f"\nNo regressions beyond {args.threshold:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,550 @@
+# This file contains the pluggable cache layer used by analysis.py.
+# Data results (metrics) are kept in one in-process store with a memory budget, both inside the
+# Streamlit app and anywhere else (batch scoring, scripts, notebooks); models and other shared
+# objects go through st.cache_resource in the app. The analysis core never has to import Streamlit.
+# Under every backend, an optional SQLite result store persists results across processes and restarts.
+#
+# Results are compacted before they are cached (float64 arrays as float32, short strings interned)
+# and evicted least recently used first once their estimated size exceeds DETECTOR_CACHE_MAX_MB,
+# or DETECTOR_CACHE_TTL seconds after they were computed. Cached arrays are read-only and shared;
+# lists and dicts are copied for every caller, so mutating a result never changes the cache.
+import dataclasses
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+import profiling
+
+# Selects the default backend outside the app: "memory", "disk" or "none"
+CACHE_ENV_VAR = "DETECTOR_CACHE"
+CACHE_DIR_ENV_VAR = "DETECTOR_CACHE_DIR"
+# Path of a SQLite result store shared by all processes; enables persistence under any backend
+RESULT_DB_ENV_VAR = "DETECTOR_RESULT_DB"
+RESULT_DB_MAX_BYTES_ENV_VAR = "DETECTOR_RESULT_DB_MAX_BYTES"
+# Memory budget and lifetime of the in-process result store
+MEMORY_MAX_MB_ENV_VAR = "DETECTOR_CACHE_MAX_MB"
+TTL_ENV_VAR = "DETECTOR_CACHE_TTL"
+DEFAULT_MEMORY_MAX_MB = 256
+# Strings up to this length in cached results (words, labels, sources) are interned and shared by every result
+INTERN_MAX_CHARS = 32
+
+
+def default_cache_dir():
+    return os.environ.get(CACHE_DIR_ENV_VAR) or os.path.join(os.path.expanduser("~"), ".cache", "ai-text-detector")
+
+
+def _hash_value(value, hash_funcs: dict, h):
+    """Feeds a stable representation of `value` into the hash object `h`."""
+    for cls, hash_func in hash_funcs.items():
+        if isinstance(value, cls):
+            h.update(str(hash_func(value)).encode("utf-8"))
+            return
+    if isinstance(value, str):
+        h.update(b"s")
+        h.update(value.encode("utf-8"))
+    elif isinstance(value, bytes):
+        h.update(b"b")
+        h.update(value)
+    elif value is None or isinstance(value, (bool, int, float)):
+        h.update(repr(value).encode("utf-8"))
+    elif isinstance(value, (list, tuple)):
+        h.update(b"[")
+        for item in value:
+            _hash_value(item, hash_funcs, h)
+            h.update(b",")
+        h.update(b"]")
+    elif isinstance(value, dict):
+        h.update(b"{")
+        for key in sorted(value, key=repr):
+            _hash_value(key, hash_funcs, h)
+            _hash_value(value[key], hash_funcs, h)
+        h.update(b"}")
+    else:
+        h.update(pickle.dumps(value))
+
+
+@functools.lru_cache(maxsize=None)
+def _signature(func):
+    try:
+        return inspect.signature(func)
+    except (TypeError, ValueError):
+        return None
+
+
+def _bound_arguments(func, args: tuple, kwargs: dict):
+    """
+    The call's arguments by parameter name, defaults included, so f(doc) and f(doc, stride=512)
+    share a key and changing a default changes the key.
+    """
+    signature = _signature(func)
+    if signature is None:
+        return args, kwargs
+    try:
+        bound = signature.bind(*args, **kwargs)
+    except TypeError:
+        # Let the call itself raise the error
+        return args, kwargs
+    bound.apply_defaults()
+    return dict(bound.arguments)
+
+
+def make_key(func, args: tuple, kwargs: dict, hash_funcs: dict = None, extra: tuple = ()) -> str:
+    """
+    Builds the cache key for one call: the function's qualified name, `extra` (e.g. the model and
+    result version) and a digest of its bound arguments.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{func.__module__}.{func.__qualname__}".encode("utf-8"))
+    _hash_value(extra, hash_funcs or {}, h)
+    _hash_value(_bound_arguments(func, args, kwargs), hash_funcs or {}, h)
+    return h.hexdigest()
+
+
+def compact(value):
+    """
+    Converts a result to the compact form it is cached in: float64 arrays become float32, int64
+    arrays int32 (when the values fit) and short strings are interned; lists, tuples and dicts are
+    rebuilt with compacted items. Arrays are made read-only, since they are shared by every caller
+    (the containers around them are not, see _unshared).
+    """
+    if isinstance(value, np.ndarray):
+        if value.dtype == np.float64:
+            value = value.astype(np.float32)
+        elif value.dtype == np.int64 and (
+            not value.size
+            or (value.min() >= np.iinfo(np.int32).min and value.max() <= np.iinfo(np.int32).max)
+        ):
+            value = value.astype(np.int32)
+        else:
+            value = value.view()
+        value.flags.writeable = False
+        return value
+    if type(value) is str:
+        return sys.intern(value) if len(value) <= INTERN_MAX_CHARS else value
+    if type(value) is list:
+        return [compact(item) for item in value]
+    if type(value) is tuple:
+        return tuple(compact(item) for item in value)
+    if type(value) is dict:
+        return {compact(key): compact(item) for key, item in value.items()}
+    return value
+
+
+def _unshared(value):
+    """
+    A copy of a cached result's lists, tuples and dicts (as st.cache_data returns a copy), so a caller
+    that mutates its result does not change what later callers get. Arrays (read-only after compact)
+    and other objects such as Documents are shared.
+    """
+    if type(value) is list:
+        return [_unshared(item) for item in value]
+    if type(value) is tuple:
+        return tuple(_unshared(item) for item in value)
+    if type(value) is dict:
+        return {key: _unshared(item) for key, item in value.items()}
+    return value
+
+
+def estimate_size(value, _seen: set = None) -> int:
+    """Approximate memory held by `value` in bytes (array buffers included, objects shared within it counted once)."""
+    if _seen is None:
+        _seen = set()
+    if id(value) in _seen:
+        return 0
+    _seen.add(id(value))
+    if isinstance(value, np.ndarray):
+        # A view does not own its buffer, so sys.getsizeof leaves it out
+        return sys.getsizeof(value) + (0 if value.flags.owndata else value.nbytes)
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(k, _seen) + estimate_size(v, _seen) for k, v in value.items())
+    elif dataclasses.is_dataclass(value) and not isinstance(value, type):
+        # E.g. a parsed Document: its fields hold the data
+        size += sum(estimate_size(getattr(value, field.name), _seen) for field in dataclasses.fields(value))
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, _seen) for item in value)
+    return size
+
+
+class MemoryStore:
+    """
+    The in-process store shared by every cached data function: least recently used results are
+    evicted once the total estimated size exceeds `max_bytes`, and results expire `ttl` seconds
+    after they were computed (never if `ttl` is None).
+    """
+
+    def __init__(self, max_bytes: int, ttl: float = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl or None
+        self._entries = OrderedDict()  # key -> (value, size, expires, function), least recently used first
+        self._functions = {}  # function -> OrderedDict of its keys, least recently used first
+        self._function_bytes = Counter()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = Counter()  # reason ("size", "ttl", "max_entries") -> count
+        self.rejected = 0  # results larger than the whole budget, never stored
+
+    def _remove(self, key, reason: str = None):
+        _, size, _, function = self._entries.pop(key)
+        del self._functions[function][key]
+        self._bytes -= size
+        self._function_bytes[function] -= size
+        if reason:
+            self.evictions[reason] += 1
+
+    def _sweep(self, now: float):
+        """Drops every expired entry; runs at most four times per TTL period."""
+        if self.ttl is None or now < self._next_sweep:
+            return
+        self._next_sweep = now + self.ttl / 4
+        for key in [k for k, (_, _, expires, _) in self._entries.items() if expires <= now]:
+            self._remove(key, "ttl")
+
+    def get(self, key: str):
+        """
+        Returns:
+            - hit (bool): Whether a live result was found.
+            - value: The cached result, or None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] <= time.monotonic():
+                self._remove(key, "ttl")
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self._functions[entry[3]].move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, key: str, value, function: str, max_entries: int = None):
+        """Stores a result of `function`, evicting older results to stay within the budget (and `max_entries` per function)."""
+        size = estimate_size(value)
+        now = time.monotonic()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._sweep(now)
+            if size > self.max_bytes:
+                self.rejected += 1
+                return
+            keys = self._functions.setdefault(function, OrderedDict())
+            while max_entries is not None and keys and len(keys) >= max_entries:
+                self._remove(next(iter(keys)), "max_entries")
+            while self._entries and self._bytes + size > self.max_bytes:
+                self._remove(next(iter(self._entries)), "size")
+            self._entries[key] = (value, size, now + self.ttl if self.ttl else None, function)
+            keys[key] = None
+            self._bytes += size
+            self._function_bytes[function] += size
+
+    def clear(self, function: str = None):
+        """Drops every result, or only those of `function`."""
+        with self._lock:
+            keys = list(self._entries) if function is None else list(self._functions.get(function, ()))
+            for key in keys:
+                self._remove(key)
+
+    def stats(self):
+        """
+        Returns:
+            - A dictionary with the number of entries, their estimated size in bytes, the budget and
+              TTL, hit/miss counts, evictions by reason and the entries / bytes of each function.
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_s": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": dict(self.evictions),
+                "rejected": self.rejected,
+                "functions": [
+                    {"function": function, "entries": len(keys), "bytes": self._function_bytes[function]}
+                    for function, keys in sorted(self._functions.items()) if keys
+                ],
+            }
+
+
+class MemoryCache:
+    """
+    A thread-safe in-process cache. Data results go to the budgeted MemoryStore and every caller gets
+    its own copy of their lists and dicts; resources are kept by reference for the life of the
+    process (up to `max_entries` per function).
+    """
+    name = "memory"
+
+    def __init__(self):
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def wrap_data(self, func, hash_funcs=None, max_entries=None):
+        name = f"{func.__module__}.{func.__qualname__}"
+        store = get_memory_store()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = make_key(func, args, kwargs, hash_funcs)
+            hit, value = store.get(key)
+            if hit:
+                return _unshared(value)
+            value = func(*args, **kwargs)
+            store.put(key, value, name, max_entries)
+            return _unshared(value)
+
+        wrapper.clear = functools.partial(store.clear, name)
+        return wrapper
+
+    def wrap_resource(self, func, hash_funcs=None, max_entries=None):
+        store = self._stores.setdefault(f"{func.__module__}.{func.__qualname__}", {})
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = make_key(func, args, kwargs, hash_funcs)
+            with self._lock:
+                if key in store:
+                    return store[key]
+            result = func(*args, **kwargs)
+            with self._lock:
+                if max_entries is not None and len(store) >= max_entries:
+                    # Drop the oldest entry (dicts keep insertion order)
+                    store.pop(next(iter(store)))
+                store[key] = result
+            return result
+
+        wrapper.clear = store.clear
+        return wrapper
+
+
+class NoCache(MemoryCache):
+    """Recomputes every result. Resources such as models are still loaded once per process."""
+    name = "none"
+
+    def wrap_data(self, func, hash_funcs=None, max_entries=None):
+        return func
+
+
+class DiskCache(NoCache):
+    """Keeps results only in the persistent result store (see result_store.py), not in process memory."""
+    name = "disk"
+
+    def __init__(self):
+        super().__init__()
+        if get_result_store() is None:
+            set_result_store(os.path.join(default_cache_dir(), "results.sqlite"))
+
+
+class StreamlitCache(MemoryCache):
+    """
+    Keeps data results in the budgeted MemoryStore (st.cache_data has no memory budget) and
+    delegates resources to st.cache_resource. Only used inside the Streamlit app.
+    """
+    name = "streamlit"
+
+    def wrap_resource(self, func, hash_funcs=None, max_entries=None):
+        import streamlit as st
+        return st.cache_resource(func, hash_funcs=hash_funcs, max_entries=max_entries)
+
+
+_BACKENDS = {
+    "none": NoCache,
+    "memory": MemoryCache,
+    "disk": DiskCache,
+    "streamlit": StreamlitCache,
+}
+_backend = None
+_backend_lock = threading.Lock()
+_result_store = None
+_result_store_configured = False
+_result_store_lock = threading.Lock()
+_memory_store = None
+_memory_store_lock = threading.Lock()
+
+
+def set_result_store(store):
+    """
+    Enables the persistent result store, given a ResultStore or a path to its SQLite file (None disables it).
+    Data results are looked up there before being computed, underneath whichever backend is active.
+    """
+    global _result_store, _result_store_configured
+    if isinstance(store, str):
+        from result_store import DEFAULT_MAX_BYTES, ResultStore
+        max_bytes = int(os.environ.get(RESULT_DB_MAX_BYTES_ENV_VAR, DEFAULT_MAX_BYTES))
+        store = ResultStore(store, max_bytes=max_bytes)
+    with _result_store_lock:
+        _result_store = store
+        _result_store_configured = True
+
+
+def get_result_store():
+    """Returns the persistent result store, configured from DETECTOR_RESULT_DB on first use, or None."""
+    if not _result_store_configured:
+        path = os.environ.get(RESULT_DB_ENV_VAR)
+        set_result_store(path if path else None)
+    return _result_store
+
+
+def cache_stats():
+    """
+    Returns:
+        - Hit/miss/eviction statistics of the persistent result store, or None if it is disabled.
+    """
+    store = get_result_store()
+    return store.stats() if store is not None else None
+
+
+def get_memory_store():
+    """Returns the process-wide in-process result store, sized from DETECTOR_CACHE_MAX_MB / DETECTOR_CACHE_TTL on first use."""
+    global _memory_store
+    with _memory_store_lock:
+        if _memory_store is None:
+            max_mb = float(os.environ.get(MEMORY_MAX_MB_ENV_VAR, DEFAULT_MEMORY_MAX_MB))
+            ttl = float(os.environ.get(TTL_ENV_VAR, 0))
+            _memory_store = MemoryStore(int(max_mb * 2**20), ttl=ttl)
+        return _memory_store
+
+
+def memory_cache_stats():
+    """
+    Returns:
+        - Size, budget, hit/miss and eviction statistics of the in-process result store (see MemoryStore.stats).
+    """
+    return get_memory_store().stats()
+
+
+def _persistent(func, hash_funcs=None, model=None, version: int = 1):
+    """Wraps `func` so results are read from / written to the persistent result store when one is enabled."""
+    metric = f"{func.__module__}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        store = get_result_store()
+        if store is None:
+            return func(*args, **kwargs)
+        # Content hash (via hash_funcs) + metric + model + result version + every parameter such as stride
+        key = make_key(func, args, kwargs, hash_funcs, extra=(model, version))
+        hit, value = store.get(key)
+        if hit:
+            return value
+        value = func(*args, **kwargs)
+        store.put(key, value, metric=metric, model=model or "")
+        return value
+
+    return wrapper
+
+
+def set_backend(backend):
+    """
+    Selects the cache backend, by name ("streamlit", "memory", "disk", "none") or as an instance.
+    Call this before the first analysis runs; functions already wrapped by a previous backend are re-wrapped.
+    """
+    global _backend
+    with _backend_lock:
+        if isinstance(backend, str):
+            # Streamlit reruns the app script on every interaction; keep the existing backend
+            if _backend is not None and _backend.name == backend:
+                return
+            backend = _BACKENDS[backend]()
+        _backend = backend
+
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = _BACKENDS[os.environ.get(CACHE_ENV_VAR, "memory")]()
+        return _backend
+
+
+# Set by the innermost wrapper when a cached function's body actually runs, i.e. on a cache miss
+_calls = threading.local()
+
+
+def _compacted(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return compact(func(*args, **kwargs))
+
+    return wrapper
+
+
+def _mark_executed(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _calls.executed = True
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def _cached(kind: str, func=None, *, hash_funcs: dict = None, max_entries: int = None, model: str = None,
+            version: int = 1, persist: bool = True):
+    def decorator(func):
+        name = f"{func.__module__}.{func.__qualname__}"
+        # Data results are compacted once, so memory, the result store and the caller all see the same values
+        body = _mark_executed(_compacted(func) if kind == "data" else func)
+        # Only data results are persisted; resources (models) cannot be pickled meaningfully
+        target = _persistent(body, hash_funcs, model, version) if kind == "data" and persist else body
+        # The backend is resolved on first call, so the app can pick Streamlit after import
+        wrapped = {}
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            backend = get_backend()
+            inner = wrapped.get(backend)
+            if inner is None:
+                wrap = backend.wrap_data if kind == "data" else backend.wrap_resource
+                inner = wrapped[backend] = wrap(target, hash_funcs=hash_funcs, max_entries=max_entries)
+            if not profiling.enabled():
+                return inner(*args, **kwargs)
+            # Works for every backend (including st.cache_data): a hit never reaches the function body
+            previous = getattr(_calls, "executed", False)
+            _calls.executed = False
+            try:
+                result = inner(*args, **kwargs)
+                profiling.count_cache(name, hit=not _calls.executed)
+                return result
+            finally:
+                _calls.executed = previous
+
+        def clear():
+            for inner in wrapped.values():
+                if hasattr(inner, "clear"):
+                    inner.clear()
+
+        wrapper.clear = clear
+        return wrapper
+
+    return decorator(func) if func is not None else decorator
+
+
+def cache_data(func=None, *, hash_funcs: dict = None, max_entries: int = None, model: str = None,
+               version: int = 1, persist: bool = True):
+    """
+    Caches a function's return value; the counterpart of st.cache_data.
+    `model` names the model (and version) the result depends on, so persisted results are not reused across models.
+    Bump `version` whenever the shape of the result changes, so results persisted by an earlier build are not served.
+    With `persist=False` results are only kept in the in-process store, never in the persistent result store.
+    """
+    return _cached("data", func, hash_funcs=hash_funcs, max_entries=max_entries, model=model, version=version,
+                   persist=persist)
+
+
+def cache_resource(func=None, *, hash_funcs: dict = None, max_entries: int = None):
+    """Caches a shared object such as a model; the counterpart of st.cache_resource."""
+    return _cached("resource", func, hash_funcs=hash_funcs, max_entries=max_entries)
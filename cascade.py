@@ -0,0 +1,224 @@
+# Cascade scoring for high-volume screening: the cheap NLTK metrics first, GPT-2 and MiniLM only when needed.
+#
+# Burstiness, TTR and the Zipf exponent cost milliseconds; perplexity and semantic drift cost seconds.
+# In cascade mode a text is first scored on the cheap metrics alone (analysis.calculate_partial_score).
+# If that partial score falls outside the uncertainty band (default 30-70, DETECTOR_CASCADE_BAND) it
+# is returned as the result; inside the band the text is escalated to the full pipeline.
+#
+# Usage (calibration): scores a corpus both ways and reports, for each band,
+# how many texts would be escalated and how often the cascade agrees with the full pipeline:
+#   python cascade.py corpus.jsonl --limit 500
+#   python cascade.py texts/ --bands 40-60,30-70,20-80
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import analysis
+from document import parse_document
+
+BAND_ENV_VAR = "DETECTOR_CASCADE_BAND"
+DEFAULT_BAND = (30.0, 70.0)
+# Scores at or above this are labelled AI-generated when comparing the cascade with the full pipeline
+DECISION_THRESHOLD = 50.0
+
+
+_decisions = Counter()  # "escalated" / "early_stop" -> count, since the process started
+_decisions_lock = threading.Lock()
+
+
+def parse_band(value: str):
+    """Parses "30,70" or "30-70" into (30.0, 70.0)."""
+    low, high = (float(v) for v in value.replace("-", ",").split(","))
+    if not 0 <= low <= high <= 100:
+        raise ValueError(f"Uncertainty band must satisfy 0 <= low <= high <= 100, got {value!r}")
+    return low, high
+
+
+def selected_band():
+    value = os.environ.get(BAND_ENV_VAR)
+    return parse_band(value) if value else DEFAULT_BAND
+
+
+def needs_escalation(partial_score: float, band: tuple = None):
+    """True when the partial score is inside the uncertainty band, i.e. too close to call."""
+    low, high = band or selected_band()
+    return bool(low <= partial_score <= high)
+
+
+def record_decision(escalated: bool):
+    with _decisions_lock:
+        _decisions["escalated" if escalated else "early_stop"] += 1
+
+
+def escalation_stats():
+    """
+    Returns:
+        - A dictionary with the number of cascade decisions in this process and the fraction escalated.
+    """
+    with _decisions_lock:
+        total = _decisions["escalated"] + _decisions["early_stop"]
+        return {"decisions": total, "escalated": _decisions["escalated"],
+                "escalation_rate": _decisions["escalated"] / total if total else 0.0}
+
+
+def cheap_metrics(doc):
+    """
+    The NLTK-based metrics of a parsed document (no model calls).
+
+    Returns:
+        - metrics (dict): burstiness, ttr and (when it can be fitted) zipf_exponent.
+        - details (dict): sent_lengths, pos_dist and zipf_data, for callers that also report them.
+    """
+    # Bypass the Streamlit caches, as score_corpus does: a corpus run would otherwise keep every document in memory
+    burstiness, sent_lengths = analysis.calculate_burstiness.__wrapped__(doc)
+    ttr, pos_dist = analysis.calculate_stylometry.__wrapped__(doc)
+    zipf_data = analysis.calculate_zipf.__wrapped__(doc)
+    metrics = {"burstiness": burstiness, "ttr": ttr}
+    if zipf_data and zipf_data["exponent"] is not None:
+        metrics["zipf_exponent"] = zipf_data["exponent"]
+    return metrics, {"sent_lengths": sent_lengths, "pos_dist": pos_dist, "zipf_data": zipf_data}
+
+
+def expensive_metrics(docs: list, stride: int = 512, ppl_batch_size: int = 8):
+    """
+    Perplexity (windows of all documents share forward passes), semantic drift and, with a reference
+    index configured, the reference corpus matches.
+
+    Returns:
+        - A list of dictionaries with avg_perplexity and, for documents with 2+ sentences, avg_drift
+          and semantic_variance (and reference_coverage / reference_ai_fraction with a reference
+          index); in the same order as `docs`.
+    """
+    if not docs:
+        return []
+    perplexities = analysis.calculate_perplexity_batch(docs, stride=stride, batch_size=ppl_batch_size)
+    results = []
+    for doc, (avg_ppl, _) in zip(docs, perplexities):
+        metrics = {"avg_perplexity": avg_ppl}
+        if len(doc.sentences) >= 2:
+            # Only the drift statistics are scored, so the 2D projection is never computed
+            drift = analysis.drift_summary(analysis.encode_sentences(list(doc.sentences)))
+            metrics["avg_drift"] = drift["avg_drift"]
+            metrics["semantic_variance"] = drift["variance"]
+        reference = analysis.calculate_reference_matches(doc)
+        if reference is not None:
+            metrics["reference_coverage"] = reference["coverage"]
+            metrics["reference_ai_fraction"] = reference["ai_fraction"]
+        results.append(metrics)
+    return results
+
+
+def cascade_score_batch(docs: list, band: tuple = None, stride: int = 512, ppl_batch_size: int = 8):
+    """
+    Scores parsed documents in cascade mode; only documents whose partial score is inside `band` run
+    through GPT-2 and MiniLM (together, as one perplexity batch).
+
+    Returns:
+        - A list of dictionaries, one per document: score (final score if escalated, else the partial
+          score), partial_score, escalated (bool), metrics (every metric computed) and details
+          (see cheap_metrics).
+    """
+    band = band or selected_band()
+    results = []
+    for doc in docs:
+        metrics, details = cheap_metrics(doc)
+        partial = analysis.calculate_partial_score(metrics)
+        escalate = needs_escalation(partial, band)
+        if band != (0, 100):
+            record_decision(escalate)
+        results.append({
+            "score": partial, "partial_score": partial, "escalated": escalate,
+            "metrics": metrics, "details": details,
+        })
+
+    escalated = [i for i, result in enumerate(results) if result["escalated"]]
+    for i, extra in zip(escalated, expensive_metrics([docs[i] for i in escalated], stride, ppl_batch_size)):
+        results[i]["metrics"].update(extra)
+        results[i]["score"] = analysis.calculate_final_score(results[i]["metrics"])
+    return results
+
+
+# --- Calibration report ---
+def evaluate(partial_scores: list, full_scores: list, band: tuple, threshold: float = DECISION_THRESHOLD):
+    """
+    How the cascade with `band` would have done on texts whose partial and full scores are known.
+
+    Returns:
+        - A dictionary with the escalation rate, the AI/human label agreement with the full pipeline
+          (overall and on the texts that stopped early) and the mean absolute score difference.
+    """
+    n = len(partial_scores)
+    escalated = early = agree = early_agree = 0
+    abs_diff = 0.0
+    for partial, full in zip(partial_scores, full_scores):
+        if needs_escalation(partial, band):
+            # An escalated text gets the full pipeline's score, so it agrees by construction
+            escalated += 1
+            agree += 1
+            continue
+        early += 1
+        same = (partial >= threshold) == (full >= threshold)
+        agree += same
+        early_agree += same
+        abs_diff += abs(partial - full)
+    return {
+        "band": band,
+        "texts": n,
+        "escalation_rate": escalated / n if n else 0.0,
+        "agreement": agree / n if n else 1.0,
+        "early_stop_agreement": early_agree / early if early else 1.0,
+        "mean_abs_diff": abs_diff / n if n else 0.0,
+    }
+
+
+def main(argv=None):
+    from score_corpus import open_reader
+
+    parser = argparse.ArgumentParser(description="Compare cascade scoring with the full pipeline on a corpus.")
+    parser.add_argument("input", help="A .jsonl, .json (array), .csv or .parquet file, or a directory of .txt files")
+    parser.add_argument("--bands", default="40-60,30-70,20-80,10-90",
+                        help="Comma-separated uncertainty bands to evaluate, e.g. 40-60,30-70")
+    parser.add_argument("--threshold", type=float, default=DECISION_THRESHOLD, help="Score that counts as AI")
+    parser.add_argument("--limit", type=int, default=None, help="Only use the first N texts")
+    parser.add_argument("--text-field", default="text")
+    parser.add_argument("--id-field", default="id")
+    args = parser.parse_args(argv)
+    bands = [parse_band(b) for b in args.bands.split(",")]
+
+    analysis.download_nltk_data()
+    partial_scores, full_scores = [], []
+    cheap_time = expensive_time = 0.0
+    for i, record in enumerate(open_reader(args.input, args.text_field, args.id_field)):
+        if args.limit is not None and i >= args.limit:
+            break
+        start = time.perf_counter()
+        doc = parse_document(record["text"])
+        metrics, _ = cheap_metrics(doc)
+        partial_scores.append(analysis.calculate_partial_score(metrics))
+        mid = time.perf_counter()
+        metrics.update(expensive_metrics([doc])[0])
+        full_scores.append(analysis.calculate_final_score(metrics))
+        cheap_time += mid - start
+        expensive_time += time.perf_counter() - mid
+
+    n = len(full_scores)
+    if not n:
+        print("No texts found", file=sys.stderr)
+        return 1
+    print(f"{n} texts; cheap metrics {cheap_time / n * 1000:.1f} ms/text, perplexity + drift "
+          f"{expensive_time / n * 1000:.1f} ms/text\n")
+    print(f"{'band':>9}  {'escalated':>9}  {'agreement':>9}  {'early-stop agr.':>15}  {'mean |diff|':>11}  {'est. time':>9}")
+    for band in bands:
+        report = evaluate(partial_scores, full_scores, band, args.threshold)
+        # Every text pays for the cheap metrics, only escalated texts for the models
+        est_time = (cheap_time + expensive_time * report["escalation_rate"]) / (cheap_time + expensive_time)
+        print(f"{band[0]:>4g}-{band[1]:<4g}  {report['escalation_rate']:>9.1%}  {report['agreement']:>9.1%}  "
+              f"{report['early_stop_agreement']:>15.1%}  {report['mean_abs_diff']:>11.2f}  {est_time:>9.1%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+# This file contains the shared parsed-document structure used by every metric.
+import hashlib
+from dataclasses import dataclass
+
+import nltk
+
+import profiling
+import tagging
+
+
+@dataclass(frozen=True)
+class Document:
+    """
+    A text that has been sentence-split, tokenized and POS-tagged exactly once.
+
+    Attributes:
+        - text (str): The original input text.
+        - content_hash (str): A hex digest of the text, used as the cache key for every metric.
+        - sentences (tuple): The sentences produced by the sentence tokenizer.
+        - sentence_spans (tuple): (start, end) character offsets of each sentence in `text`.
+        - sentence_tokens (tuple): The word tokens of each sentence.
+        - tokens (tuple): All word tokens of the text, in order.
+        - lower_tokens (tuple): `tokens` lowercased.
+        - pos_tags (tuple): The POS tag of each token in `lower_tokens`.
+        - sentence_pos_tags (tuple): `pos_tags` grouped by sentence.
+    """
+    text: str
+    content_hash: str
+    sentences: tuple
+    sentence_spans: tuple
+    sentence_tokens: tuple
+    tokens: tuple
+    lower_tokens: tuple
+    pos_tags: tuple
+    sentence_pos_tags: tuple
+
+    @property
+    def sentence_lengths(self):
+        """Number of word tokens in each sentence."""
+        return [len(toks) for toks in self.sentence_tokens]
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+def hash_text(text: str) -> str:
+    """Returns the content hash used to identify a text."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def sentence_spans(text: str, sentences: list):
+    """
+    Locates each sentence in the original text.
+    The punkt tokenizer returns slices of the input, so a forward search is exact.
+    """
+    spans = []
+    pos = 0
+    for sent in sentences:
+        start = text.find(sent, pos)
+        if start == -1:
+            # Should not happen with punkt, but never fail the whole analysis over offsets
+            start = pos
+        end = start + len(sent)
+        spans.append((start, end))
+        pos = end
+    return spans
+
+
+def parse_document(text: str, previous: "Document" = None) -> Document:
+    """
+    Parses a text into a Document.
+    Sentence splitting, word tokenization and POS tagging each run once over the text.
+
+    Tagging is done per sentence, so a sentence's tokens and tags depend only on the sentence itself.
+    With `previous` (an earlier version of the same text), sentences that appear unchanged in it
+    reuse its tokens and tags, and only new or edited sentences are tokenized and tagged.
+
+    Note: `nltk.word_tokenize(text)` is itself sentence splitting followed by per-sentence
+    tokenization, so concatenating the per-sentence tokens gives the same token stream.
+    """
+    with profiling.stage("parse.sentences"):
+        sentences = nltk.sent_tokenize(text)
+
+    known = {}
+    if previous is not None:
+        known = {
+            sent: (toks, tags)
+            for sent, toks, tags in zip(previous.sentences, previous.sentence_tokens, previous.sentence_pos_tags)
+        }
+
+    sentence_tokens = [None] * len(sentences)
+    sentence_pos_tags = [None] * len(sentences)
+    new_idx = []
+    with profiling.stage("parse.tokenize"):
+        for i, sent in enumerate(sentences):
+            if sent in known:
+                sentence_tokens[i], sentence_pos_tags[i] = known[sent]
+            else:
+                sentence_tokens[i] = tuple(nltk.word_tokenize(sent, preserve_line=True))
+                new_idx.append(i)
+
+    # Tag only the sentences we have not seen, in one batched call
+    with profiling.stage("parse.pos_tag"):
+        to_tag = [[tok.lower() for tok in sentence_tokens[i]] for i in new_idx]
+        for i, tags in zip(new_idx, tagging.tag_sentences(to_tag) if to_tag else []):
+            sentence_pos_tags[i] = tags
+
+    tokens = tuple(tok for toks in sentence_tokens for tok in toks)
+    lower_tokens = tuple(tok.lower() for tok in tokens)
+    pos_tags = tuple(tag for tags in sentence_pos_tags for tag in tags)
+
+    return Document(
+        text=text,
+        content_hash=hash_text(text),
+        sentences=tuple(sentences),
+        sentence_spans=tuple(sentence_spans(text, sentences)),
+        sentence_tokens=tuple(sentence_tokens),
+        tokens=tokens,
+        lower_tokens=lower_tokens,
+        pos_tags=pos_tags,
+        sentence_pos_tags=tuple(sentence_pos_tags),
+    )
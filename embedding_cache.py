@@ -0,0 +1,164 @@
+# This file contains the sentence-level embedding cache used by analysis.calculate_semantic_drift.
+# Boilerplate sentences (disclaimers, signatures, template intros) repeat across documents, so
+# embeddings are cached per sentence rather than per document.
+import atexit
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_MAX_ENTRIES = 100_000
+# Persist to disk after this many new embeddings (and once more at exit)
+SAVE_EVERY = 1_000
+
+
+def sentence_key(sentence: str) -> int:
+    """A 64-bit hash of a sentence, used as its cache key."""
+    return int.from_bytes(hashlib.blake2b(sentence.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class SentenceEmbeddingCache:
+    """
+    A bounded LRU cache of sentence embeddings.
+
+    Embeddings live in one float32 matrix that grows (by doubling) up to max_entries rows; the LRU index
+    only maps 64-bit sentence hashes to row numbers, so per-entry overhead is a few dozen bytes.
+    With `path` set the cache is loaded from and saved to a .npz file.
+    """
+
+    def __init__(self, model_name: str, max_entries: int = DEFAULT_MAX_ENTRIES, path: str = None):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.path = path
+        self._matrix = None
+        self._index = OrderedDict()  # sentence key -> row in _matrix, least recently used first
+        self._free_rows = []
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self._load()
+            atexit.register(self.save)
+
+    def __len__(self):
+        return len(self._index)
+
+    def _allocate(self, dim: int, capacity: int = 1024):
+        rows = min(max(capacity, 1), self.max_entries)
+        self._matrix = np.zeros((rows, dim), dtype=np.float32)
+        self._free_rows = list(range(rows - 1, -1, -1))
+
+    def _grow(self):
+        old_rows = self._matrix.shape[0]
+        new_rows = min(old_rows * 2, self.max_entries)
+        matrix = np.zeros((new_rows, self._matrix.shape[1]), dtype=np.float32)
+        matrix[:old_rows] = self._matrix
+        self._matrix = matrix
+        self._free_rows = list(range(new_rows - 1, old_rows - 1, -1))
+
+    def _store(self, key: int, vector):
+        # max_entries <= 0 disables the cache (e.g. DETECTOR_EMBEDDING_CACHE_SIZE=0)
+        if self.max_entries <= 0:
+            return
+        if key in self._index:
+            self._index.move_to_end(key)
+            return
+        if not self._free_rows and self._matrix.shape[0] < self.max_entries:
+            self._grow()
+        if self._free_rows:
+            row = self._free_rows.pop()
+        else:
+            # Reuse the row of the least recently used sentence
+            _, row = self._index.popitem(last=False)
+        self._matrix[row] = vector
+        self._index[key] = row
+
+    def encode(self, model, sentences: list, batch_size: int = 64):
+        """
+        Returns embeddings for `sentences`, encoding only sentences not seen before, in one batch.
+
+        Returns:
+            - A float32 array of shape (len(sentences), dim).
+        """
+        keys = [sentence_key(s) for s in sentences]
+
+        with self._lock:
+            vectors = {}
+            missing = {}
+            for key, sentence in zip(keys, sentences):
+                if key in vectors or key in missing:
+                    continue
+                row = self._index.get(key)
+                if row is None:
+                    missing[key] = sentence
+                else:
+                    self._index.move_to_end(key)
+                    vectors[key] = self._matrix[row].copy()
+            self.misses += len(missing)
+            self.hits += len(keys) - len(missing)
+
+        if missing:
+            encoded = model.encode(list(missing.values()), batch_size=batch_size, convert_to_numpy=True)
+            encoded = np.asarray(encoded, dtype=np.float32)
+            new_vectors = dict(zip(missing.keys(), encoded))
+            vectors.update(new_vectors)
+
+            with self._lock:
+                if self._matrix is None:
+                    self._allocate(encoded.shape[1])
+                for key, vector in new_vectors.items():
+                    self._store(key, vector)
+                self._unsaved += len(new_vectors)
+                should_save = self.path and self._unsaved >= SAVE_EVERY
+            if should_save:
+                self.save()
+
+        if not keys:
+            return np.zeros((0, self._matrix.shape[1] if self._matrix is not None else 0), dtype=np.float32)
+        return np.stack([vectors[key] for key in keys])
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._index),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "bytes": self._matrix.nbytes if self._matrix is not None else 0,
+            }
+
+    def save(self):
+        """Writes the cached embeddings (in LRU order) to `path`, atomically."""
+        if not self.path:
+            return
+        with self._lock:
+            if self._matrix is None or not self._unsaved:
+                return
+            keys = np.fromiter(self._index.keys(), dtype=np.uint64, count=len(self._index))
+            rows = np.fromiter(self._index.values(), dtype=np.int64, count=len(self._index))
+            vectors = self._matrix[rows]
+            self._unsaved = 0
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, keys=keys, vectors=vectors, model_name=np.array(self.model_name))
+        os.replace(tmp_path, self.path)
+
+    def _load(self):
+        try:
+            with np.load(self.path) as data:
+                if str(data["model_name"]) != self.model_name:
+                    return
+                keys, vectors = data["keys"], data["vectors"]
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            return
+        if not len(keys) or self.max_entries <= 0:
+            return
+        self._allocate(vectors.shape[1], capacity=len(keys))
+        # Keep the most recently used entries if the file holds more than max_entries
+        for key, vector in zip(keys[-self.max_entries:], vectors[-self.max_entries:]):
+            self._store(int(key), vector)
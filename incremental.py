@@ -0,0 +1,188 @@
+# This file contains the incremental re-analysis used when a user edits a text and analyses it again.
+# An IncrementalAnalyzer remembers the previous version of one session's text. On the next run:
+#   - sentences that did not change reuse their tokens and POS tags (document.parse_document(previous=...)),
+#   - TTR, POS and Zipf counts are updated by removing the old sentences and adding the new ones,
+#   - perplexity keeps the previous window layout around the edit, so only windows overlapping it
+#     are run through GPT-2 (the rest come from analysis.load_window_cache()),
+#   - embeddings of unchanged sentences come from the sentence embedding cache as usual.
+# The previous Document is kept in the result cache's in-process store, so it counts against
+# DETECTOR_CACHE_MAX_MB; if it has been evicted, the next text is parsed from scratch.
+import difflib
+import itertools
+import threading
+from collections import Counter
+
+import numpy as np
+
+import analysis
+import caching
+import perplexity
+import profiling
+import tagging
+from document import Document, parse_document
+
+# Distinguishes the store entries of different analyzers (ids of collected objects are reused)
+_analyzer_ids = itertools.count()
+
+
+class IncrementalAnalyzer:
+    """
+    Keeps the last analysis of one text and updates it from the difference to the next version.
+
+    The document side (update_document, burstiness, stylometry, zipf) and the perplexity side
+    have separate state and locks, so perplexity can run while the text is being parsed.
+    """
+
+    def __init__(self, stride: int = perplexity.DEFAULT_STRIDE, batch_size: int = perplexity.DEFAULT_BATCH_SIZE):
+        self.stride = stride
+        self.batch_size = batch_size
+        self._doc_lock = threading.Lock()
+        self._ppl_lock = threading.Lock()
+        self._doc_key = f"{__name__}.IncrementalAnalyzer:{next(_analyzer_ids)}"
+        self._type_counts = Counter()  # lowercased token -> count, for TTR
+        self._pos_counts = Counter()  # POS category -> count
+        self._zipf_counts = Counter()  # Zipf word -> count
+        self._sentence_lengths = []  # of the current Document, for burstiness
+        self._text = None
+        self._token_ids = None
+        self._windows = None
+        self._ppl_result = None
+        # What the last update reused, e.g. {"sentences_reused": 40, "sentences_parsed": 2, ...}
+        self.last_update = {}
+
+    # --- Document side ---
+    @property
+    def doc(self):
+        """The current Document, or None before the first text or after it was evicted from the store."""
+        return caching.get_memory_store().get(self._doc_key)[1]
+
+    def _add(self, counts: Counter, items):
+        for item in items:
+            counts[item] += 1
+
+    def _remove(self, counts: Counter, items):
+        for item in items:
+            counts[item] -= 1
+            if not counts[item]:
+                del counts[item]
+
+    def _apply(self, doc: Document, indices, update):
+        stop_words = analysis.load_stopwords()
+        for i in indices:
+            lower = [tok.lower() for tok in doc.sentence_tokens[i]]
+            update(self._type_counts, lower)
+            update(self._pos_counts, map(tagging.category_of, doc.sentence_pos_tags[i]))
+            update(self._zipf_counts, analysis.zipf_tokens(lower, stop_words))
+
+    def update_document(self, text: str) -> Document:
+        """
+        Parses `text`, reusing everything that belongs to sentences of the previous version.
+
+        Returns:
+            - The Document for `text`.
+        """
+        with self._doc_lock:
+            previous = self.doc
+            if previous is not None and previous.text == text:
+                return previous
+
+            analysis.download_nltk_data()
+            # Parsed here rather than by analysis.load_document, so the store holds (and counts) it once
+            doc = parse_document(text, previous=previous)
+            if previous is None:
+                # The counts belong to the previous Document, so they are rebuilt along with it
+                for counts in (self._type_counts, self._pos_counts, self._zipf_counts):
+                    counts.clear()
+                self._apply(doc, range(len(doc.sentences)), self._add)
+                self.last_update.update(sentences_reused=0, sentences_parsed=len(doc.sentences))
+            else:
+                matcher = difflib.SequenceMatcher(None, previous.sentences, doc.sentences, autojunk=False)
+                parsed = 0
+                for op, i1, i2, j1, j2 in matcher.get_opcodes():
+                    if op == "equal":
+                        continue
+                    self._apply(previous, range(i1, i2), self._remove)
+                    self._apply(doc, range(j1, j2), self._add)
+                    parsed += j2 - j1
+                self.last_update.update(sentences_reused=len(doc.sentences) - parsed, sentences_parsed=parsed)
+
+            self._sentence_lengths = doc.sentence_lengths
+            caching.get_memory_store().put(self._doc_key, doc, "incremental.IncrementalAnalyzer.update_document")
+            return doc
+
+    @profiling.profiled("metric.burstiness")
+    def burstiness(self):
+        """Same result as analysis.calculate_burstiness for the current document."""
+        with self._doc_lock:
+            sent_lengths = list(self._sentence_lengths)
+        if not sent_lengths:
+            return 0, []
+        return analysis.burstiness_from_lengths(sent_lengths), sent_lengths
+
+    @profiling.profiled("metric.stylometry")
+    def stylometry(self):
+        """Same result as analysis.calculate_stylometry for the current document."""
+        with self._doc_lock:
+            # Every lowercased token is counted once in _type_counts
+            return analysis.stylometry_from_counts(len(self._type_counts), sum(self._type_counts.values()), self._pos_counts)
+
+    @profiling.profiled("metric.zipf")
+    def zipf(self):
+        """Same result as analysis.calculate_zipf for the current document."""
+        with self._doc_lock:
+            return analysis.zipf_from_counts(self._zipf_counts)
+
+    # --- Perplexity side ---
+    def perplexity(self, text: str):
+        """
+        Perplexity of `text`. The first text is scored with the standard window layout
+        (analysis.calculate_perplexity); after an edit the previous layout is kept outside the
+        edited span, so the values can differ slightly from scoring the edited text from scratch.
+
+        Returns:
+            - avg_ppl (float), ppl_scores (list): As analysis.calculate_perplexity.
+        """
+        result = self.surprisal(text)
+        return result["avg_ppl"], result["ppl_scores"]
+
+    def surprisal(self, text: str):
+        """
+        Perplexity of `text` with the NLL of every token, from the same window layout as perplexity().
+
+        Returns:
+            - A dictionary as analysis.calculate_token_surprisal.
+        """
+        with self._ppl_lock:
+            if text == self._text:
+                return self._ppl_result
+
+            model, tokenizer = analysis.load_perplexity_model()
+            encoded = tokenizer(text, return_offsets_mapping=True)
+            token_ids = encoded["input_ids"]
+            max_length = model.config.n_positions
+
+            if self._token_ids is None:
+                result = analysis.calculate_token_surprisal(text, stride=self.stride, batch_size=self.batch_size)
+                windows = perplexity.plan_windows(len(token_ids), max_length, self.stride)
+                self.last_update.update(windows_total=len(windows), windows_scored=len(windows))
+            else:
+                windows = perplexity.replan_windows(self._token_ids, token_ids, self._windows, max_length, self.stride)
+                cache = analysis.load_window_cache()
+                misses = cache.misses
+                pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+                nlls, token_nlls = perplexity.score_windows(
+                    model, [(token_ids[begin:end], trg_len) for begin, end, trg_len in windows],
+                    batch_size=self.batch_size, pad_token_id=pad_token_id, cache=cache, return_tokens=True,
+                )
+                avg_ppl, ppl_scores = perplexity.summarize_nlls(nlls)
+                result = {
+                    "avg_ppl": avg_ppl,
+                    "ppl_scores": ppl_scores,
+                    # replan_windows covers every token once, in order
+                    "token_nlls": perplexity.concat_token_nlls(token_nlls),
+                    "token_offsets": np.asarray(encoded["offset_mapping"], dtype=np.int32).reshape(-1, 2),
+                }
+                self.last_update.update(windows_total=len(windows), windows_scored=cache.misses - misses)
+
+            self._text, self._token_ids, self._windows, self._ppl_result = text, token_ids, windows, result
+            return result
@@ -0,0 +1,137 @@
+# This file contains the selectable CPU inference backends for the GPT-2 and MiniLM models.
+#
+#   fp32    - plain PyTorch (the original behaviour)
+#   int8    - dynamic int8 quantization of every Linear layer (incl. GPT-2's Conv1D projections)
+#   compile - torch.compile on the transformer body
+#   onnx    - ONNX Runtime via optimum (pip install "optimum[onnxruntime]")
+#
+# The backend is picked with DETECTOR_BACKEND and the intra-op thread count with DETECTOR_NUM_THREADS.
+# Use parity_check.py to see how far perplexity and drift move compared with fp32.
+import os
+
+BACKENDS = ("fp32", "int8", "compile", "onnx")
+BACKEND_ENV_VAR = "DETECTOR_BACKEND"
+NUM_THREADS_ENV_VAR = "DETECTOR_NUM_THREADS"
+
+
+def selected_backend():
+    backend = os.environ.get(BACKEND_ENV_VAR, "fp32").lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown {BACKEND_ENV_VAR}={backend!r}, expected one of {', '.join(BACKENDS)}")
+    return backend
+
+
+def selected_num_threads():
+    """The configured intra-op thread count, or None to keep torch's default."""
+    value = os.environ.get(NUM_THREADS_ENV_VAR)
+    return int(value) if value else None
+
+
+def configure_threads(num_threads: int = None):
+    """Sets torch's intra-op thread count (and a single inter-op thread, since we never run graphs in parallel)."""
+    import torch
+
+    if num_threads is None:
+        num_threads = selected_num_threads()
+    if num_threads is None:
+        return
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set before the first inter-op parallel work has started
+        pass
+
+
+def _conv1d_to_linear(module):
+    """
+    Replaces GPT-2's transformers Conv1D layers (x @ W + b) with equivalent nn.Linear layers,
+    so quantize_dynamic can quantize the attention and MLP projections.
+    """
+    import torch.nn as nn
+    from transformers.pytorch_utils import Conv1D
+
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            in_features, out_features = child.weight.shape
+            linear = nn.Linear(in_features, out_features)
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            _conv1d_to_linear(child)
+    return module
+
+
+def _quantize(module):
+    import torch
+    import torch.nn as nn
+
+    return torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8)
+
+
+def load_perplexity_model(model_name: str, backend: str = None, num_threads: int = None):
+    """
+    Loads the causal LM and its tokenizer with the requested backend.
+
+    Returns:
+        - (model, tokenizer). For "onnx" the model is an optimum ORTModelForCausalLM, which perplexity.py
+          drives through its generic logits path.
+    """
+    from transformers import GPT2LMHeadModel, GPT2TokenizerFast
+
+    backend = backend or selected_backend()
+    configure_threads(num_threads)
+    tokenizer = GPT2TokenizerFast.from_pretrained(model_name)
+
+    if backend == "onnx":
+        try:
+            from optimum.onnxruntime import ORTModelForCausalLM
+        except ImportError as e:
+            raise ImportError('The onnx backend needs optimum: pip install "optimum[onnxruntime]"') from e
+        model = ORTModelForCausalLM.from_pretrained(
+            model_name, export=True, use_cache=False, session_options=_ort_session_options(num_threads)
+        )
+        return model, tokenizer
+
+    model = GPT2LMHeadModel.from_pretrained(model_name).eval()
+    if backend == "int8":
+        model = _quantize(_conv1d_to_linear(model))
+    elif backend == "compile":
+        import torch
+        # perplexity.py calls the transformer body and the LM head separately; the body is the expensive part
+        model.transformer = torch.compile(model.transformer, dynamic=True)
+    return model, tokenizer
+
+
+def load_embedding_model(model_name: str, backend: str = None, num_threads: int = None):
+    """Loads the sentence-transformer model with the requested backend."""
+    from sentence_transformers import SentenceTransformer
+
+    backend = backend or selected_backend()
+    configure_threads(num_threads)
+
+    if backend == "onnx":
+        return SentenceTransformer(
+            model_name, backend="onnx", model_kwargs={"session_options": _ort_session_options(num_threads)}
+        )
+
+    model = SentenceTransformer(model_name, device="cpu")
+    if backend == "int8":
+        model = _quantize(model)
+    elif backend == "compile":
+        import torch
+        model[0].auto_model = torch.compile(model[0].auto_model, dynamic=True)
+    return model
+
+
+def _ort_session_options(num_threads: int = None):
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    num_threads = num_threads if num_threads is not None else selected_num_threads()
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return options
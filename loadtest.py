@@ -0,0 +1,138 @@
+# Load test for service.py: keeps a fixed number of requests in flight and reports latency and throughput.
+#
+# Usage:
+#   python service.py &
+#   python loadtest.py --concurrency 32 --requests 500
+#   python loadtest.py --endpoint /perplexity --duration 30 essay1.txt essay2.txt
+#
+# Each client reuses one keep-alive connection. Latency covers a request from sending it to reading
+# the whole response; only 200 responses count towards the percentiles, the rest are listed by status.
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import Counter
+
+import numpy as np
+
+
+async def _request(reader, writer, host: str, path: str, body: bytes):
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length, close = 0, False
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+        elif name.strip().lower() == "connection":
+            close = value.strip().lower() == "close"
+    await reader.readexactly(length)
+    return status, close
+
+
+async def _client(host: str, port: int, path: str, bodies: list, deadline: float, remaining: list,
+                  latencies: list, statuses: Counter, offset: int):
+    reader = writer = None
+    i = offset
+    while time.perf_counter() < deadline and remaining[0] > 0:
+        remaining[0] -= 1
+        if writer is None:
+            reader, writer = await asyncio.open_connection(host, port)
+        start = time.perf_counter()
+        try:
+            status, close = await _request(reader, writer, host, path, bodies[i % len(bodies)])
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+            statuses["connection error"] += 1
+            writer.close()
+            writer = None
+            continue
+        elapsed = time.perf_counter() - start
+        statuses[status] += 1
+        if status == 200:
+            latencies.append(elapsed)
+        if close:
+            writer.close()
+            writer = None
+        i += 1
+    if writer is not None:
+        writer.close()
+
+
+async def run_load(host: str, port: int, path: str, texts: list, concurrency: int,
+                   n_requests: int = None, duration: float = None):
+    """
+    Returns:
+        - A dictionary with the request count, status counts, requests per second and p50/p90/p99 latency (seconds).
+    """
+    bodies = [json.dumps({"text": text}).encode() for text in texts]
+    latencies, statuses = [], Counter()
+    remaining = [n_requests if n_requests is not None else float("inf")]
+    deadline = time.perf_counter() + duration if duration is not None else float("inf")
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        _client(host, port, path, bodies, deadline, remaining, latencies, statuses, i) for i in range(concurrency)
+    ))
+    elapsed = time.perf_counter() - start
+    completed = sum(statuses.values())
+    result = {
+        "requests": completed,
+        "ok": len(latencies),
+        "statuses": {str(k): v for k, v in statuses.items()},
+        "seconds": elapsed,
+        "rps": completed / elapsed if elapsed else 0.0,
+        "ok_rps": len(latencies) / elapsed if elapsed else 0.0,
+    }
+    if latencies:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        result.update(p50=float(p50), p90=float(p90), p99=float(p99), max=max(latencies))
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure p50/p99 latency and requests per second of service.py.")
+    parser.add_argument("texts", nargs="*", help="Text files to send (defaults to built-in samples)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--endpoint", default="/score", help="e.g. /score, /perplexity, /semantic_drift")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests kept in flight")
+    parser.add_argument("--requests", type=int, default=None, help="Total requests (default 200 unless --duration)")
+    parser.add_argument("--duration", type=float, default=None, help="Run for this many seconds instead")
+    parser.add_argument("--json", action="store_true", help="Print the result as JSON")
+    args = parser.parse_args(argv)
+
+    if args.texts:
+        texts = []
+        for path in args.texts:
+            with open(path, encoding="utf-8") as f:
+                texts.append(f.read())
+    else:
+        from parity_check import SAMPLE_TEXTS
+        texts = SAMPLE_TEXTS
+    n_requests = args.requests if args.requests is not None or args.duration is not None else 200
+
+    result = asyncio.run(run_load(args.host, args.port, args.endpoint, texts, args.concurrency,
+                                  n_requests, args.duration))
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return 0
+
+    print(f"{result['requests']:,} requests to {args.endpoint} in {result['seconds']:.2f}s "
+          f"with {args.concurrency} in flight")
+    print(f"  throughput: {result['rps']:.1f} req/s ({result['ok_rps']:.1f} ok/s)")
+    print(f"  statuses:   {', '.join(f'{k}: {v}' for k, v in sorted(result['statuses'].items()))}")
+    if result["ok"]:
+        print(f"  latency:    p50 {result['p50'] * 1000:.1f} ms, p90 {result['p90'] * 1000:.1f} ms, "
+              f"p99 {result['p99'] * 1000:.1f} ms, max {result['max'] * 1000:.1f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+# Multi-process corpus scoring: worker processes forked after the models are loaded, so every worker
+# shares the parent's single copy of the distilgpt2 and MiniLM weights.
+#
+# One Python process only gets as many cores as torch's intra-op threads and the GIL-bound NLTK
+# parse give it. ScoringPool loads the NLTK data, the tagger and both models once in the parent,
+# freezes the heap (gc.freeze, so the collector does not touch and copy the shared pages) and then
+# forks the workers. The weights are never written after the fork, so their pages stay shared
+# copy-on-write. Each worker gets its share of the thread budget (total threads / workers) for
+# torch and ONNX Runtime, and the parent only reads the input and writes the results.
+#
+# Used by score_corpus.py --workers N. Needs the "fork" start method (Linux; macOS with care).
+# ONNX Runtime sessions do not survive a fork, so with DETECTOR_BACKEND=onnx every worker loads its own.
+# Neither do SQLite connections: the result store (DETECTOR_CACHE=disk, DETECTOR_RESULT_DB) keeps none
+# open in the parent while preloading, and every worker opens its own (see result_store.ResultStore).
+import gc
+import multiprocessing
+import os
+from collections import deque
+
+import analysis
+import inference_backends
+from document import parse_document
+
+# Batches queued per worker; bounds how much of the corpus is in memory at once
+QUEUE_DEPTH = 2
+
+
+def thread_budget(workers: int, total_threads: int = None):
+    """
+    Returns:
+        - The intra-op threads each of `workers` processes gets from `total_threads` (default: all cores), at least 1.
+    """
+    total_threads = total_threads or os.cpu_count() or 1
+    return max(1, total_threads // workers)
+
+
+def preload(threads_per_worker: int):
+    """Loads everything the workers need before they are forked, without running any inference."""
+    # Thread settings are inherited by the workers; ONNX Runtime reads them when its sessions are created
+    os.environ[inference_backends.NUM_THREADS_ENV_VAR] = str(threads_per_worker)
+    # Rust tokenizers refuse to use their thread pool in a forked child; use it nowhere instead
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    missing = analysis.download_nltk_data()
+    if missing:
+        raise RuntimeError(f"NLTK resources unavailable: {', '.join(missing)}")
+    analysis.load_stopwords()
+    # Punkt and the perceptron tagger load their weights on first use
+    parse_document("Load the tokenizer and the tagger. Then fork.")
+    if analysis.INFERENCE_BACKEND != "onnx":
+        analysis.load_perplexity_model()
+        analysis.load_embedding_model()
+
+
+def _init_worker(threads: int):
+    inference_backends.configure_threads(threads)
+
+
+class ScoringPool:
+    """
+    A pool of forked scoring processes. imap() runs a function over batches in the workers and
+    yields the results in input order, with at most QUEUE_DEPTH batches per worker in flight.
+
+    Use as a context manager; the workers are stopped on exit.
+    """
+
+    def __init__(self, workers: int, total_threads: int = None):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise RuntimeError("Parallel scoring needs the 'fork' start method, which this platform does not have")
+        self.workers = workers
+        self.threads_per_worker = thread_budget(workers, total_threads)
+        preload(self.threads_per_worker)
+        # Objects allocated so far are never collected, so the collector never writes to their pages
+        gc.freeze()
+        self._pool = multiprocessing.get_context("fork").Pool(
+            workers, initializer=_init_worker, initargs=(self.threads_per_worker,)
+        )
+
+    def imap(self, func, iterable, **kwargs):
+        """Yields func(item, **kwargs) for each item of `iterable`, in order."""
+        in_flight = deque()
+        for item in iterable:
+            in_flight.append(self._pool.apply_async(func, (item,), kwargs))
+            if len(in_flight) >= self.workers * QUEUE_DEPTH:
+                yield in_flight.popleft().get()
+        while in_flight:
+            yield in_flight.popleft().get()
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+        gc.unfreeze()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,101 @@
+# Compares an optimised inference backend against the fp32 baseline.
+#
+# Usage:
+#   python parity_check.py --backend int8
+#   python parity_check.py --backend onnx --threads 4 essay1.txt essay2.txt
+#
+# For each text it reports the average perplexity, the largest per-window perplexity change,
+# and the semantic drift under both backends, followed by the wall time of each backend.
+import argparse
+import time
+
+import nltk
+import numpy as np
+
+import inference_backends
+import perplexity
+from analysis import EMBEDDING_MODEL_NAME, PERPLEXITY_MODEL_NAME, adjacent_drifts, download_nltk_data
+
+SAMPLE_TEXTS = [
+    "The committee met on Tuesday to review the budget. After a long debate, members agreed to postpone "
+    "the vote until next month. Several residents voiced concerns about the proposed cuts to the library. "
+    "One speaker, a retired teacher, said the branch was the only quiet place her grandchildren could study.",
+    "Artificial intelligence has transformed numerous industries in recent years. It enables organizations "
+    "to automate repetitive tasks and derive insights from large datasets. Furthermore, it offers significant "
+    "potential for improving decision-making processes. However, it is important to consider the ethical "
+    "implications of its widespread adoption.",
+    "I missed the bus again. Rain, obviously. By the time I got to the office the coffee machine was broken "
+    "and someone had taken my chair, which, fine, it's a chair. But the whole day went like that.",
+]
+
+
+def run_backend(backend: str, texts: list, num_threads: int = None):
+    """
+    Returns:
+        - A list of per-text results and the wall time spent in inference.
+    """
+    ppl_model, tokenizer = inference_backends.load_perplexity_model(PERPLEXITY_MODEL_NAME, backend, num_threads)
+    embed_model = inference_backends.load_embedding_model(EMBEDDING_MODEL_NAME, backend, num_threads)
+
+    # One untimed pass so compilation / session start-up is not counted
+    perplexity.perplexity_for_texts(ppl_model, tokenizer, texts[:1])
+    embed_model.encode(nltk.sent_tokenize(texts[0]))
+
+    start = time.perf_counter()
+    ppl_results = perplexity.perplexity_for_texts(ppl_model, tokenizer, texts)
+    results = []
+    for text, (avg_ppl, ppl_scores) in zip(texts, ppl_results):
+        sentences = nltk.sent_tokenize(text)
+        drift = None
+        if len(sentences) > 1:
+            embeddings = np.asarray(embed_model.encode(sentences), dtype=np.float32)
+            drift = float(np.mean(adjacent_drifts(embeddings)))
+        results.append({"avg_ppl": avg_ppl, "ppl_scores": ppl_scores, "drift": drift})
+    return results, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure how far an inference backend moves the metrics vs fp32.")
+    parser.add_argument("texts", nargs="*", help="Text files to compare on (defaults to built-in samples)")
+    parser.add_argument("--backend", choices=[b for b in inference_backends.BACKENDS if b != "fp32"], required=True)
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads for both backends")
+    args = parser.parse_args(argv)
+
+    download_nltk_data()
+    texts = SAMPLE_TEXTS
+    if args.texts:
+        texts = []
+        for path in args.texts:
+            with open(path, encoding="utf-8") as f:
+                texts.append(f.read())
+
+    baseline, baseline_time = run_backend("fp32", texts, args.threads)
+    candidate, candidate_time = run_backend(args.backend, texts, args.threads)
+
+    print(f"{'text':>4}  {'ppl fp32':>10}  {'ppl ' + args.backend:>10}  {'rel diff':>8}  {'max window':>10}  "
+          f"{'drift fp32':>10}  {'drift ' + args.backend:>10}  {'abs diff':>8}")
+    rel_diffs = []
+    drift_diffs = []
+    for i, (base, cand) in enumerate(zip(baseline, candidate)):
+        rel = abs(cand["avg_ppl"] - base["avg_ppl"]) / base["avg_ppl"] if base["avg_ppl"] else 0.0
+        window_rel = max(
+            (abs(c - b) / b for b, c in zip(base["ppl_scores"], cand["ppl_scores"]) if b), default=0.0
+        )
+        rel_diffs.append(rel)
+        drift_cols = "{:>10}  {:>10}  {:>8}".format("-", "-", "-")
+        if base["drift"] is not None:
+            drift_diff = abs(cand["drift"] - base["drift"])
+            drift_diffs.append(drift_diff)
+            drift_cols = f"{base['drift']:>10.4f}  {cand['drift']:>10.4f}  {drift_diff:>8.4f}"
+        print(f"{i:>4}  {base['avg_ppl']:>10.2f}  {cand['avg_ppl']:>10.2f}  {rel:>8.2%}  {window_rel:>10.2%}  {drift_cols}")
+
+    print()
+    print(f"max perplexity rel diff: {max(rel_diffs):.2%}")
+    if drift_diffs:
+        print(f"max drift abs diff:      {max(drift_diffs):.4f}")
+    print(f"inference time fp32: {baseline_time:.2f}s, {args.backend}: {candidate_time:.2f}s "
+          f"({baseline_time / candidate_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
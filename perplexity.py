@@ -0,0 +1,397 @@
+# This file contains the batched sliding-window perplexity engine used by analysis.calculate_perplexity.
+# torch is imported inside the functions so that importing this module stays cheap.
+#
+# The forward pass already yields the NLL of every scored token; besides each window's mean it is kept
+# as a float32 array (one value per token), which gives per-sentence perplexity and the token heatmap
+# (see surprisal_for_texts and sentence_perplexities) without running the model again.
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+
+import profiling
+import scheduler
+
+DEFAULT_STRIDE = 512
+DEFAULT_BATCH_SIZE = 8
+# Number of target positions projected through the LM head at once (bounds the logits tensor size)
+LOGITS_CHUNK = 1024
+DEFAULT_WINDOW_CACHE_SIZE = 4096
+
+
+def window_key(ids: list, trg_len: int) -> bytes:
+    """Identifies a window by its token ids and scored length, so a window's NLL can be reused wherever it recurs."""
+    h = hashlib.blake2b(trg_len.to_bytes(4, "little"), digest_size=16)
+    h.update(array("l", ids).tobytes())
+    return h.digest()
+
+
+class WindowCache:
+    """
+    A bounded, thread-safe LRU map from window_key to the window's mean NLL and its token NLLs
+    (a float32 array of trg_len values, at most a few KB per window).
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_WINDOW_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: bytes):
+        """Returns (nll, token_nlls) for a window scored before, else None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: bytes, nll: float, token_nlls):
+        with self._lock:
+            self._entries[key] = (nll, token_nlls)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def plan_windows(seq_len: int, max_length: int, stride: int = DEFAULT_STRIDE):
+    """
+    Lays out the sliding windows over a token sequence, exactly as the original one-window-at-a-time loop did.
+
+    Returns:
+        - A list of (begin, end, trg_len) tuples. Only the last `trg_len` tokens of each window are scored,
+          the rest is context that was already scored by the previous window.
+    """
+    windows = []
+    prev_end_loc = 0
+    for begin_loc in range(0, seq_len, stride):
+        end_loc = min(begin_loc + max_length, seq_len)
+        trg_len = end_loc - prev_end_loc
+        windows.append((begin_loc, end_loc, trg_len))
+        prev_end_loc = end_loc
+        if end_loc == seq_len:
+            break
+    return windows
+
+
+def plan_targets(start: int, stop: int, max_length: int, stride: int = DEFAULT_STRIDE):
+    """
+    Lays out windows that score the tokens in [start, stop), `stride` targets at a time with the same
+    amount of left context as plan_windows. plan_targets(0, n, ...) gives the same layout as plan_windows(n, ...).
+
+    Returns:
+        - A list of (begin, end, trg_len) tuples.
+    """
+    windows = []
+    target = start
+    while target < stop:
+        if target == 0:
+            end = min(max_length, stop)
+            begin = 0
+        else:
+            end = min(target + stride, stop)
+            begin = max(0, target - (max_length - stride))
+        windows.append((begin, end, end - target))
+        target = end
+    return windows
+
+
+def _common_affixes(old_ids: list, new_ids: list):
+    """Lengths of the common prefix and (non-overlapping) common suffix of two token sequences."""
+    import numpy as np
+
+    old = np.asarray(old_ids, dtype=np.int64)
+    new = np.asarray(new_ids, dtype=np.int64)
+    n = min(len(old), len(new))
+    mismatch = np.flatnonzero(old[:n] != new[:n])
+    prefix = int(mismatch[0]) if len(mismatch) else n
+    rest = n - prefix
+    if not rest:
+        return prefix, 0
+    mismatch = np.flatnonzero(old[::-1][:rest] != new[::-1][:rest])
+    suffix = int(mismatch[0]) if len(mismatch) else rest
+    return prefix, suffix
+
+
+def replan_windows(old_ids: list, new_ids: list, old_windows: list, max_length: int,
+                   stride: int = DEFAULT_STRIDE):
+    """
+    Lays out windows for an edited token sequence so that as many windows as possible are
+    unchanged from `old_windows`: windows before the edit are kept, windows after it are shifted
+    by the change in length, and only the edited span gets new windows (see plan_targets).
+
+    Kept and shifted windows have the same token ids as before, so their NLLs come from the
+    WindowCache; a shifted window is only re-scored if its left context reaches into the edit.
+
+    Returns:
+        - A list of (begin, end, trg_len) tuples covering every token of `new_ids` exactly once.
+    """
+    prefix, suffix = _common_affixes(old_ids, new_ids)
+    if prefix == len(old_ids) == len(new_ids):
+        return list(old_windows)
+
+    delta = len(new_ids) - len(old_ids)
+    suffix_start = len(old_ids) - suffix
+
+    head = [w for w in old_windows if w[1] <= prefix]
+    tail = [
+        (max(0, begin + delta), end + delta, trg_len)
+        for begin, end, trg_len in old_windows
+        if end - trg_len >= suffix_start
+    ]
+    start = head[-1][1] if head else 0
+    stop = tail[0][1] - tail[0][2] if tail else len(new_ids)
+    return head + plan_targets(start, stop, max_length, stride) + tail
+
+
+def _target_logits(model, input_ids, attention_mask, positions):
+    """
+    Yields (logits, flat_positions) chunks for the scored positions only.
+    Running the LM head on scored positions avoids materialising a [batch, 1024, vocab] tensor.
+    """
+    if hasattr(model, "transformer") and hasattr(model, "lm_head"):
+        hidden = model.transformer(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+        hidden = hidden.reshape(-1, hidden.size(-1))
+        for start in range(0, positions.numel(), LOGITS_CHUNK):
+            idx = positions[start:start + LOGITS_CHUNK]
+            yield model.lm_head(hidden[idx]), idx
+    else:
+        # Generic causal LM (e.g. an exported/optimised backend): fall back to full logits
+        logits = model(input_ids=input_ids, attention_mask=attention_mask).logits
+        logits = logits.reshape(-1, logits.size(-1))
+        yield logits[positions], positions
+
+
+def score_windows(model, windows: list, batch_size: int = DEFAULT_BATCH_SIZE, pad_token_id: int = 0,
+                  cache: WindowCache = None, return_tokens: bool = False):
+    """
+    Computes the mean negative log-likelihood of each window, packing windows into padded batches.
+
+    Args:
+        - windows (list): (input_ids, trg_len) pairs; input_ids is a list of token ids.
+        - batch_size (int): Number of windows per forward pass.
+        - cache (WindowCache): If given, windows scored before are not run through the model again.
+        - return_tokens (bool): Also return the NLL of each scored token.
+
+    Returns:
+        - A list of NLL floats, in the same order as `windows`.
+        - With return_tokens, also a list of float32 arrays: the NLLs of each window's last trg_len
+          tokens (NaN for the first token of a sequence, which has nothing to be predicted from).
+    """
+    nlls = [float("nan")] * len(windows)
+    token_nlls = [None] * len(windows)
+    pending = range(len(windows))
+    keys = None
+    if cache is not None:
+        keys = [window_key(ids, trg_len) for ids, trg_len in windows]
+        pending = []
+        for i, key in enumerate(keys):
+            entry = cache.get(key)
+            if entry is None:
+                pending.append(i)
+            else:
+                nlls[i], token_nlls[i] = entry
+
+    # Sort by length so windows of similar size share a batch and padding stays small
+    order = sorted(pending, key=lambda i: len(windows[i][0]), reverse=True)
+
+    with profiling.stage("perplexity.windows"):
+        _score_batches(model, windows, order, nlls, token_nlls, batch_size, pad_token_id, cache, keys)
+    return (nlls, token_nlls) if return_tokens else nlls
+
+
+def _score_batches(model, windows, order, nlls, token_nlls, batch_size, pad_token_id, cache, keys):
+    """Runs the windows listed in `order` through the model and writes their NLLs into `nlls` and `token_nlls`."""
+    import numpy as np
+    import torch
+    import torch.nn.functional as F
+
+    for start in range(0, len(order), batch_size):
+        batch_idx = order[start:start + batch_size]
+        width = len(windows[batch_idx[0]][0])
+
+        input_ids = torch.full((len(batch_idx), width), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch_idx), width), dtype=torch.long)
+        labels = torch.full((len(batch_idx), width), -100, dtype=torch.long)
+        for row, i in enumerate(batch_idx):
+            ids, trg_len = windows[i]
+            n = len(ids)
+            input_ids[row, :n] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, :n] = 1
+            labels[row, n - trg_len:n] = input_ids[row, n - trg_len:n]
+
+        # Token t is predicted from position t - 1, same shift as GPT2LMHeadModel(labels=...)
+        shift_labels = labels[:, 1:]
+        rows, cols = (shift_labels != -100).nonzero(as_tuple=True)
+        positions = rows * width + cols
+        targets = shift_labels[rows, cols]
+
+        token_nll = torch.empty(targets.numel())
+        offset = 0
+        # In the app, concurrent sessions take turns on the model (see scheduler.py)
+        with scheduler.slot(), torch.no_grad():
+            for logits, _ in _target_logits(model, input_ids, attention_mask, positions):
+                n = logits.size(0)
+                token_nll[offset:offset + n] = F.cross_entropy(
+                    logits.float(), targets[offset:offset + n], reduction="none"
+                )
+                offset += n
+
+        sums = torch.zeros(len(batch_idx)).index_add_(0, rows, token_nll)
+        counts = torch.bincount(rows, minlength=len(batch_idx))
+        # nonzero() is row-major, so each window's token NLLs are one contiguous run
+        per_row = np.split(token_nll.numpy(), np.cumsum(counts.numpy())[:-1])
+        for row, i in enumerate(batch_idx):
+            nlls[i] = (sums[row] / counts[row]).item()
+            trg_len = windows[i][1]
+            # A window starting the sequence cannot score its first token
+            token_nlls[i] = np.concatenate((np.full(trg_len - len(per_row[row]), np.nan, dtype=np.float32),
+                                            per_row[row]))
+            if cache is not None:
+                cache.put(keys[i], nlls[i], token_nlls[i])
+
+
+def summarize_nlls(nlls: list):
+    """
+    Returns:
+        - avg_ppl (float): exp of the mean window NLL (0 for an empty text).
+        - ppl_scores (list): The perplexity of each window.
+    """
+    import torch
+
+    if not nlls:
+        return 0, []
+    nll_tensor = torch.tensor(nlls)
+    return torch.exp(nll_tensor.mean()).item(), torch.exp(nll_tensor).tolist()
+
+
+def concat_token_nlls(token_nlls: list):
+    """Joins per-window token NLL arrays (in window order) into one array with a value per token."""
+    import numpy as np
+
+    return np.concatenate(token_nlls) if token_nlls else np.empty(0, dtype=np.float32)
+
+
+def _score_documents(model, token_id_lists: list, stride: int, batch_size: int, pad_token_id: int,
+                     cache: WindowCache):
+    """
+    Scores the standard window layout of every document in one score_windows call.
+
+    Returns:
+        - A list of (window NLLs, window token NLL arrays) pairs, one per document.
+    """
+    max_length = model.config.n_positions
+    windows = []
+    owners = []
+    for doc_idx, ids in enumerate(token_id_lists):
+        for begin, end, trg_len in plan_windows(len(ids), max_length, stride):
+            windows.append((ids[begin:end], trg_len))
+            owners.append(doc_idx)
+
+    nlls, token_nlls = score_windows(model, windows, batch_size=batch_size, pad_token_id=pad_token_id,
+                                     cache=cache, return_tokens=True)
+
+    per_doc = [([], []) for _ in token_id_lists]
+    for doc_idx, nll, tokens in zip(owners, nlls, token_nlls):
+        per_doc[doc_idx][0].append(nll)
+        per_doc[doc_idx][1].append(tokens)
+    return per_doc
+
+
+def perplexity_for_token_ids(model, token_id_lists: list, stride: int = DEFAULT_STRIDE,
+                             batch_size: int = DEFAULT_BATCH_SIZE, pad_token_id: int = 0,
+                             cache: WindowCache = None):
+    """
+    Scores one or many tokenized documents, sharing forward passes across document boundaries.
+
+    Returns:
+        - A list of (avg_ppl, ppl_scores) tuples, one per document.
+    """
+    per_doc = _score_documents(model, token_id_lists, stride, batch_size, pad_token_id, cache)
+    return [summarize_nlls(doc_nlls) for doc_nlls, _ in per_doc]
+
+
+def perplexity_for_texts(model, tokenizer, texts: list, stride: int = DEFAULT_STRIDE,
+                         batch_size: int = DEFAULT_BATCH_SIZE, cache: WindowCache = None):
+    """
+    Calculates sliding-window perplexity for a list of texts with batched forward passes.
+
+    Returns:
+        - A list of (avg_ppl, ppl_scores) tuples, one per text.
+    """
+    if not texts:
+        return []
+    with profiling.stage("perplexity.tokenize"):
+        token_id_lists = tokenizer(list(texts))["input_ids"]
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    return perplexity_for_token_ids(
+        model, token_id_lists, stride=stride, batch_size=batch_size, pad_token_id=pad_token_id, cache=cache
+    )
+
+
+def surprisal_for_texts(model, tokenizer, texts: list, stride: int = DEFAULT_STRIDE,
+                        batch_size: int = DEFAULT_BATCH_SIZE, cache: WindowCache = None):
+    """
+    The same windows and forward passes as perplexity_for_texts, also keeping the NLL (surprisal,
+    in nats) of every token and the character span it came from.
+
+    Returns:
+        - A list of dictionaries, one per text: avg_ppl and ppl_scores (as perplexity_for_texts),
+          token_nlls (float32 array, one value per GPT-2 token, NaN for the first token) and
+          token_offsets (int32 array of (start, end) character offsets into the text).
+    """
+    import numpy as np
+
+    if not texts:
+        return []
+    with profiling.stage("perplexity.tokenize"):
+        encoded = tokenizer(list(texts), return_offsets_mapping=True)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    per_doc = _score_documents(model, encoded["input_ids"], stride, batch_size, pad_token_id, cache)
+
+    results = []
+    for (nlls, token_nlls), offsets in zip(per_doc, encoded["offset_mapping"]):
+        avg_ppl, ppl_scores = summarize_nlls(nlls)
+        results.append({
+            "avg_ppl": avg_ppl,
+            "ppl_scores": ppl_scores,
+            "token_nlls": concat_token_nlls(token_nlls),
+            "token_offsets": np.asarray(offsets, dtype=np.int32).reshape(-1, 2),
+        })
+    return results
+
+
+def sentence_perplexities(token_nlls, token_offsets, sentence_spans: list):
+    """
+    Maps token NLLs onto sentences: a token belongs to the sentence containing its last character
+    (GPT-2 tokens carry the preceding space, so their first character can lie between sentences).
+
+    Returns:
+        - sentence_ppl (np.ndarray): exp of the mean token NLL of each sentence (NaN if it has no scored token).
+        - token_sentence (np.ndarray): The sentence index of each token.
+    """
+    import numpy as np
+
+    token_nlls = np.asarray(token_nlls, dtype=np.float64)
+    token_offsets = np.asarray(token_offsets, dtype=np.int64).reshape(-1, 2)
+    n_sentences = len(sentence_spans)
+    if not n_sentences:
+        return np.empty(0), np.zeros(len(token_nlls), dtype=np.int32)
+
+    starts = np.asarray([start for start, _ in sentence_spans], dtype=np.int64)
+    last_char = np.maximum(token_offsets[:, 1] - 1, token_offsets[:, 0])
+    token_sentence = np.clip(np.searchsorted(starts, last_char, side="right") - 1, 0, n_sentences - 1)
+
+    scored = ~np.isnan(token_nlls)
+    sums = np.bincount(token_sentence[scored], weights=token_nlls[scored], minlength=n_sentences)
+    counts = np.bincount(token_sentence[scored], minlength=n_sentences)
+    with np.errstate(invalid="ignore"):
+        sentence_ppl = np.exp(sums / counts)
+    return sentence_ppl, token_sentence.astype(np.int32)
@@ -1,7 +1,58 @@
 # This file will contain the plotting functions using Plotly.
+#
+# Figures are sent to the browser with all of their data, so long documents are thinned out first:
+# series and trajectories with more than DETECTOR_PLOT_MAX_POINTS points are downsampled (LTTB for
+# the perplexity series, an even stride for the semantic trajectory), the sentence-length histogram
+# is pre-binned, large traces use WebGL (Scattergl) and hover text is cut at DETECTOR_PLOT_HOVER_CHARS.
+# The token heatmap is HTML with one span per token, so only the first DETECTOR_HEATMAP_MAX_TOKENS are drawn.
+import html
+import os
+
 import plotly.express as px
 import pandas as pd
 import plotly.graph_objects as go
+import numpy as np
+
+MAX_POINTS_ENV_VAR = "DETECTOR_PLOT_MAX_POINTS"
+HOVER_CHARS_ENV_VAR = "DETECTOR_PLOT_HOVER_CHARS"
+MAX_POINTS = int(os.environ.get(MAX_POINTS_ENV_VAR, 2000))
+HOVER_CHARS = int(os.environ.get(HOVER_CHARS_ENV_VAR, 120))
+HEATMAP_MAX_TOKENS_ENV_VAR = "DETECTOR_HEATMAP_MAX_TOKENS"
+HEATMAP_MAX_TOKENS = int(os.environ.get(HEATMAP_MAX_TOKENS_ENV_VAR, 3000))
+
+def lttb(y, n_out: int):
+    """
+    Largest-Triangle-Three-Buckets downsampling of the series y (x is the index).
+
+    Returns:
+        - indices (np.ndarray): The indices of the kept points, always including the first and last.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # Interior points are split into n_out - 2 buckets; from each, keep the point forming the
+    # largest triangle with the previously kept point and the mean of the next bucket
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    kept = np.empty(n_out, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    prev = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x = (edges[i + 1] + edges[i + 2] - 1) / 2
+            next_y = y[edges[i + 1]:edges[i + 2]].mean()
+        else:
+            next_x, next_y = n - 1, y[-1]
+        xs = np.arange(start, end)
+        area = np.abs((prev - next_x) * (y[start:end] - y[prev]) - (prev - xs) * (next_y - y[prev]))
+        prev = kept[i + 1] = start + int(np.argmax(area))
+    return kept
+
+def truncate_hover(text: str, max_chars: int = None):
+    max_chars = max_chars or HOVER_CHARS
+    return text if len(text) <= max_chars else text[:max_chars - 1].rstrip() + "…"
 
 def plot_burstiness(sent_lengths: list):
     """
@@ -14,6 +65,9 @@ def plot_burstiness(sent_lengths: list):
             yaxis_title="句子數量 (Number of Sentences)"
         )
 
+    if len(sent_lengths) > MAX_POINTS:
+        return _binned_sentence_lengths(sent_lengths)
+
     df = pd.DataFrame({'Sentence Length': sent_lengths})
     fig = px.histogram(
         df, 
@@ -29,6 +83,32 @@ def plot_burstiness(sent_lengths: list):
     )
     return fig
 
+def _binned_sentence_lengths(sent_lengths: list):
+    """plot_burstiness for long documents: one bar per length and a box built from precomputed quartiles."""
+    lengths = np.asarray(sent_lengths, dtype=np.int64)
+    counts = np.bincount(lengths)
+    present = np.nonzero(counts)[0]
+    q1, median, q3 = np.percentile(lengths, [25, 50, 75])
+    iqr = q3 - q1
+    inside = lengths[(lengths >= q1 - 1.5 * iqr) & (lengths <= q3 + 1.5 * iqr)]
+
+    fig = go.Figure()
+    fig.add_trace(go.Bar(x=present, y=counts[present], name="Sentences", showlegend=False))
+    fig.add_trace(go.Box(
+        q1=[q1], median=[median], q3=[q3],
+        lowerfence=[inside.min()], upperfence=[inside.max()],
+        y=["Sentence Length"], orientation="h", yaxis="y2", showlegend=False,
+    ))
+    fig.update_layout(
+        title_text='<b>句長分布 (Sentence Length Distribution)</b>',
+        title_x=0.5,
+        xaxis_title='句子中的詞數 (Words per Sentence)',
+        yaxis=dict(title='句子數量 (Number of Sentences)', domain=[0, 0.8]),
+        yaxis2=dict(domain=[0.82, 1], showticklabels=False),
+        bargap=0.1
+    )
+    return fig
+
 def plot_pos_distribution(pos_dist: dict):
     """
     Creates an interactive bar chart of the Part-of-Speech distribution.
@@ -60,7 +140,8 @@ def plot_pos_distribution(pos_dist: dict):
 
 def plot_zipf(zipf_data: dict):
     """
-    Creates an interactive log-log plot of word rank vs. frequency.
+    Creates a log-log plot of word rank vs. frequency from the log-binned Zipf summary,
+    with the fitted power law and the ideal Zipf curve (exponent 1).
     """
     if not zipf_data:
         return go.Figure().update_layout(
@@ -69,45 +150,53 @@ def plot_zipf(zipf_data: dict):
             xaxis_title="詞頻排名 (Log Rank)", yaxis_title="詞語頻率 (Log Frequency)"
         )
 
-    ranks = zipf_data["ranks"]
-    frequencies = zipf_data["frequencies"]
-    words = zipf_data["words"]
-
-    df = pd.DataFrame({
-        "Rank": ranks,
-        "Frequency": frequencies,
-        "Word": words
-    })
+    binned = zipf_data["binned"]
+    ranks = binned["rank"]
+    hover = [
+        f"排名 (Ranks) {start}–{end}<br>平均頻率 (Mean frequency) {freq:.2f}" if start != end
+        else f"排名 (Rank) {start}<br>頻率 (Frequency) {freq:.0f}"
+        for start, end, freq in zip(binned["rank_start"], binned["rank_end"], binned["frequency"])
+    ]
 
-    # Create the scatter plot for the actual data
-    fig = px.scatter(
-        df,
-        x="Rank",
-        y="Frequency",
-        log_x=True,
-        log_y=True,
-        title="<b>Zipf's Law 分布 (Zipf's Law Distribution)</b>",
-        labels={"Rank": "詞頻排名 (Log Rank)", "Frequency": "詞語頻率 (Log Frequency)"},
-        hover_data=["Word"]
-    )
-    fig.update_traces(marker=dict(color='blue', opacity=0.7), name="Actual Distribution")
+    fig = go.Figure()
+    # One point per log-spaced rank bin instead of one per vocabulary item
+    fig.add_trace(go.Scatter(
+        x=ranks,
+        y=binned["frequency"],
+        mode='markers',
+        name="Actual Distribution",
+        marker=dict(color='blue', opacity=0.7),
+        hovertext=hover,
+        hoverinfo="text",
+    ))
 
-    # Add the ideal Zipf's Law line
     # The ideal line is y = c/x, where c is the frequency of the most frequent word.
-    c = frequencies[0]
-    ideal_freqs = [c / r for r in ranks]
-    
+    c = zipf_data["frequencies"][0]
     fig.add_trace(go.Scatter(
-        x=ranks, 
-        y=ideal_freqs, 
-        mode='lines', 
+        x=ranks,
+        y=c / ranks,
+        mode='lines',
         name="Ideal Zipf's Law",
         line=dict(color='red', dash='dash')
     ))
 
+    title = "<b>Zipf's Law 分布 (Zipf's Law Distribution)</b>"
+    if zipf_data["exponent"] is not None:
+        fig.add_trace(go.Scatter(
+            x=ranks,
+            y=10 ** (zipf_data["intercept"] - zipf_data["exponent"] * np.log10(ranks)),
+            mode='lines',
+            name=f"Fitted (s = {zipf_data['exponent']:.2f})",
+            line=dict(color='green')
+        ))
+        title += f"<br><sup>s = {zipf_data['exponent']:.3f}, R² = {zipf_data['r_squared']:.3f}</sup>"
+
     fig.update_layout(
+        title_text=title,
         title_x=0.5,
-        legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01)
+        xaxis_type="log", yaxis_type="log",
+        xaxis_title="詞頻排名 (Log Rank)", yaxis_title="詞語頻率 (Log Frequency)",
+        legend=dict(yanchor="top", y=0.99, xanchor="right", x=0.99)
     )
     
     return fig
@@ -123,41 +212,49 @@ def plot_semantic_drift(semantic_data: dict):
         )
     
     pca_data = semantic_data["pca_data"]
-    df = pd.DataFrame({
-        "x": pca_data["x"],
-        "y": pca_data["y"],
-        "sentence": pca_data["sentences"]
-    })
+    x, y = np.asarray(pca_data["x"]), np.asarray(pca_data["y"])
+    order = np.arange(len(x))
+    if len(x) > MAX_POINTS:
+        # An even stride keeps the overall path; the colour still shows each point's sentence number
+        order = np.unique(np.linspace(0, len(x) - 1, MAX_POINTS).astype(np.int64))
+    # Cached results only keep sentence offsets; analysis.semantic_sentences adds the texts
+    sentences = pca_data.get("sentences")
+    hover = [f"#{i + 1}: {truncate_hover(sentences[i])}" if sentences else f"#{i + 1}" for i in order]
 
     fig = go.Figure()
 
     # Add the trajectory line
-    fig.add_trace(go.Scatter(
-        x=df['x'], 
-        y=df['y'],
+    fig.add_trace(go.Scattergl(
+        x=x[order], 
+        y=y[order],
         mode='lines',
         line=dict(width=1, color='lightgrey'),
-        name='Trajectory'
+        name='Trajectory',
+        hoverinfo='skip'
     ))
 
     # Add the points (sentences)
-    fig.add_trace(go.Scatter(
-        x=df['x'], 
-        y=df['y'],
+    fig.add_trace(go.Scattergl(
+        x=x[order], 
+        y=y[order],
         mode='markers',
         marker=dict(
-            size=8,
-            color=df.index, # Color by sentence order
+            size=8 if len(order) <= 500 else 5,
+            color=order, # Color by sentence order
             colorscale='Viridis',
             showscale=True,
             colorbar=dict(title="Sentence Order")
         ),
         hoverinfo='text',
-        hovertext=df['sentence'],
+        hovertext=hover,
         name='Sentences'
     ))
 
-    
+    if len(order) < len(x):
+        fig.update_layout(
+            title_text=f"<b>語意軌跡 (Semantic Trajectory)</b><br><sup>{len(order):,} / {len(x):,} sentences shown</sup>"
+        )
+
     return fig
 
 def plot_perplexity(ppl_scores: list, avg_ppl: float):
@@ -171,14 +268,22 @@ def plot_perplexity(ppl_scores: list, avg_ppl: float):
             yaxis_title="Perplexity"
         )
     
-    df = pd.DataFrame({'Perplexity': ppl_scores})
-    df.index.name = "Text Chunk"
-    
-    fig = px.line(
-        df,
-        y='Perplexity',
-        title='<b>Perplexity (困惑度) 時間序列圖</b>',
-        labels={'index': '文本區塊 (Text Chunk)', 'Perplexity': 'Perplexity Score'}
+    ppl_scores = np.asarray(ppl_scores, dtype=np.float64)
+    chunks = lttb(ppl_scores, MAX_POINTS)
+    title = '<b>Perplexity (困惑度) 時間序列圖</b>'
+    if len(chunks) < len(ppl_scores):
+        title += f"<br><sup>LTTB: {len(chunks):,} / {len(ppl_scores):,} chunks shown</sup>"
+
+    fig = go.Figure(go.Scattergl(
+        x=chunks,
+        y=ppl_scores[chunks],
+        mode='lines',
+        name='Perplexity Score'
+    ))
+    fig.update_layout(
+        title_text=title,
+        xaxis_title='文本區塊 (Text Chunk)',
+        yaxis_title='Perplexity Score'
     )
     
     # Add average line
@@ -194,4 +299,76 @@ def plot_perplexity(ppl_scores: list, avg_ppl: float):
     
     return fig
 
+def plot_sentence_perplexity(sentence_ppl: list, sentences: list, avg_ppl: float):
+    """
+    Creates a bar chart of the perplexity of each sentence, from the token NLLs of the perplexity pass.
+    Low bars are the sentences GPT-2 found most predictable.
+    """
+    title = '<b>逐句 Perplexity (Per-Sentence Perplexity)</b>'
+    if not len(sentence_ppl):
+        return go.Figure().update_layout(
+            title_text=title, xaxis_title="句子 (Sentence)", yaxis_title="Perplexity"
+        )
+
+    sentence_ppl = np.asarray(sentence_ppl, dtype=np.float64)
+    # LTTB needs finite values; sentences without scored tokens are drawn as gaps
+    kept = lttb(np.nan_to_num(sentence_ppl, nan=avg_ppl), MAX_POINTS)
+    if len(kept) < len(sentence_ppl):
+        title += f"<br><sup>LTTB: {len(kept):,} / {len(sentence_ppl):,} sentences shown</sup>"
+
+    fig = go.Figure(go.Bar(
+        x=kept,
+        y=sentence_ppl[kept],
+        hovertext=[truncate_hover(sentences[i]) for i in kept],
+        hovertemplate="句子 (Sentence) %{x}<br>Perplexity %{y:.2f}<br>%{hovertext}<extra></extra>",
+        name='Sentence Perplexity',
+    ))
+    fig.update_layout(
+        title_text=title,
+        xaxis_title='句子 (Sentence)',
+        yaxis_title='Perplexity',
+        yaxis_type='log',
+        title_x=0.5,
+    )
+    fig.add_hline(y=avg_ppl, line_dash="dot", annotation_text=f"Average: {avg_ppl:.2f}",
+                  annotation_position="bottom right", line_color='red')
+    return fig
+
+def token_heatmap_html(text: str, token_nlls, token_offsets, max_tokens: int = None):
+    """
+    Renders the text with each GPT-2 token shaded by its surprisal: the more predictable the token
+    (low NLL, AI-like), the darker the red. Shades are scaled between the 5th and 95th percentile
+    of the document's token NLLs; hovering a token shows its NLL.
+
+    Returns:
+        - An HTML string (the first `max_tokens` tokens; text between tokens is kept as is).
+          Render it as HTML (st.html), not through st.markdown, which would parse the text as Markdown.
+    """
+    max_tokens = max_tokens or HEATMAP_MAX_TOKENS
+    token_nlls = np.asarray(token_nlls, dtype=np.float64)
+    token_offsets = np.asarray(token_offsets, dtype=np.int64).reshape(-1, 2)
+    scored = token_nlls[~np.isnan(token_nlls)]
+    if not len(scored):
+        return f'<div style="white-space: pre-wrap">{html.escape(text)}</div>'
+
+    low, high = np.percentile(scored, [5, 95])
+    # Predictability in 0-1: 1 for the least surprising tokens
+    shade = 1 - np.clip((token_nlls - low) / max(high - low, 1e-6), 0, 1)
 
+    parts = []
+    pos = 0
+    for (start, end), nll, alpha in zip(token_offsets[:max_tokens], token_nlls, shade):
+        if start < pos:
+            continue
+        parts.append(html.escape(text[pos:start]))
+        piece = html.escape(text[start:end])
+        if np.isnan(nll):
+            parts.append(piece)
+        else:
+            parts.append(f'<span title="NLL {nll:.2f}" style="background-color: rgba(220, 38, 38, {alpha * 0.8:.2f})">{piece}</span>')
+        pos = end
+    if len(token_offsets) > max_tokens:
+        parts.append(f"… <i>({len(token_offsets) - max_tokens:,} more tokens not shown)</i>")
+    else:
+        parts.append(html.escape(text[pos:]))
+    return f'<div style="white-space: pre-wrap; line-height: 1.8">{"".join(parts)}</div>'
@@ -0,0 +1,328 @@
+# This file contains the per-stage instrumentation used to find out where an analysis spends its time.
+#
+# Stages (model loading, NLTK checks, tokenization, POS tagging, GPT-2 windows, encoding, PCA,
+# figure building, ...) are wrapped in `with profiling.stage("name"):`. While profiling is enabled
+# (DETECTOR_PROFILE=1 or set_enabled(True)) each stage records wall time, CPU time and peak RSS
+# growth, and caching.py reports a hit or miss for every cached call. Aggregates can be exported
+# as JSON or in the Prometheus text format; set DETECTOR_METRICS_PORT to serve the latter over HTTP.
+#
+# CPU time is process-wide (it includes torch's worker threads), so stages running at the same
+# time on different threads each see the other's CPU time too.
+import functools
+import json
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+
+PROFILE_ENV_VAR = "DETECTOR_PROFILE"
+METRICS_PORT_ENV_VAR = "DETECTOR_METRICS_PORT"
+# Stage records kept for export, most recent last
+MAX_RECENT = 1000
+SAMPLE_INTERVAL = 0.005  # seconds between RSS samples
+
+_enabled = os.environ.get(PROFILE_ENV_VAR, "").lower() not in ("", "0", "false", "no")
+_lock = threading.Lock()
+_local = threading.local()
+_stats = {}  # stage name -> StageStats
+_cache_counts = Counter()  # (function, "hit" | "miss") -> count
+_recent = deque(maxlen=MAX_RECENT)
+_sampler = None
+_metrics_server = None
+
+
+def enabled():
+    return _enabled
+
+
+def set_enabled(flag: bool):
+    global _enabled
+    _enabled = bool(flag)
+
+
+@dataclass
+class StageRecord:
+    """One execution of a stage."""
+    name: str
+    started: float  # Unix time
+    wall_s: float
+    cpu_s: float
+    peak_mem_mb: float  # Peak RSS growth over the stage, None where RSS cannot be read
+    thread: str
+
+
+@dataclass
+class StageStats:
+    """Running totals of a stage since the process started (or since reset())."""
+    calls: int = 0
+    wall_s: float = 0.0
+    cpu_s: float = 0.0
+    max_wall_s: float = 0.0
+    peak_mem_mb: float = 0.0
+
+    def add(self, record: StageRecord):
+        self.calls += 1
+        self.wall_s += record.wall_s
+        self.cpu_s += record.cpu_s
+        self.max_wall_s = max(self.max_wall_s, record.wall_s)
+        if record.peak_mem_mb is not None:
+            self.peak_mem_mb = max(self.peak_mem_mb, record.peak_mem_mb)
+
+
+class Trace:
+    """Collects the stage records and cache lookups of one analysis, across the threads it runs on."""
+
+    def __init__(self):
+        self.records = []
+        self.cache = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, record: StageRecord):
+        with self._lock:
+            self.records.append(record)
+
+    def count_cache(self, function: str, hit: bool):
+        with self._lock:
+            self.cache[(function, "hit" if hit else "miss")] += 1
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "stages": [asdict(r) for r in self.records],
+                "cache": [{"function": f, "result": r, "count": n} for (f, r), n in sorted(self.cache.items())],
+            }
+
+
+def set_trace(trace: Trace):
+    """Attaches `trace` to the current thread (None detaches), so its stages are also recorded there."""
+    _local.trace = trace
+
+
+def current_trace():
+    return getattr(_local, "trace", None)
+
+
+# --- Memory sampling ---
+def rss_bytes():
+    """Resident set size of this process, or None where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class _RSSSampler:
+    """A daemon thread that samples RSS and keeps the running peak of every open stage."""
+
+    def __init__(self):
+        self._active = {}  # token -> [peak bytes]
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        threading.Thread(target=self._run, name="profiling-rss", daemon=True).start()
+
+    def open(self, start: int):
+        token = object()
+        with self._lock:
+            self._active[token] = [start]
+        self._wake.set()
+        return token
+
+    def close(self, token, end: int):
+        with self._lock:
+            peak = self._active.pop(token)
+        return max(peak[0], end)
+
+    def _run(self):
+        while True:
+            # Sleep until a stage is open, then sample while any is
+            self._wake.wait()
+            time.sleep(SAMPLE_INTERVAL)
+            rss = rss_bytes()
+            with self._lock:
+                if not self._active:
+                    self._wake.clear()
+                for peak in self._active.values():
+                    peak[0] = max(peak[0], rss)
+
+
+def _get_sampler():
+    global _sampler
+    if _sampler is None:
+        with _lock:
+            if _sampler is None:
+                _sampler = _RSSSampler()
+    return _sampler
+
+
+# --- Recording ---
+@contextmanager
+def stage(name: str):
+    """Times the enclosed block as stage `name`; free when profiling is disabled."""
+    if not _enabled:
+        yield
+        return
+
+    start_rss = rss_bytes()
+    token = _get_sampler().open(start_rss) if start_rss is not None else None
+    started = time.time()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        peak_mb = None
+        if token is not None:
+            peak_mb = (_sampler.close(token, rss_bytes() or start_rss) - start_rss) / 2**20
+        record = StageRecord(name, started, wall, cpu, peak_mb, threading.current_thread().name)
+        with _lock:
+            _stats.setdefault(name, StageStats()).add(record)
+            _recent.append(record)
+        trace = current_trace()
+        if trace is not None:
+            trace.add(record)
+
+
+def profiled(name: str = None):
+    """Decorator form of stage(); the stage name defaults to the function's qualified name."""
+    def decorator(func):
+        stage_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count_cache(function: str, hit: bool):
+    """Records a cache hit or miss of a cached function (called by caching.py)."""
+    if not _enabled:
+        return
+    with _lock:
+        _cache_counts[(function, "hit" if hit else "miss")] += 1
+    trace = current_trace()
+    if trace is not None:
+        trace.count_cache(function, hit)
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+        _cache_counts.clear()
+        _recent.clear()
+
+
+# --- Export ---
+def snapshot():
+    """
+    Returns:
+        - A dictionary with per-stage totals, cache hit/miss counts, the size and evictions of the
+          in-process result cache and the most recent stage records.
+    """
+    import caching
+
+    with _lock:
+        return {
+            "enabled": _enabled,
+            "stages": {name: asdict(s) for name, s in sorted(_stats.items())},
+            "cache": [{"function": f, "result": r, "count": n} for (f, r), n in sorted(_cache_counts.items())],
+            "result_cache": caching.memory_cache_stats(),
+            "recent": [asdict(r) for r in _recent],
+        }
+
+
+def export_json(indent: int = 2) -> str:
+    return json.dumps(snapshot(), indent=indent)
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def export_prometheus() -> str:
+    """The per-stage totals, cache counts and result cache size in the Prometheus text exposition format."""
+    import caching
+
+    with _lock:
+        stats = sorted(_stats.items())
+        cache = sorted(_cache_counts.items())
+    result_cache = caching.memory_cache_stats()
+
+    metrics = [
+        ("detector_stage_calls_total", "counter", "Number of times each stage ran.", lambda s: s.calls),
+        ("detector_stage_seconds_total", "counter", "Wall time spent in each stage.", lambda s: s.wall_s),
+        ("detector_stage_cpu_seconds_total", "counter", "Process CPU time spent during each stage.", lambda s: s.cpu_s),
+        ("detector_stage_max_seconds", "gauge", "Longest single run of each stage.", lambda s: s.max_wall_s),
+        ("detector_stage_peak_memory_bytes", "gauge", "Largest RSS growth seen during each stage.",
+         lambda s: s.peak_mem_mb * 2**20),
+    ]
+    lines = []
+    for metric, kind, help_text, value in metrics:
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for name, s in stats:
+            lines.append(f'{metric}{{stage="{_label(name)}"}} {value(s):.6g}')
+    lines.append("# HELP detector_cache_requests_total Cached function calls by result.")
+    lines.append("# TYPE detector_cache_requests_total counter")
+    for (function, result), count in cache:
+        lines.append(f'detector_cache_requests_total{{function="{_label(function)}",result="{result}"}} {count}')
+    lines.append("# HELP detector_result_cache_bytes Estimated size of the in-process result cache.")
+    lines.append("# TYPE detector_result_cache_bytes gauge")
+    lines.append(f"detector_result_cache_bytes {result_cache['bytes']}")
+    lines.append("# HELP detector_result_cache_max_bytes Memory budget of the in-process result cache.")
+    lines.append("# TYPE detector_result_cache_max_bytes gauge")
+    lines.append(f"detector_result_cache_max_bytes {result_cache['max_bytes']}")
+    lines.append("# HELP detector_result_cache_entries Results held by the in-process result cache, by function.")
+    lines.append("# TYPE detector_result_cache_entries gauge")
+    for row in result_cache["functions"]:
+        lines.append(f'detector_result_cache_entries{{function="{_label(row["function"])}"}} {row["entries"]}')
+    lines.append("# HELP detector_result_cache_evictions_total Results evicted from the in-process result cache, by reason.")
+    lines.append("# TYPE detector_result_cache_evictions_total counter")
+    for reason, count in sorted(result_cache["evictions"].items()):
+        lines.append(f'detector_result_cache_evictions_total{{reason="{reason}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+
+def serve_prometheus(port: int, host: str = "0.0.0.0"):
+    """Serves export_prometheus() at http://host:port/metrics from a daemon thread; returns the server."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = export_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="profiling-metrics", daemon=True).start()
+    return server
+
+
+def start_metrics_server_from_env():
+    """Starts the Prometheus endpoint once per process if DETECTOR_METRICS_PORT is set (implies profiling)."""
+    global _metrics_server
+    port = os.environ.get(METRICS_PORT_ENV_VAR)
+    if not port:
+        return None
+    with _lock:
+        if _metrics_server is None:
+            set_enabled(True)
+            _metrics_server = serve_prometheus(int(port))
+    return _metrics_server
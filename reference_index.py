@@ -0,0 +1,432 @@
+# Local similarity index over a reference corpus of confirmed AI-generated and human sentences.
+#
+# Near-duplicates of known AI output are a much stronger signal than the heuristics behind
+# calculate_final_score. Reference sentences are embedded with analysis.load_embedding_model,
+# L2-normalised and appended to shards of memory-mapped matrices: float32, or int8 with one
+# float32 scale per row (a quarter of the disk and page cache). A lookup is a batched matrix
+# product of the query sentences against each shard, block by block, keeping the top k of every
+# block and merging them, so only the index pages being scanned need to be in memory.
+#
+# On disk an index is a directory: meta.json (model, dimension, dtype, rows per shard) plus, per
+# shard, the vectors (and int8 scales), one label byte per row and the sentences as JSON lines
+# with their byte offsets. meta.json is replaced atomically after every append, so a reader never
+# sees a half-written batch, and an open index picks up appends made by other processes.
+#
+# Usage:
+#   python reference_index.py add refs/ gpt_outputs.jsonl --label ai
+#   python reference_index.py add refs/ essays/ --label human
+#   python reference_index.py add refs/ labelled.csv --label-field label --int8
+#   python reference_index.py query refs/ essay.txt
+#   python reference_index.py bench --rows 1000000 --queries 64
+#   python reference_index.py stats refs/
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+INDEX_ENV_VAR = "DETECTOR_REFERENCE_INDEX"
+THRESHOLD_ENV_VAR = "DETECTOR_REFERENCE_THRESHOLD"
+LABELS = ("human", "ai")
+DTYPES = ("float32", "int8")
+SHARD_ROWS = 262_144
+# Reference rows scored per matrix product; bounds the (queries x block) score matrix
+SEARCH_BLOCK = 65_536
+# Cosine similarity from which a reference sentence counts as a near-duplicate
+DEFAULT_THRESHOLD = 0.92
+TOP_MATCHES = 10
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def quantize(vectors: np.ndarray):
+    """Symmetric per-row int8 quantization: vectors ~= codes * scales[:, None]."""
+    scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def _top_k(scores: np.ndarray, k: int):
+    """Column indices of the k largest scores of every row, best first."""
+    k = min(k, scores.shape[1])
+    if k == 1:
+        # The common case (nearest reference sentence): a single pass instead of a partition
+        return np.argmax(scores, axis=1)[:, None]
+    idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, idx, axis=1), axis=1)
+    return np.take_along_axis(idx, order, axis=1)
+
+
+class ReferenceIndex:
+    """
+    An append-only, sharded embedding index stored in `path`. Opening a directory without an index
+    creates an empty one for `model` / `dim` (taken from the first append if not given).
+    """
+
+    def __init__(self, path: str, model: str = None, dtype: str = "float32", shard_rows: int = SHARD_ROWS):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown index dtype {dtype!r}, expected one of {', '.join(DTYPES)}")
+        self.path = path
+        self._lock = threading.Lock()
+        self._meta_mtime = None
+        self._shards = []
+        # shards: rows in each shard; text_bytes: committed size of each shard's sentences file
+        self.meta = {"model": model, "dim": None, "dtype": dtype, "shard_rows": shard_rows, "shards": [], "text_bytes": []}
+        if os.path.exists(self._file("meta.json")):
+            self._reload()
+            if model and self.meta["model"] != model:
+                raise ValueError(f"Reference index {path} was built with {self.meta['model']}, not {model}; rebuild it")
+
+    def __len__(self):
+        return sum(self.meta["shards"])
+
+    def _file(self, name: str, shard: int = None):
+        return os.path.join(self.path, name if shard is None else f"{name}-{shard:05d}")
+
+    # --- Reading ---
+    def _reload(self):
+        with open(self._file("meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self._meta_mtime = os.stat(self._file("meta.json")).st_mtime_ns
+        dim = self.meta["dim"]
+        self._shards = []
+        for shard, rows in enumerate(self.meta["shards"]):
+            if self.meta["dtype"] == "int8":
+                vectors = np.memmap(self._file("vectors.i8", shard), dtype=np.int8, mode="r", shape=(rows, dim))
+                scales = np.memmap(self._file("scales.f32", shard), dtype=np.float32, mode="r", shape=(rows,))
+            else:
+                vectors = np.memmap(self._file("vectors.f32", shard), dtype=np.float32, mode="r", shape=(rows, dim))
+                scales = None
+            labels = np.memmap(self._file("labels.u8", shard), dtype=np.uint8, mode="r", shape=(rows,))
+            self._shards.append((vectors, scales, labels))
+
+    def refresh(self):
+        """Re-opens the shards if another process has appended since they were mapped."""
+        try:
+            mtime = os.stat(self._file("meta.json")).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._meta_mtime:
+            with self._lock:
+                self._reload()
+
+    def search(self, queries, k: int = 5):
+        """
+        Finds the k most similar reference sentences of every query embedding (cosine similarity).
+
+        Returns:
+            - scores (np.ndarray): (n_queries, k) float32 similarities, best first.
+            - rows (np.ndarray): (n_queries, k) int64 global row numbers (see records()); -1 where the index has fewer rows.
+        """
+        self.refresh()
+        queries = normalize(queries)
+        n = len(queries)
+        best_scores = np.full((n, k), -np.inf, dtype=np.float32)
+        best_rows = np.full((n, k), -1, dtype=np.int64)
+        if not n or not len(self):
+            return best_scores, best_rows
+
+        offset = 0
+        candidates_scores, candidates_rows = [best_scores], [best_rows]
+        for vectors, scales, _ in self._shards:
+            for start in range(0, len(vectors), SEARCH_BLOCK):
+                block = vectors[start:start + SEARCH_BLOCK]
+                if scales is None:
+                    scores = queries @ block.T
+                else:
+                    scores = (queries @ block.astype(np.float32).T) * scales[start:start + SEARCH_BLOCK]
+                idx = _top_k(scores, k)
+                candidates_scores.append(np.take_along_axis(scores, idx, axis=1))
+                candidates_rows.append(idx + offset + start)
+            offset += len(vectors)
+
+        scores = np.concatenate(candidates_scores, axis=1)
+        rows = np.concatenate(candidates_rows, axis=1)
+        idx = _top_k(scores, k)
+        return np.take_along_axis(scores, idx, axis=1), np.take_along_axis(rows, idx, axis=1)
+
+    def labels(self, rows):
+        """The label ("ai" / "human") of each global row number."""
+        shard_rows = self.meta["shard_rows"]
+        return [LABELS[self._shards[int(row) // shard_rows][2][int(row) % shard_rows]] for row in rows]
+
+    def records(self, rows):
+        """
+        Returns:
+            - A list of dictionaries (sentence, label, source) for the given global row numbers.
+        """
+        results = []
+        for row in rows:
+            shard, local = divmod(int(row), self.meta["shard_rows"])
+            offsets = np.memmap(self._file("offsets.u64", shard), dtype=np.uint64, mode="r",
+                                shape=(self.meta["shards"][shard],))
+            with open(self._file("sentences.jsonl", shard), "rb") as f:
+                f.seek(int(offsets[local]))
+                record = json.loads(f.readline())
+            results.append(record)
+        for record, label in zip(results, self.labels(rows)):
+            record["label"] = label
+        return results
+
+    # --- Appending ---
+    def add(self, sentences: list, labels: list, sources: list = None, embeddings=None):
+        """
+        Appends reference sentences with their labels ("ai" / "human") and optional source ids.
+        Sentences are encoded with analysis.encode_sentences unless `embeddings` are given.
+
+        Returns:
+            - The number of rows added.
+        """
+        if not sentences:
+            return 0
+        if embeddings is None:
+            import analysis
+            embeddings = analysis.encode_sentences(list(sentences))
+        unknown = set(labels) - set(LABELS)
+        if unknown:
+            raise ValueError(f"Unknown reference labels {sorted(unknown)}, expected one of {', '.join(LABELS)}")
+        vectors = normalize(embeddings)
+        codes = np.asarray([LABELS.index(label) for label in labels], dtype=np.uint8)
+        sources = sources if sources is not None else [None] * len(sentences)
+
+        with self._lock:
+            # Work on a copy, so a failed append leaves the open index as it was
+            meta = json.loads(json.dumps(self.meta))
+            if meta["dim"] is None:
+                meta["dim"] = int(vectors.shape[1])
+                if meta["model"] is None:
+                    import analysis
+                    meta["model"] = analysis.EMBEDDING_MODEL_TAG
+            elif vectors.shape[1] != meta["dim"]:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match the index ({meta['dim']})")
+            os.makedirs(self.path, exist_ok=True)
+
+            start = 0
+            while start < len(vectors):
+                if not meta["shards"] or meta["shards"][-1] >= meta["shard_rows"]:
+                    meta["shards"].append(0)
+                    meta["text_bytes"].append(0)
+                shard = len(meta["shards"]) - 1
+                end = min(len(vectors), start + meta["shard_rows"] - meta["shards"][shard])
+                meta["text_bytes"][shard] = self._append_shard(
+                    meta, shard, vectors[start:end], codes[start:end], sentences[start:end], sources[start:end]
+                )
+                meta["shards"][shard] += end - start
+                start = end
+            self._write_meta(meta)
+            self._reload()
+        return len(vectors)
+
+    def _append_shard(self, meta: dict, shard: int, vectors, codes, sentences, sources):
+        """Appends rows to every file of a shard; returns the new size of its sentences file."""
+        rows = meta["shards"][shard]
+        text_size = meta["text_bytes"][shard]
+        dim = meta["dim"]
+        if meta["dtype"] == "int8":
+            vectors, scales = quantize(vectors)
+            parts = [("vectors.i8", vectors, rows * dim), ("scales.f32", scales, rows * 4)]
+        else:
+            parts = [("vectors.f32", vectors, rows * dim * 4)]
+        parts.append(("labels.u8", codes, rows))
+
+        lines = [json.dumps({"sentence": s, "source": src}, ensure_ascii=False).encode("utf-8") + b"\n"
+                 for s, src in zip(sentences, sources)]
+        offsets = text_size + np.cumsum([0] + [len(line) for line in lines[:-1]], dtype=np.uint64)
+        text = b"".join(lines)
+        parts += [("offsets.u64", offsets.astype(np.uint64), rows * 8), ("sentences.jsonl", text, text_size)]
+
+        for name, data, committed in parts:
+            with open(self._file(name, shard), "ab") as f:
+                # Drop anything written after the last committed append (e.g. a crash half-way)
+                f.truncate(committed)
+                f.write(data if isinstance(data, bytes) else np.ascontiguousarray(data).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        return text_size + len(text)
+
+    def _write_meta(self, meta: dict):
+        # Write-then-rename, so readers see either the old or the new row counts
+        tmp_path = self._file(f"meta.json.{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._file("meta.json"))
+
+    def stats(self):
+        counts = np.zeros(len(LABELS), dtype=np.int64)
+        for _, _, labels in self._shards:
+            counts += np.bincount(labels, minlength=len(LABELS))
+        return {
+            "rows": len(self),
+            "shards": len(self.meta["shards"]),
+            "dtype": self.meta["dtype"],
+            "dim": self.meta["dim"],
+            "model": self.meta["model"],
+            "rows_by_label": dict(zip(LABELS, counts.tolist())),
+        }
+
+
+def selected_threshold():
+    value = os.environ.get(THRESHOLD_ENV_VAR)
+    return float(value) if value else DEFAULT_THRESHOLD
+
+
+def match_sentences(index: ReferenceIndex, sentences: list, embeddings, threshold: float = None):
+    """
+    Looks up the nearest reference sentence of every sentence of a document.
+
+    Returns:
+        - A dictionary with coverage (share of sentences with a near-duplicate at or above `threshold`),
+          ai_fraction / human_fraction (share of sentences whose near-duplicate is AI / human),
+          max_similarity, and matches: the best near-duplicates (sentence, reference, label, source,
+          similarity), most similar first.
+    """
+    threshold = selected_threshold() if threshold is None else threshold
+    n = len(sentences)
+    if not n or not len(index):
+        return {"coverage": 0.0, "ai_fraction": 0.0, "human_fraction": 0.0, "max_similarity": None, "matches": []}
+
+    scores, rows = index.search(embeddings, k=1)
+    scores, rows = scores[:, 0], rows[:, 0]
+    matched = np.flatnonzero(scores >= threshold)
+    best = matched[np.argsort(-scores[matched])][:TOP_MATCHES]
+    references = index.records(rows[best])
+    labels = index.labels(rows[matched])
+    return {
+        "coverage": len(matched) / n,
+        "ai_fraction": labels.count("ai") / n,
+        "human_fraction": labels.count("human") / n,
+        "max_similarity": float(scores.max()),
+        "matches": [
+            {"sentence": sentences[i], "reference": ref["sentence"], "label": ref["label"],
+             "source": ref["source"], "similarity": float(scores[i])}
+            for i, ref in zip(best, references)
+        ],
+    }
+
+
+# --- Command line ---
+def _read_labelled(path: str, text_field: str, id_field: str, label_field: str):
+    """Yields {"id", "text", "label"} from a .jsonl or .csv file with a label column."""
+    import csv
+
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.endswith(".csv"):
+            csv.field_size_limit(sys.maxsize)
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for row_no, row in enumerate(rows):
+            yield {"id": row.get(id_field, row_no), "text": row.get(text_field) or "",
+                   "label": str(row[label_field]).strip().lower()}
+
+
+def _reference_sentences(path: str, label: str, label_field: str, text_field: str, id_field: str):
+    """Yields (sentence, label, source id) for every sentence of the input corpus."""
+    import nltk
+    from score_corpus import open_reader
+
+    if label_field:
+        records = _read_labelled(path, text_field, id_field, label_field)
+    else:
+        records = ({**record, "label": label} for record in open_reader(path, text_field, id_field))
+    for record in records:
+        for sentence in nltk.sent_tokenize(record["text"]):
+            yield sentence, record["label"], record["id"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build and query the reference-corpus similarity index.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="Append a corpus to an index (created if missing)")
+    add.add_argument("index", help="Index directory")
+    add.add_argument("input", help="A .jsonl, .json (array), .csv or .parquet file, or a directory of .txt files")
+    add.add_argument("--label", choices=LABELS, help="Label of every text in the input")
+    add.add_argument("--label-field", help="Column with the label (ai / human) of each text instead (.jsonl / .csv)")
+    add.add_argument("--text-field", default="text")
+    add.add_argument("--id-field", default="id")
+    add.add_argument("--int8", action="store_true", help="Store int8 vectors (only when creating the index)")
+    add.add_argument("--chunk", type=int, default=4096, help="Sentences encoded and appended at a time")
+
+    query = commands.add_parser("query", help="Show the near-duplicates of a text file")
+    query.add_argument("index")
+    query.add_argument("text_file")
+    query.add_argument("--threshold", type=float, default=None)
+
+    stats = commands.add_parser("stats", help="Print the size of an index")
+    stats.add_argument("index")
+
+    bench = commands.add_parser("bench", help="Time lookups against a synthetic index of random vectors")
+    bench.add_argument("--rows", type=int, default=1_000_000)
+    bench.add_argument("--dim", type=int, default=384)
+    bench.add_argument("--queries", type=int, default=64, help="Query sentences per lookup (one document)")
+    bench.add_argument("--int8", action="store_true")
+    bench.add_argument("--path", default=None, help="Where to build it (default: a temporary directory)")
+    args = parser.parse_args(argv)
+
+    if args.command == "stats":
+        print(json.dumps(ReferenceIndex(args.index).stats(), indent=2))
+        return 0
+
+    if args.command == "bench":
+        import tempfile
+
+        path = args.path or tempfile.mkdtemp(prefix="reference-index-")
+        index = ReferenceIndex(path, model="random", dtype="int8" if args.int8 else "float32")
+        rng = np.random.default_rng(0)
+        start = time.perf_counter()
+        for begin in range(0, args.rows, SHARD_ROWS):
+            n = min(SHARD_ROWS, args.rows - begin)
+            index.add([""] * n, ["ai"] * n, embeddings=rng.standard_normal((n, args.dim), dtype=np.float32))
+        print(f"built {len(index):,} x {args.dim} {index.meta['dtype']} rows in {time.perf_counter() - start:.1f}s at {path}")
+        queries = rng.standard_normal((args.queries, args.dim), dtype=np.float32)
+        index.search(queries, k=5)  # page the shards in
+        latencies = []
+        for _ in range(5):
+            start = time.perf_counter()
+            index.search(queries, k=5)
+            latencies.append(time.perf_counter() - start)
+        median = float(np.median(latencies))
+        print(f"top-5 for {args.queries} query sentences: {median * 1000:.1f} ms "
+              f"({median / args.queries * 1000:.2f} ms per sentence)")
+        return 0
+
+    import analysis
+    analysis.download_nltk_data()
+
+    if args.command == "query":
+        index = ReferenceIndex(args.index)
+        with open(args.text_file, encoding="utf-8") as f:
+            doc = analysis.load_document(f.read())
+        result = match_sentences(index, list(doc.sentences), analysis.encode_sentences(list(doc.sentences)),
+                                 args.threshold)
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+        return 0
+
+    if bool(args.label) == bool(args.label_field):
+        parser.error("add needs exactly one of --label or --label-field")
+    index = ReferenceIndex(args.index, model=analysis.EMBEDDING_MODEL_TAG, dtype="int8" if args.int8 else "float32")
+    batch = []
+    added = 0
+    for item in _reference_sentences(args.input, args.label, args.label_field, args.text_field, args.id_field):
+        batch.append(item)
+        if len(batch) == args.chunk:
+            added += index.add(*map(list, zip(*batch)))
+            batch = []
+            print(f"Added {added:,} sentences", file=sys.stderr)
+    if batch:
+        added += index.add(*map(list, zip(*batch)))
+    print(json.dumps(index.stats(), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+# This file contains the persistent, content-addressed result store behind caching.py.
+# Results are kept in a single SQLite file, so they survive restarts and can be shared by every
+# worker process (and every app replica on the same volume).
+#
+# Usage:
+#   python result_store.py stats ~/.cache/ai-text-detector/results.sqlite
+#   python result_store.py clear ~/.cache/ai-text-detector/results.sqlite
+import json
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+
+DEFAULT_MAX_BYTES = 1 << 30  # 1 GiB
+# Refresh an entry's LRU timestamp at most this often, so cache hits rarely need a write lock
+TOUCH_INTERVAL = 60.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    metric TEXT NOT NULL,
+    model TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL,
+    value BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (name, value) VALUES ('total_bytes', 0), ('evictions', 0);
+"""
+
+
+class ResultStore:
+    """
+    A size-bounded LRU store of pickled metric results in SQLite.
+    Safe to share between threads (one connection per thread) and processes (WAL journal + busy timeout).
+    A forked child opens its own connections: SQLite connections must not be used across fork().
+    """
+
+    def __init__(self, path: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._pid = os.getpid()
+        # Connections inherited through fork(); never used or closed, since closing one would release
+        # the parent's locks on the database file
+        self._inherited = []
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # A short-lived connection, so creating the store (e.g. before forking workers) leaves none open
+        conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+        try:
+            conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        if os.getpid() != self._pid:
+            self._inherited.append(self._local)
+            self._local = threading.local()
+            self._pid = os.getpid()
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, key: str):
+        """
+        Returns:
+            - (True, value) on a hit, (False, None) on a miss.
+        """
+        conn = self._connect()
+        row = conn.execute("SELECT value, last_access FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self._count("misses")
+            return False, None
+        try:
+            value = pickle.loads(row[0])
+        except Exception:
+            # Written by an incompatible version of the code; treat as a miss and let it be overwritten
+            self._count("misses")
+            return False, None
+        now = time.time()
+        if now - row[1] > TOUCH_INTERVAL:
+            conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+        self._count("hits")
+        return True, value
+
+    def put(self, key: str, value, metric: str = "", model: str = ""):
+        """Stores a result, then evicts least recently used entries until the store fits in max_bytes."""
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes:
+            return
+        now = time.time()
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            old = conn.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, metric, model, size, created, last_access, value) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, metric, model, len(blob), now, now, blob),
+            )
+            delta = len(blob) - (old[0] if old else 0)
+            conn.execute("UPDATE meta SET value = value + ? WHERE name = 'total_bytes'", (delta,))
+            evicted = self._evict(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if evicted:
+            with self._stats_lock:
+                self.evictions += evicted
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT value FROM meta WHERE name = 'total_bytes'").fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+        # Evict down to 90% so we do not pay for an eviction pass on every insert
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        freed = 0
+        for key, size in conn.execute("SELECT key, size FROM results ORDER BY last_access ASC").fetchall():
+            if total - freed <= target:
+                break
+            conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            freed += size
+            evicted += 1
+        conn.execute("UPDATE meta SET value = value - ? WHERE name = 'total_bytes'", (freed,))
+        conn.execute("UPDATE meta SET value = value + ? WHERE name = 'evictions'", (evicted,))
+        return evicted
+
+    def clear(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM results")
+        conn.execute("UPDATE meta SET value = 0 WHERE name = 'total_bytes'")
+        conn.execute("COMMIT")
+
+    def stats(self):
+        """
+        Returns:
+            - A dictionary with this process's hits/misses/evictions and the store-wide entry count,
+              size and eviction total (shared by all processes using the file).
+        """
+        conn = self._connect()
+        entries = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        meta = dict(conn.execute("SELECT name, value FROM meta").fetchall())
+        by_metric = dict(conn.execute("SELECT metric, COUNT(*) FROM results GROUP BY metric").fetchall())
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": meta.get("total_bytes", 0),
+                "max_bytes": self.max_bytes,
+                "total_evictions": meta.get("evictions", 0),
+                "entries_by_metric": by_metric,
+            }
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2 or argv[0] not in ("stats", "clear"):
+        print("usage: python result_store.py {stats|clear} PATH", file=sys.stderr)
+        return 2
+    store = ResultStore(argv[1])
+    if argv[0] == "clear":
+        store.clear()
+    print(json.dumps(store.stats(), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
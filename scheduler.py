@@ -0,0 +1,154 @@
+# Process-wide scheduler for model calls, so concurrent Streamlit sessions do not oversubscribe the CPU.
+#
+# Every session thread shares the same cached GPT-2 and MiniLM objects. Left alone, N sessions each
+# run their forward passes with torch's default thread count (one thread per core), N times more
+# threads than cores, and every request slows down. Once enable() has been called (app.py does),
+# every forward pass - a batch of perplexity windows, a chunk of sentences to embed - first takes
+# one of DETECTOR_MODEL_SLOTS slots and runs with a fixed share of the cores as torch threads.
+# Waiting passes are served first-in, first-out. A slot is released after every batch, so a long
+# document interleaves with short ones instead of holding the models until it is done.
+#
+# Outside the app (enable() not called) slot() does nothing and torch's thread settings are untouched.
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import inference_backends
+import profiling
+
+SLOTS_ENV_VAR = "DETECTOR_MODEL_SLOTS"
+# Fewer threads than this per forward pass stops paying off for distilgpt2 / MiniLM sized matrices
+MIN_THREADS_PER_SLOT = 4
+
+_scheduler = None
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class Scheduler:
+    """
+    Bounded FIFO admission for model calls: at most `slots` run at once, each with `threads` torch threads.
+    """
+
+    def __init__(self, slots: int, threads: int):
+        self.slots = slots
+        self.threads = threads
+        self._cond = threading.Condition()
+        self._tickets = itertools.count()
+        self._queue = deque()  # (ticket, owner) of waiting calls, oldest first
+        self._running = 0
+        self.completed = 0
+        self.total_wait_s = 0.0
+        self.max_wait_s = 0.0
+
+    def acquire(self, owner=None):
+        """Blocks until it is this call's turn and a slot is free."""
+        start = time.perf_counter()
+        with self._cond:
+            ticket = (next(self._tickets), owner)
+            self._queue.append(ticket)
+            while self._queue[0] is not ticket or self._running >= self.slots:
+                self._cond.wait()
+            self._queue.popleft()
+            self._running += 1
+            waited = time.perf_counter() - start
+            self.total_wait_s += waited
+            self.max_wait_s = max(self.max_wait_s, waited)
+            # The next caller in line may fit into another free slot
+            self._cond.notify_all()
+        _set_torch_threads(self.threads)
+
+    def release(self):
+        with self._cond:
+            self._running -= 1
+            self.completed += 1
+            self._cond.notify_all()
+
+    def position(self, owner):
+        """1-based place of `owner`'s earliest waiting call in the queue, or 0 if it has none waiting."""
+        with self._cond:
+            for i, (_, queued_owner) in enumerate(self._queue):
+                if queued_owner == owner:
+                    return i + 1
+            return 0
+
+    def stats(self):
+        with self._cond:
+            return {
+                "slots": self.slots,
+                "threads_per_slot": self.threads,
+                "running": self._running,
+                "queued": len(self._queue),
+                "completed": self.completed,
+                "mean_wait_s": self.total_wait_s / self.completed if self.completed else 0.0,
+                "max_wait_s": self.max_wait_s,
+            }
+
+
+def _set_torch_threads(threads: int):
+    import torch
+
+    # The intra-op thread count is per calling thread, so it is set on whichever session thread got the slot
+    if torch.get_num_threads() != threads:
+        torch.set_num_threads(threads)
+
+
+def enable(slots: int = None, total_threads: int = None):
+    """
+    Turns on scheduling for this process (once; later calls return the existing scheduler).
+    By default the cores are split into slots of MIN_THREADS_PER_SLOT threads; DETECTOR_MODEL_SLOTS
+    sets the number of slots and DETECTOR_NUM_THREADS the threads per slot.
+
+    Returns:
+        - The Scheduler.
+    """
+    global _scheduler
+    with _lock:
+        if _scheduler is None:
+            total_threads = total_threads or os.cpu_count() or 1
+            slots = slots or int(os.environ.get(SLOTS_ENV_VAR, 0)) or max(1, total_threads // MIN_THREADS_PER_SLOT)
+            threads = inference_backends.selected_num_threads() or max(1, total_threads // slots)
+            # Models loaded from now on (and ONNX Runtime sessions) use the same per-slot thread count
+            os.environ[inference_backends.NUM_THREADS_ENV_VAR] = str(threads)
+            _scheduler = Scheduler(slots, threads)
+    return _scheduler
+
+
+def enabled():
+    return _scheduler is not None
+
+
+def set_owner(owner):
+    """Tags the model calls made on the current thread (e.g. with a session id) for position()."""
+    _local.owner = owner
+
+
+@contextmanager
+def slot():
+    """Runs the enclosed model call in a scheduler slot; a no-op unless enable() was called."""
+    if _scheduler is None:
+        yield
+        return
+    with profiling.stage("scheduler.wait"):
+        _scheduler.acquire(getattr(_local, "owner", None))
+    try:
+        yield
+    finally:
+        _scheduler.release()
+
+
+def position(owner):
+    """Queue position of `owner`'s next model call (0 if none is waiting or scheduling is off)."""
+    return _scheduler.position(owner) if _scheduler is not None else 0
+
+
+def stats():
+    """
+    Returns:
+        - A dictionary with the slots, threads per slot, running and queued calls and the mean / max
+          queue wait, or None when scheduling is off.
+    """
+    return _scheduler.stats() if _scheduler is not None else None
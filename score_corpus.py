@@ -0,0 +1,339 @@
+# Headless batch scorer: streams a corpus through the same metrics as the Streamlit app.
+#
+# Usage:
+#   python score_corpus.py corpus.jsonl scores.jsonl
+#   python score_corpus.py texts/ scores.parquet --batch-size 64
+#   python score_corpus.py corpus.jsonl scores.jsonl --workers 8   (forked workers sharing one copy of the models, see parallel.py)
+#
+# Progress is checkpointed next to the output, so re-running the same command after a crash
+# resumes after the last completed batch instead of starting over.
+import argparse
+import csv
+import json
+import math
+import os
+import re
+import sys
+
+import analysis
+import cascade
+import tagging
+from document import parse_document
+
+CHECKPOINT_SUFFIX = ".checkpoint.json"
+PART_NAME = re.compile(r"part-(\d+)\.parquet")
+
+
+# --- Readers: each yields {"id": ..., "text": ...} one document at a time ---
+def read_jsonl(path: str, text_field: str = "text", id_field: str = "id"):
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            yield {"id": row.get(id_field, line_no), "text": row.get(text_field) or ""}
+
+
+def read_json(path: str, text_field: str = "text", id_field: str = "id"):
+    """Reads a .json file holding one array of documents (loaded whole, unlike JSONL)."""
+    with open(path, encoding="utf-8") as f:
+        rows = json.load(f)
+    if not isinstance(rows, list):
+        raise ValueError(f"{path}: expected a JSON array of documents")
+    for row_no, row in enumerate(rows):
+        yield {"id": row.get(id_field, row_no), "text": row.get(text_field) or ""}
+
+
+def read_csv(path: str, text_field: str = "text", id_field: str = "id"):
+    # Documents can be far longer than the csv module's default field limit
+    csv.field_size_limit(sys.maxsize)
+    with open(path, encoding="utf-8", newline="") as f:
+        for row_no, row in enumerate(csv.DictReader(f)):
+            yield {"id": row.get(id_field, row_no), "text": row.get(text_field) or ""}
+
+
+def read_txt_dir(path: str):
+    for name in sorted(os.listdir(path)):
+        if not name.endswith(".txt"):
+            continue
+        with open(os.path.join(path, name), encoding="utf-8", errors="replace") as f:
+            yield {"id": name, "text": f.read()}
+
+
+def read_parquet(path: str, text_field: str = "text", id_field: str = "id"):
+    import pyarrow.parquet as pq
+
+    pf = pq.ParquetFile(path)
+    columns = [c for c in (id_field, text_field) if c in pf.schema_arrow.names]
+    row_no = 0
+    for batch in pf.iter_batches(batch_size=1024, columns=columns):
+        for row in batch.to_pylist():
+            yield {"id": row.get(id_field, row_no), "text": row.get(text_field) or ""}
+            row_no += 1
+
+
+def open_reader(path: str, text_field: str, id_field: str):
+    if os.path.isdir(path):
+        return read_txt_dir(path)
+    if path.endswith(".jsonl"):
+        return read_jsonl(path, text_field, id_field)
+    if path.endswith(".json"):
+        return read_json(path, text_field, id_field)
+    if path.endswith(".csv"):
+        return read_csv(path, text_field, id_field)
+    if path.endswith(".parquet"):
+        return read_parquet(path, text_field, id_field)
+    raise ValueError(f"Unsupported input format: {path} (expected .jsonl, .json, .csv, .parquet or a directory of .txt files)")
+
+
+# --- Writers: append one batch of result rows at a time ---
+class JsonlWriter:
+    """Appends rows to a JSONL file. The byte offset after each batch is the resume point."""
+
+    def __init__(self, path: str, offset: int = 0):
+        self.path = path
+        mode = "r+b" if os.path.exists(path) else "wb"
+        self.f = open(path, mode)
+        # Drop anything written after the last checkpoint (a batch that crashed half-way)
+        self.f.truncate(offset)
+        self.f.seek(offset)
+
+    def write(self, rows: list):
+        for row in rows:
+            self.f.write((json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8"))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def state(self):
+        return {"output_offset": self.f.tell()}
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetWriter:
+    """Writes each batch as a numbered part file inside the output directory."""
+
+    def __init__(self, path: str, next_part: int = 0):
+        import pyarrow  # noqa: F401 (fail early if the optional dependency is missing)
+
+        self.path = path
+        self.next_part = next_part
+        os.makedirs(path, exist_ok=True)
+        # Remove parts from a batch that was written but never checkpointed; other files are left alone
+        for name in os.listdir(path):
+            match = PART_NAME.fullmatch(name)
+            if match and int(match.group(1)) >= next_part:
+                os.remove(os.path.join(path, name))
+
+    def write(self, rows: list):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if not rows:
+            return
+        pq.write_table(pa.Table.from_pylist(rows), os.path.join(self.path, f"part-{self.next_part:05d}.parquet"))
+        self.next_part += 1
+
+    def state(self):
+        return {"next_part": self.next_part}
+
+    def close(self):
+        pass
+
+
+def open_writer(path: str, checkpoint: dict):
+    if path.endswith(".parquet"):
+        return ParquetWriter(path, checkpoint.get("next_part", 0))
+    return JsonlWriter(path, checkpoint.get("output_offset", 0))
+
+
+# --- Checkpointing ---
+def load_checkpoint(output_path: str):
+    try:
+        with open(output_path + CHECKPOINT_SUFFIX, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_checkpoint(output_path: str, state: dict):
+    # Write-then-rename so a crash never leaves a half-written checkpoint behind
+    tmp_path = output_path + CHECKPOINT_SUFFIX + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, output_path + CHECKPOINT_SUFFIX)
+
+
+# --- Scoring ---
+def _clean(value):
+    """Converts numpy scalars to plain floats and NaN to None so rows are valid JSON."""
+    if value is None:
+        return None
+    value = float(value)
+    return None if math.isnan(value) else value
+
+
+def score_batch(records: list, stride: int = 512, ppl_batch_size: int = 8, cascade_band: tuple = None):
+    """
+    Runs every metric and calculate_final_score on a batch of documents.
+    Perplexity windows from the whole batch share forward passes.
+    With `cascade_band`, perplexity and drift only run for documents whose partial score
+    (cheap metrics only) falls inside the band; see cascade.py.
+
+    Returns:
+        - A list of result rows, one per record.
+    """
+    analysis.download_nltk_data()
+    docs = [parse_document(r["text"]) for r in records]
+    # Without a band every document is escalated, i.e. the full pipeline
+    results = cascade.cascade_score_batch(docs, band=cascade_band or (0, 100), stride=stride,
+                                          ppl_batch_size=ppl_batch_size)
+
+    rows = []
+    for record, doc, result in zip(records, docs, results):
+        metrics = result["metrics"]
+        zipf_data = result["details"]["zipf_data"]
+        row = {
+            "id": record["id"],
+            "n_sentences": len(doc.sentences),
+            "n_tokens": len(doc.tokens),
+            "avg_perplexity": _clean(metrics.get("avg_perplexity")),
+            "burstiness": _clean(metrics["burstiness"]),
+            "ttr": _clean(metrics["ttr"]),
+            "zipf_vocab_size": zipf_data["vocab_size"] if zipf_data else 0,
+            "zipf_exponent": _clean(zipf_data["exponent"]) if zipf_data else None,
+            "zipf_r2": _clean(zipf_data["r_squared"]) if zipf_data else None,
+            "avg_drift": _clean(metrics.get("avg_drift")),
+            "semantic_variance": _clean(metrics.get("semantic_variance")),
+            "final_score": _clean(result["score"]),
+        }
+        if analysis.load_reference_index() is not None:
+            row["reference_coverage"] = _clean(metrics.get("reference_coverage"))
+            row["reference_ai_fraction"] = _clean(metrics.get("reference_ai_fraction"))
+        if cascade_band:
+            row["partial_score"] = _clean(result["partial_score"])
+            row["escalated"] = result["escalated"]
+        # POS shares depend on the tagging backend (see tagging.py), so rows say which one produced them
+        row["pos_tagger"] = tagging.selected_tagger()
+        row.update({f"pos_{k.lower()}": _clean(v) for k, v in result["details"]["pos_dist"].items()})
+        rows.append(row)
+    return rows
+
+
+def score_records(records: list, stride: int = 512, ppl_batch_size: int = 8, cascade_band: tuple = None):
+    """
+    score_batch, retried one document at a time if the batch fails, so a single bad document
+    does not sink the whole batch.
+
+    Returns:
+        - A list of result rows, one per record (an id and an error message for documents that failed).
+    """
+    try:
+        return score_batch(records, stride=stride, ppl_batch_size=ppl_batch_size, cascade_band=cascade_band)
+    except Exception:
+        rows = []
+        for record in records:
+            try:
+                rows.extend(score_batch([record], stride=stride, ppl_batch_size=ppl_batch_size,
+                                        cascade_band=cascade_band))
+            except Exception as doc_error:
+                rows.append({"id": record["id"], "error": f"{type(doc_error).__name__}: {doc_error}"})
+        return rows
+
+
+def _batches(iterable, size: int):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run(input_path: str, output_path: str, batch_size: int = 32, text_field: str = "text", id_field: str = "id",
+        stride: int = 512, ppl_batch_size: int = 8, restart: bool = False, cascade_band: tuple = None,
+        workers: int = 1, threads: int = None):
+    """
+    Scores a corpus batch by batch, writing results and a checkpoint after every batch.
+    Only one batch of documents is held in memory at a time, or with `workers` > 1 a few batches
+    per worker process (see parallel.py; `threads` is the total thread budget they share).
+    """
+    checkpoint = {} if restart else load_checkpoint(output_path)
+    if checkpoint and checkpoint.get("input") != os.path.abspath(input_path):
+        raise ValueError(f"Checkpoint for {output_path} belongs to another input ({checkpoint.get('input')}); use --restart")
+    processed = checkpoint.get("processed", 0)
+    if processed:
+        print(f"Resuming after {processed} documents", file=sys.stderr)
+
+    reader = open_reader(input_path, text_field, id_field)
+    # Skip documents that are already in the output
+    for _ in range(processed):
+        if next(reader, None) is None:
+            break
+
+    writer = open_writer(output_path, checkpoint)
+    pool = None
+    scored = escalated = 0
+    options = {"stride": stride, "ppl_batch_size": ppl_batch_size, "cascade_band": cascade_band}
+    try:
+        if workers > 1:
+            import parallel
+
+            pool = parallel.ScoringPool(workers, threads)
+            print(f"Scoring with {workers} workers, {pool.threads_per_worker} threads each", file=sys.stderr)
+            # Results come back in input order, so the checkpoint still marks a prefix of the input
+            results = pool.imap(score_records, _batches(reader, batch_size), **options)
+        else:
+            results = (score_records(batch, **options) for batch in _batches(reader, batch_size))
+        for rows in results:
+            writer.write(rows)
+            # One row per document, scored or not
+            processed += len(rows)
+            save_checkpoint(output_path, {"input": os.path.abspath(input_path), "processed": processed, **writer.state()})
+            if cascade_band:
+                scored += sum("escalated" in row for row in rows)
+                escalated += sum(bool(row.get("escalated")) for row in rows)
+                print(f"Scored {processed} documents ({escalated / max(scored, 1):.1%} escalated this run)", file=sys.stderr)
+            else:
+                print(f"Scored {processed} documents", file=sys.stderr)
+    finally:
+        if pool is not None:
+            pool.close()
+        writer.close()
+    return processed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score a text corpus with the AI text detector metrics.")
+    parser.add_argument("input", help="A .jsonl, .json (array), .csv or .parquet file, or a directory of .txt files")
+    parser.add_argument("output", help="A .jsonl file, or a .parquet directory of part files")
+    parser.add_argument("--batch-size", type=int, default=32, help="Documents scored per batch / checkpoint")
+    parser.add_argument("--ppl-batch-size", type=int, default=8, help="Perplexity windows per forward pass")
+    parser.add_argument("--stride", type=int, default=512, help="Perplexity sliding-window stride")
+    parser.add_argument("--text-field", default="text")
+    parser.add_argument("--id-field", default="id")
+    parser.add_argument("--restart", action="store_true", help="Ignore any existing checkpoint and start over")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes; the models are loaded once and shared by forking (see parallel.py)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Total torch threads, split evenly between the workers (default: all cores)")
+    parser.add_argument("--cascade", nargs="?", const="", default=None, metavar="LOW,HIGH",
+                        help="Run perplexity and drift only for texts whose cheap-metric score is inside this "
+                             "uncertainty band (default DETECTOR_CASCADE_BAND or 30,70); see cascade.py")
+    args = parser.parse_args(argv)
+    cascade_band = None
+    if args.cascade is not None:
+        cascade_band = cascade.parse_band(args.cascade) if args.cascade else cascade.selected_band()
+
+    run(args.input, args.output, batch_size=args.batch_size, text_field=args.text_field, id_field=args.id_field,
+        stride=args.stride, ppl_batch_size=args.ppl_batch_size, restart=args.restart, cascade_band=cascade_band,
+        workers=args.workers, threads=args.threads)
+
+
+if __name__ == "__main__":
+    main()
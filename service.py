@@ -0,0 +1,453 @@
+# Asyncio HTTP API around the analysis core, for calling the detector from other services.
+#
+# Usage:
+#   python service.py                                   # http://127.0.0.1:8080
+#   python service.py --port 9000 --max-batch 32 --max-wait-ms 5 --queue-size 512
+#
+# Endpoints (POST bodies are JSON: {"text": "...", "timeout": optional seconds}):
+#   POST /score            final score plus every metric
+#   POST /perplexity, /burstiness, /stylometry, /zipf, /semantic_drift
+#   GET  /health           readiness, queue depths and batching statistics
+#
+# Concurrent requests are coalesced into micro-batches for the distilgpt2 and MiniLM forward
+# passes: a batch is sent as soon as it holds --max-batch requests or --max-wait-ms after its first
+# request arrived. Each model has a bounded queue; when it is full the request is rejected with 503
+# and Retry-After instead of queueing without limit. Every request has a timeout (504 when exceeded).
+# See loadtest.py for p50/p99 latency and requests per second.
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import analysis
+import perplexity
+import profiling
+import tagging
+
+MAX_BATCH_ENV_VAR = "DETECTOR_SERVICE_MAX_BATCH"
+MAX_WAIT_ENV_VAR = "DETECTOR_SERVICE_MAX_WAIT_MS"
+QUEUE_SIZE_ENV_VAR = "DETECTOR_SERVICE_QUEUE_SIZE"
+TIMEOUT_ENV_VAR = "DETECTOR_SERVICE_TIMEOUT"
+DEFAULT_MAX_BATCH = 16
+DEFAULT_MAX_WAIT_MS = 10
+DEFAULT_QUEUE_SIZE = 256
+DEFAULT_TIMEOUT = 30.0
+MAX_BODY_BYTES = 10 * 2**20
+# Threads for the NLTK metrics and final-score requests; the models each have their own thread
+CPU_WORKERS = 4
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable",
+               504: "Gateway Timeout"}
+
+
+class Overloaded(Exception):
+    """A batcher's queue is full; the client should retry later."""
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent submissions into batches for `process`, which runs on a dedicated thread
+    so one model is never called from two threads at once.
+
+    A batch is started when `max_batch` items are waiting or `max_wait` seconds after its first
+    item arrived. Items whose caller has given up (timed out) are dropped before the batch runs.
+    """
+
+    def __init__(self, name: str, process, max_batch: int, max_wait: float, queue_size: int):
+        self.name = name
+        self.process = process
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"batch-{name}")
+        self._task = None
+        self.stats = {"submitted": 0, "rejected": 0, "dropped": 0, "batches": 0, "batched_items": 0}
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._executor.shutdown(wait=False)
+
+    def submit(self, item):
+        """Queues `item` and returns a future for its result; raises Overloaded if the queue is full."""
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((item, future))
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            raise Overloaded(f"{self.name} queue is full")
+        self.stats["submitted"] += 1
+        return future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            live = [(item, future) for item, future in batch if not future.done()]
+            self.stats["dropped"] += len(batch) - len(live)
+            if not live:
+                continue
+            self.stats["batches"] += 1
+            self.stats["batched_items"] += len(live)
+            try:
+                results = await loop.run_in_executor(self._executor, self._process, [item for item, _ in live])
+            except Exception as exc:
+                for _, future in live:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            for (_, future), result in zip(live, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _process(self, items: list):
+        with profiling.stage(f"service.batch.{self.name}"):
+            return self.process(items)
+
+    def snapshot(self):
+        batches = self.stats["batches"]
+        return {
+            **self.stats,
+            "queue_depth": self._queue.qsize(),
+            "queue_size": self._queue.maxsize,
+            "mean_batch_size": self.stats["batched_items"] / batches if batches else 0.0,
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+
+# --- Batched model calls ---
+def perplexity_batch(texts: list):
+    """One perplexity_for_texts call for every text in the batch: their windows share forward passes."""
+    model, tokenizer = analysis.load_perplexity_model()
+    return perplexity.perplexity_for_texts(
+        model, tokenizer, texts, stride=perplexity.DEFAULT_STRIDE,
+        batch_size=perplexity.DEFAULT_BATCH_SIZE, cache=analysis.load_window_cache(),
+    )
+
+
+def embedding_batch(sentence_lists: list):
+    """Encodes the sentences of every document in the batch together, then splits them up again."""
+    flat = [sent for sentences in sentence_lists for sent in sentences]
+    embeddings = analysis.encode_sentences(flat) if flat else None
+    results, start = [], 0
+    for sentences in sentence_lists:
+        results.append(embeddings[start:start + len(sentences)])
+        start += len(sentences)
+    return results
+
+
+# --- JSON ---
+def _jsonable(value):
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, (np.floating, float)):
+        value = float(value)
+        return value if math.isfinite(value) else None
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+class DetectorService:
+    """Routes requests to the batched models and the NLTK metrics."""
+
+    METRICS = ("perplexity", "burstiness", "stylometry", "zipf", "semantic_drift")
+
+    def __init__(self, max_batch: int = DEFAULT_MAX_BATCH, max_wait_ms: float = DEFAULT_MAX_WAIT_MS,
+                 queue_size: int = DEFAULT_QUEUE_SIZE, timeout: float = DEFAULT_TIMEOUT):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.ready = False
+        self.perplexity = None
+        self.embedding = None
+        self._cpu = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="service-cpu")
+
+    async def start(self):
+        self.perplexity = MicroBatcher("perplexity", perplexity_batch, self.max_batch, self.max_wait, self.queue_size)
+        self.embedding = MicroBatcher("embedding", embedding_batch, self.max_batch, self.max_wait, self.queue_size)
+        self.perplexity.start()
+        self.embedding.start()
+        # Load NLTK data and both models before accepting traffic
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            loop.run_in_executor(self._cpu, analysis.download_nltk_data),
+            loop.run_in_executor(self._cpu, analysis.load_perplexity_model),
+            loop.run_in_executor(self._cpu, analysis.load_embedding_model),
+        )
+        self.ready = True
+
+    async def stop(self):
+        await self.perplexity.stop()
+        await self.embedding.stop()
+        self._cpu.shutdown(wait=False)
+
+    def _in_cpu_pool(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._cpu, func, *args)
+
+    # --- Metrics ---
+    async def _perplexity(self, text: str):
+        avg_ppl, ppl_scores = await self.perplexity.submit(text)
+        return {"avg_perplexity": avg_ppl, "ppl_scores": ppl_scores}
+
+    async def _semantic_drift(self, doc_future):
+        doc = await doc_future
+        sentences = list(doc.sentences)
+        if len(sentences) < 2:
+            return None
+        embeddings = await self.embedding.submit(sentences)
+        return await self._in_cpu_pool(analysis.drift_summary, embeddings)
+
+    async def _burstiness(self, doc_future):
+        score, sent_lengths = await self._in_cpu_pool(analysis.calculate_burstiness, await doc_future)
+        return {"burstiness": score, "sentence_lengths": sent_lengths}
+
+    async def _stylometry(self, doc_future):
+        ttr, pos_dist = await self._in_cpu_pool(analysis.calculate_stylometry, await doc_future)
+        return {"ttr": ttr, "pos_distribution": pos_dist, "pos_tagger": tagging.selected_tagger()}
+
+    async def _zipf(self, doc_future):
+        zipf_data = await self._in_cpu_pool(analysis.calculate_zipf, await doc_future)
+        if not zipf_data:
+            return None
+        # The full rank curve can be as long as the vocabulary; clients get the summary
+        return {key: zipf_data[key] for key in
+                ("vocab_size", "n_tokens", "top_words", "exponent", "intercept", "r_squared")}
+
+    async def _reference(self, doc_future):
+        # None without a reference index (see analysis.load_reference_index)
+        return await self._in_cpu_pool(analysis.calculate_reference_matches, await doc_future)
+
+    async def metric(self, name: str, text: str):
+        if name == "perplexity":
+            return await self._perplexity(text)
+        doc_future = asyncio.ensure_future(self._in_cpu_pool(analysis.load_document, text))
+        return await getattr(self, f"_{name}")(doc_future)
+
+    async def score(self, text: str):
+        """Every metric, run concurrently (perplexity starts before the text is parsed), and the final score."""
+        doc_future = asyncio.ensure_future(self._in_cpu_pool(analysis.load_document, text))
+        ppl, burst, style, zipf, drift, reference = await asyncio.gather(
+            self._perplexity(text), self._burstiness(doc_future), self._stylometry(doc_future),
+            self._zipf(doc_future), self._semantic_drift(doc_future), self._reference(doc_future),
+        )
+        metrics = {
+            "avg_perplexity": ppl["avg_perplexity"],
+            "burstiness": burst["burstiness"],
+            "ttr": style["ttr"],
+        }
+        if drift:
+            metrics["avg_drift"] = drift["avg_drift"]
+        if zipf and zipf["exponent"] is not None:
+            metrics["zipf_exponent"] = zipf["exponent"]
+        # Near-duplicates of the reference corpus enter the score as in the app and the batch scorer
+        if reference is not None:
+            metrics["reference_coverage"] = reference["coverage"]
+            metrics["reference_ai_fraction"] = reference["ai_fraction"]
+        return {"final_score": analysis.calculate_final_score(metrics), "metrics": metrics}
+
+    def health(self):
+        return {
+            "status": "ok" if self.ready else "loading",
+            "batchers": {b.name: b.snapshot() for b in (self.perplexity, self.embedding) if b is not None},
+        }
+
+    # --- Requests ---
+    async def handle(self, method: str, path: str, body: bytes):
+        """
+        Returns:
+            - status (int), payload (dict): The response for one request.
+        """
+        path = path.split("?")[0].rstrip("/") or "/"
+        if path == "/health":
+            return (200 if self.ready else 503), self.health()
+
+        route = path.lstrip("/")
+        if route != "score" and route not in self.METRICS:
+            raise HTTPError(404, f"Unknown endpoint {path}")
+        if method != "POST":
+            raise HTTPError(405, "Use POST")
+        if not self.ready:
+            raise Overloaded("models are still loading")
+
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "Body must be JSON")
+        text = request.get("text") if isinstance(request, dict) else None
+        if not isinstance(text, str) or not text.strip():
+            raise HTTPError(400, 'Body must be {"text": "..."} with non-empty text')
+        timeout = self.timeout
+        if request.get("timeout") is not None:
+            try:
+                timeout = float(request["timeout"])
+            except (TypeError, ValueError):
+                raise HTTPError(400, "timeout must be a number of seconds")
+            if not math.isfinite(timeout) or timeout <= 0:
+                raise HTTPError(400, "timeout must be a positive number of seconds")
+            timeout = min(timeout, self.timeout)
+
+        work = self.score(text) if route == "score" else self.metric(route, text)
+        try:
+            result = await asyncio.wait_for(work, timeout)
+        except asyncio.TimeoutError:
+            raise HTTPError(504, f"Timed out after {timeout:g}s")
+        return 200, result
+
+
+# --- HTTP/1.1 on asyncio streams ---
+async def _read_request(reader: asyncio.StreamReader):
+    """
+    Returns:
+        - method, path, headers (dict, lowercased names), body; None when the client closed the connection.
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, path, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        raise HTTPError(400, "Malformed Content-Length")
+    if length < 0:
+        raise HTTPError(400, "Malformed Content-Length")
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, f"Body over {MAX_BODY_BYTES} bytes")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), path, headers, body
+
+
+def _response(status: int, payload, keep_alive: bool, extra_headers: dict = None):
+    body = json.dumps(_jsonable(payload)).encode()
+    headers = {
+        "Content-Type": "application/json",
+        "Content-Length": str(len(body)),
+        "Connection": "keep-alive" if keep_alive else "close",
+        **(extra_headers or {}),
+    }
+    head = f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+    head += "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+    return head.encode("latin-1") + b"\r\n" + body
+
+
+async def _serve_connection(service: DetectorService, reader, writer):
+    try:
+        while True:
+            extra = None
+            try:
+                request = await _read_request(reader)
+            except HTTPError as exc:
+                # The rest of the request (e.g. an oversized body) is still unread, so the next
+                # request on this connection could not be found: answer and close
+                writer.write(_response(exc.status, {"error": str(exc)}, False))
+                await writer.drain()
+                break
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            if request is None:
+                break
+            method, path, headers, body = request
+            keep_alive = headers.get("connection", "").lower() != "close"
+            try:
+                status, payload = await service.handle(method, path, body)
+            except HTTPError as exc:
+                # The whole request was read, so the connection can serve the next one
+                status, payload = exc.status, {"error": str(exc)}
+            except Overloaded as exc:
+                status, payload = 503, {"error": str(exc)}
+                extra = {"Retry-After": "1"}
+            except Exception as exc:
+                status, payload = 500, {"error": f"{type(exc).__name__}: {exc}"}
+            writer.write(_response(status, payload, keep_alive, extra))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int, service: DetectorService):
+    server = await asyncio.start_server(lambda r, w: _serve_connection(service, r, w), host, port)
+    print("Loading models...", file=sys.stderr)
+    await service.start()
+    print(f"Serving on http://{host}:{port} (max batch {service.max_batch}, max wait "
+          f"{service.max_wait * 1000:g} ms, queue {service.queue_size}, timeout {service.timeout:g}s)", file=sys.stderr)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the detector's metrics and final score over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-batch", type=int, default=int(os.environ.get(MAX_BATCH_ENV_VAR, DEFAULT_MAX_BATCH)),
+                        help="Most requests coalesced into one model batch")
+    parser.add_argument("--max-wait-ms", type=float, default=float(os.environ.get(MAX_WAIT_ENV_VAR, DEFAULT_MAX_WAIT_MS)),
+                        help="Longest a request waits for others to share its batch")
+    parser.add_argument("--queue-size", type=int, default=int(os.environ.get(QUEUE_SIZE_ENV_VAR, DEFAULT_QUEUE_SIZE)),
+                        help="Requests waiting per model before new ones get 503")
+    parser.add_argument("--timeout", type=float, default=float(os.environ.get(TIMEOUT_ENV_VAR, DEFAULT_TIMEOUT)),
+                        help="Per-request timeout in seconds (clients may ask for less)")
+    args = parser.parse_args(argv)
+
+    service = DetectorService(args.max_batch, args.max_wait_ms, args.queue_size, args.timeout)
+    try:
+        asyncio.run(serve(args.host, args.port, service))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
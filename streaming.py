@@ -0,0 +1,333 @@
+# Streaming analysis for files too large to hold in memory (long transcripts, books).
+#
+# The file is read in chunks (buffered reads, or slices of a memory map with --mmap) and decoded
+# incrementally. Each chunk is consumed by two independent streams:
+#   - sentences: complete sentences are tokenized and tagged as they arrive; the last (possibly
+#     unfinished) sentence is carried over to the next chunk. Burstiness, TTR, POS and Zipf are kept
+#     as running counts (sentence-length histogram, vocabulary counts, POS category counts) and
+#     semantic drift as a running mean of adjacent-sentence distances and of the embedding variance.
+#   - GPT-2 tokens: text up to the last safe cut (a single space between two non-space characters,
+#     where GPT-2's pre-tokenizer splits anyway) is tokenized, and each sliding window is scored as
+#     soon as its tokens are there. Only the last max_length tokens are kept as overlap context, so
+#     the windows (and the perplexity) are the same as perplexity.plan_windows over the whole text.
+#
+# Memory therefore depends on the chunk size and the vocabulary, not on the length of the file.
+#
+# Usage:
+#   python streaming.py book.txt
+#   python streaming.py transcript.txt --chunk-mb 4 --mmap --no-drift --json result.json
+import argparse
+import codecs
+import json
+import mmap
+import re
+import sys
+import time
+from collections import Counter
+
+import nltk
+import numpy as np
+
+import analysis
+import perplexity
+import profiling
+import tagging
+from document import sentence_spans
+
+DEFAULT_CHUNK_BYTES = 1 << 20
+# A carried-over "sentence" (or GPT-2 text without a safe cut) longer than this is processed anyway
+MAX_CARRY_CHARS = 200_000
+# Where GPT-2 text can be cut without changing its tokenization
+_SAFE_CUT = re.compile(r"(?<=\S) (?=\S)")
+
+
+def read_text_chunks(path: str, chunk_bytes: int = DEFAULT_CHUNK_BYTES, use_mmap: bool = False):
+    """Yields the decoded text of a UTF-8 file chunk by chunk; a character split across chunks is kept whole."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    with open(path, "rb") as f:
+        if use_mmap:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # An empty file cannot be mapped
+                mm = None
+            if mm is not None:
+                with mm:
+                    for start in range(0, len(mm), chunk_bytes):
+                        yield decoder.decode(mm[start:start + chunk_bytes])
+        else:
+            while True:
+                data = f.read(chunk_bytes)
+                if not data:
+                    break
+                yield decoder.decode(data)
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+class StreamingAnalyzer:
+    """
+    Computes the app's metrics over a text fed in pieces with feed(); finish() returns the result.
+    """
+
+    def __init__(self, stride: int = perplexity.DEFAULT_STRIDE, batch_size: int = perplexity.DEFAULT_BATCH_SIZE,
+                 with_perplexity: bool = True, with_drift: bool = True):
+        self.stride = stride
+        self.batch_size = batch_size
+        self.with_perplexity = with_perplexity
+        self.with_drift = with_drift
+        self.chars = 0
+        # --- Sentence stream ---
+        self._sentence_carry = ""
+        self._length_counts = Counter()  # sentence length -> number of sentences
+        self._type_counts = Counter()  # lowercased token -> count, for TTR
+        self._pos_counts = Counter()  # POS category -> count
+        self._zipf_counts = Counter()  # Zipf word -> count
+        self._n_tokens = 0
+        self._stop_words = None
+        # Semantic drift: previous embedding, drift sum, and running mean / M2 of the embeddings
+        self._prev_embedding = None
+        self._drift_sum = 0.0
+        self._n_drifts = 0
+        self._n_embeddings = 0
+        self._emb_mean = None
+        self._emb_m2 = None
+        # --- GPT-2 stream ---
+        self._ppl_carry = ""
+        self._ids = []  # token ids from position self._ids_start on
+        self._ids_start = 0
+        self._n_ids = 0
+        self._next_window = 0  # index of the next full window to plan
+        self._prev_end = 0
+        self._pending_windows = []
+        self._nlls = []
+        if with_perplexity:
+            self._model, self._tokenizer = analysis.load_perplexity_model()
+            self._max_length = self._model.config.n_positions
+            tok = self._tokenizer
+            self._pad_token_id = tok.pad_token_id if tok.pad_token_id is not None else tok.eos_token_id
+
+    # --- Input ---
+    def feed(self, text: str):
+        if not text:
+            return
+        self.chars += len(text)
+        self._feed_sentences(text)
+        if self.with_perplexity:
+            self._feed_tokens(text)
+
+    # --- Sentence stream ---
+    def _feed_sentences(self, text: str, final: bool = False):
+        buffer = self._sentence_carry + text
+        with profiling.stage("parse.sentences"):
+            sentences = nltk.sent_tokenize(buffer)
+        self._sentence_carry = ""
+        if not final and sentences:
+            # The last sentence may continue in the next chunk, unless it has grown unreasonably long
+            start = sentence_spans(buffer, sentences)[-1][0]
+            if len(buffer) - start <= MAX_CARRY_CHARS:
+                self._sentence_carry = buffer[start:]
+                sentences = sentences[:-1]
+        if sentences:
+            self._add_sentences(sentences)
+
+    def _add_sentences(self, sentences: list):
+        with profiling.stage("parse.tokenize"):
+            sentence_tokens = [nltk.word_tokenize(sent, preserve_line=True) for sent in sentences]
+            lower = [[tok.lower() for tok in toks] for toks in sentence_tokens]
+        with profiling.stage("parse.pos_tag"):
+            sentence_tags = tagging.tag_sentences(lower)
+        if self._stop_words is None:
+            self._stop_words = analysis.load_stopwords()
+
+        for toks, tags in zip(lower, sentence_tags):
+            self._length_counts[len(toks)] += 1
+            self._n_tokens += len(toks)
+            self._type_counts.update(toks)
+            self._pos_counts.update(map(tagging.category_of, tags))
+            self._zipf_counts.update(analysis.zipf_tokens(toks, self._stop_words))
+
+        if self.with_drift:
+            self._add_embeddings(analysis.encode_sentences(sentences))
+
+    def _add_embeddings(self, embeddings: np.ndarray):
+        if self._prev_embedding is not None:
+            embeddings_with_prev = np.vstack([self._prev_embedding[None, :], embeddings])
+        else:
+            embeddings_with_prev = embeddings
+        drifts = analysis.adjacent_drifts(embeddings_with_prev)
+        self._drift_sum += float(drifts.sum())
+        self._n_drifts += len(drifts)
+        self._prev_embedding = embeddings[-1].copy()
+
+        # Chan et al.'s pairwise update of the per-dimension mean and sum of squared deviations
+        batch = embeddings.astype(np.float64)
+        n_b = len(batch)
+        mean_b = batch.mean(axis=0)
+        m2_b = ((batch - mean_b) ** 2).sum(axis=0)
+        if self._emb_mean is None:
+            self._emb_mean, self._emb_m2, self._n_embeddings = mean_b, m2_b, n_b
+            return
+        n_a = self._n_embeddings
+        n = n_a + n_b
+        delta = mean_b - self._emb_mean
+        self._emb_mean = self._emb_mean + delta * n_b / n
+        self._emb_m2 = self._emb_m2 + m2_b + delta ** 2 * n_a * n_b / n
+        self._n_embeddings = n
+
+    # --- GPT-2 stream ---
+    def _feed_tokens(self, text: str, final: bool = False):
+        buffer = self._ppl_carry + text
+        if final:
+            cut = len(buffer)
+        else:
+            # Keep everything after the last safe cut for the next chunk
+            match = None
+            for match in _SAFE_CUT.finditer(buffer, max(0, len(buffer) - 10_000)):
+                pass
+            if match is not None:
+                cut = match.start()
+            elif len(buffer) > MAX_CARRY_CHARS:
+                cut = len(buffer)
+            else:
+                self._ppl_carry = buffer
+                return
+        self._ppl_carry = buffer[cut:]
+        if cut:
+            with profiling.stage("perplexity.tokenize"):
+                ids = self._tokenizer(buffer[:cut])["input_ids"]
+            self._ids.extend(ids)
+            self._n_ids += len(ids)
+            self._plan_full_windows()
+
+    def _plan_full_windows(self):
+        """Queues every window whose tokens have all arrived; these are the same whatever follows."""
+        while self._next_window * self.stride + self._max_length <= self._n_ids:
+            begin = self._next_window * self.stride
+            self._queue_window(begin, begin + self._max_length)
+        if len(self._pending_windows) >= self.batch_size:
+            self._score_pending()
+
+    def _queue_window(self, begin: int, end: int):
+        ids = self._ids[begin - self._ids_start:end - self._ids_start]
+        self._pending_windows.append((ids, end - self._prev_end))
+        self._prev_end = end
+        self._next_window += 1
+        # The next window starts `stride` tokens later; nothing before that is needed again
+        drop = self._next_window * self.stride - self._ids_start
+        if drop > 0:
+            del self._ids[:drop]
+            self._ids_start += drop
+
+    def _score_pending(self):
+        if self._pending_windows:
+            self._nlls.extend(perplexity.score_windows(
+                self._model, self._pending_windows, batch_size=self.batch_size, pad_token_id=self._pad_token_id,
+            ))
+            self._pending_windows = []
+
+    # --- Result ---
+    def _burstiness(self):
+        if not self._length_counts:
+            return 0
+        lengths = np.fromiter(self._length_counts.keys(), dtype=np.float64)
+        counts = np.fromiter(self._length_counts.values(), dtype=np.float64)
+        mean = np.average(lengths, weights=counts)
+        std = np.sqrt(np.average((lengths - mean) ** 2, weights=counts))
+        return std / mean if mean > 0 else 0
+
+    def finish(self):
+        """
+        Flushes the carried-over text and returns the result.
+
+        Returns:
+            - A dictionary with chars, sentences, tokens, the metrics used by calculate_final_score
+              (avg_perplexity, burstiness, ttr, avg_drift, zipf_exponent), ppl_scores, pos_dist,
+              semantic_variance, sentence_lengths (length -> count), zipf (see analysis.zipf_from_counts)
+              and final_score.
+        """
+        if self._sentence_carry.strip():
+            self._feed_sentences("", final=True)
+        result = {"chars": self.chars, "sentences": sum(self._length_counts.values()), "tokens": self._n_tokens}
+        metrics = {}
+
+        if self.with_perplexity:
+            self._feed_tokens("", final=True)
+            # The last window ends at the end of the text, unless the last full window already did
+            if self._n_ids > self._prev_end:
+                self._queue_window(self._next_window * self.stride, self._n_ids)
+            self._score_pending()
+            avg_ppl, ppl_scores = perplexity.summarize_nlls(self._nlls)
+            metrics["avg_perplexity"] = avg_ppl
+            result["ppl_scores"] = ppl_scores
+
+        metrics["burstiness"] = self._burstiness()
+        ttr, pos_dist = analysis.stylometry_from_counts(len(self._type_counts), self._n_tokens, self._pos_counts)
+        metrics["ttr"] = ttr
+        zipf_data = analysis.zipf_from_counts(self._zipf_counts)
+        if zipf_data and zipf_data["exponent"] is not None:
+            metrics["zipf_exponent"] = zipf_data["exponent"]
+        if self.with_drift and self._n_drifts:
+            metrics["avg_drift"] = self._drift_sum / self._n_drifts
+            result["semantic_variance"] = float(np.mean(self._emb_m2 / self._n_embeddings))
+
+        result.update(metrics)
+        result["pos_dist"] = pos_dist
+        result["pos_tagger"] = tagging.selected_tagger()
+        result["sentence_lengths"] = dict(sorted(self._length_counts.items()))
+        result["zipf"] = zipf_data
+        result["final_score"] = analysis.calculate_final_score(metrics)
+        return result
+
+
+def analyze_file(path: str, chunk_bytes: int = DEFAULT_CHUNK_BYTES, use_mmap: bool = False, **kwargs):
+    """Streams a text file through a StreamingAnalyzer (kwargs are passed to it) and returns its result."""
+    analysis.download_nltk_data()
+    analyzer = StreamingAnalyzer(**kwargs)
+    for chunk in read_text_chunks(path, chunk_bytes, use_mmap):
+        analyzer.feed(chunk)
+    return analyzer.finish()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyse a large text file with constant memory.")
+    parser.add_argument("path", help="A UTF-8 text file")
+    parser.add_argument("--chunk-mb", type=float, default=DEFAULT_CHUNK_BYTES / 2**20, help="Bytes read per chunk, in MiB")
+    parser.add_argument("--mmap", action="store_true", help="Read through a memory map instead of buffered reads")
+    parser.add_argument("--stride", type=int, default=perplexity.DEFAULT_STRIDE)
+    parser.add_argument("--batch-size", type=int, default=perplexity.DEFAULT_BATCH_SIZE, help="Perplexity windows per forward pass")
+    parser.add_argument("--no-perplexity", action="store_true", help="Skip GPT-2 perplexity")
+    parser.add_argument("--no-drift", action="store_true", help="Skip MiniLM semantic drift")
+    parser.add_argument("--json", metavar="PATH", help="Also write the full result as JSON")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    start_rss = profiling.rss_bytes()
+    result = analyze_file(
+        args.path, chunk_bytes=int(args.chunk_mb * 2**20), use_mmap=args.mmap, stride=args.stride,
+        batch_size=args.batch_size, with_perplexity=not args.no_perplexity, with_drift=not args.no_drift,
+    )
+    elapsed = time.perf_counter() - start
+
+    print(f"{result['chars']:,} characters, {result['sentences']:,} sentences, {result['tokens']:,} tokens "
+          f"in {elapsed:.1f}s")
+    for key in ("avg_perplexity", "burstiness", "ttr", "zipf_exponent", "avg_drift", "final_score"):
+        if key in result:
+            print(f"  {key:>15}: {result[key]:.4f}")
+    end_rss = profiling.rss_bytes()
+    if start_rss is not None and end_rss is not None:
+        print(f"  RSS growth: {(end_rss - start_rss) / 2**20:.0f} MB")
+
+    if args.json:
+        zipf = result["zipf"]
+        if zipf:
+            # The full rank curve is as long as the vocabulary; keep the summary
+            result["zipf"] = {k: zipf[k] for k in ("vocab_size", "n_tokens", "top_words", "exponent", "intercept", "r_squared")}
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, default=float)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
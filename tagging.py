@@ -0,0 +1,280 @@
+# This file contains the POS-tagging backends and the tag -> category mapping used by stylometry.
+#
+#   perceptron - NLTK's averaged perceptron via pos_tag_sents (the original behaviour)
+#   fast       - the same perceptron model without the neighbouring-word features, memoized per
+#                (word, previous two tags); much faster on long texts, but less accurate: the weights
+#                were trained with those features, so its tags differ systematically from the
+#                perceptron's (about 62% tag agreement on the built-in samples, see `python tagging.py`).
+#                POS distributions from the two backends are not comparable; every result that reports
+#                one also names the backend (pos_tagger). The final score does not use POS shares.
+#
+# The backend is picked with DETECTOR_TAGGER. Documents with more than PARALLEL_MIN_TOKENS tokens
+# are tagged in sentence batches across DETECTOR_TAGGER_PROCESSES worker processes.
+#
+# Usage:
+#   python tagging.py                      # speed and agreement of each backend on built-in samples
+#   python tagging.py --processes 4 book.txt
+import argparse
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import nltk
+
+TAGGERS = ("perceptron", "fast")
+TAGGER_ENV_VAR = "DETECTOR_TAGGER"
+PROCESSES_ENV_VAR = "DETECTOR_TAGGER_PROCESSES"
+# Below this many tokens, worker start-up and pickling cost more than they save
+PARALLEL_MIN_TOKENS = 200_000
+# Smallest sentence batch sent to a worker
+MIN_CHUNK_TOKENS = 5_000
+# FastTagger forgets its memo beyond this many (word, prev, prev2) entries
+FAST_MEMO_MAX = 1_000_000
+
+# Major POS categories reported by stylometry, in display order
+POS_CATEGORIES = ("Noun", "Verb", "Adjective", "Adverb", "Pronoun", "Preposition", "Conjunction", "Determiner", "Other")
+# The Penn Treebank tags the perceptron model can emit
+PENN_TAGS = (
+    "CC", "CD", "DT", "EX", "FW", "IN", "JJ", "JJR", "JJS", "LS", "MD", "NN", "NNS", "NNP", "NNPS", "PDT",
+    "POS", "PRP", "PRP$", "RB", "RBR", "RBS", "RP", "SYM", "TO", "UH", "VB", "VBD", "VBG", "VBN", "VBP",
+    "VBZ", "WDT", "WP", "WP$", "WRB", "$", "#", "``", "''", "(", ")", ",", ".", ":", "-NONE-",
+)
+
+
+def pos_category(tag: str) -> str:
+    """Simplifies a Penn Treebank tag to one of POS_CATEGORIES (the rule TAG_TO_CATEGORY is built from)."""
+    if tag.startswith('NN'):
+        return "Noun"
+    elif tag.startswith('VB'):
+        return "Verb"
+    elif tag.startswith('JJ'):
+        return "Adjective"
+    elif tag.startswith('RB'):
+        return "Adverb"
+    elif tag.startswith('PRP') or tag.startswith('WP'):
+        return "Pronoun"
+    elif tag.startswith('IN'):
+        return "Preposition"
+    elif tag.startswith('CC'):
+        return "Conjunction"
+    elif tag.startswith('DT') or tag.startswith('WDT'):
+        return "Determiner"
+    return "Other"
+
+
+TAG_TO_CATEGORY = {tag: pos_category(tag) for tag in PENN_TAGS}
+
+
+def category_of(tag: str) -> str:
+    category = TAG_TO_CATEGORY.get(tag)
+    if category is None:
+        # A tag outside PENN_TAGS (e.g. from another model): classify once, then it is a lookup too
+        category = TAG_TO_CATEGORY[tag] = pos_category(tag)
+    return category
+
+
+def category_counts(tags) -> Counter:
+    """Counts POS categories by counting distinct tags first, so the mapping runs once per tag, not per token."""
+    counts = Counter()
+    for tag, n in Counter(tags).items():
+        counts[category_of(tag)] += n
+    return counts
+
+
+def selected_tagger():
+    tagger = os.environ.get(TAGGER_ENV_VAR, "perceptron").lower()
+    if tagger not in TAGGERS:
+        raise ValueError(f"Unknown {TAGGER_ENV_VAR}={tagger!r}, expected one of {', '.join(TAGGERS)}")
+    return tagger
+
+
+def selected_processes():
+    value = os.environ.get(PROCESSES_ENV_VAR)
+    if value:
+        return int(value)
+    return min(4, os.cpu_count() or 1)
+
+
+class FastTagger:
+    """
+    NLTK's averaged perceptron scored only on the features of the word itself and the two previous
+    tags. Without the neighbouring-word features a prediction depends on (word, prev, prev2) only,
+    so each combination is scored once and every later occurrence is a dictionary lookup.
+
+    Accuracy trade-off: the weights were trained together with the dropped features, so the tags
+    are biased, not just noisier, and POS shares differ from the perceptron's by several points.
+    """
+
+    def __init__(self, perceptron):
+        self.tagdict = perceptron.tagdict
+        self.model = perceptron.model
+        self.normalize = perceptron.normalize
+        self.start = tuple(perceptron.START)
+        self._memo = {}
+
+    def _predict(self, word: str, prev: str, prev2: str) -> str:
+        normalized = self.normalize(word)
+        features = {
+            "bias": 1,
+            f"i suffix {word[-3:]}": 1,
+            f"i pref1 {word[0] if word else ''}": 1,
+            f"i-1 tag {prev}": 1,
+            f"i-2 tag {prev2}": 1,
+            f"i tag+i-2 tag {prev} {prev2}": 1,
+            f"i word {normalized}": 1,
+            f"i-1 tag+i word {prev} {normalized}": 1,
+        }
+        return self.model.predict(features)[0]
+
+    def tag(self, tokens: list) -> list:
+        prev, prev2 = self.start
+        tags = []
+        memo = self._memo
+        for word in tokens:
+            tag = self.tagdict.get(word)
+            if not tag:
+                key = (word, prev, prev2)
+                tag = memo.get(key)
+                if tag is None:
+                    if len(memo) >= FAST_MEMO_MAX:
+                        memo.clear()
+                    tag = memo[key] = self._predict(word, prev, prev2)
+            tags.append(tag)
+            prev2, prev = prev, tag
+        return tags
+
+
+@functools.lru_cache(maxsize=None)
+def _fast_tagger():
+    from nltk.tag.perceptron import PerceptronTagger
+    return FastTagger(PerceptronTagger())
+
+
+def _tag_chunk(sentences: list, tagger: str):
+    """Tags a batch of tokenized sentences in this process; also the worker-process entry point."""
+    if tagger == "fast":
+        fast = _fast_tagger()
+        return [tuple(fast.tag(sent)) for sent in sentences]
+    return [tuple(tag for _, tag in tagged) for tagged in nltk.pos_tag_sents(sentences)]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool(processes: int):
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool._max_workers != processes:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # spawn, not fork: the app process has torch and Streamlit threads running
+            _pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _chunks(sentences: list, chunk_tokens: int):
+    chunk, size = [], 0
+    for sent in sentences:
+        chunk.append(sent)
+        size += len(sent)
+        if size >= chunk_tokens:
+            yield chunk
+            chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+
+def tag_sentences(sentences: list, tagger: str = None, processes: int = None):
+    """
+    POS-tags pre-split, tokenized sentences in one batched call.
+
+    Args:
+        - sentences (list): A list of token lists (lowercased, as in Document.lower_tokens).
+        - tagger (str): One of TAGGERS; defaults to DETECTOR_TAGGER.
+        - processes (int): Worker processes for documents over PARALLEL_MIN_TOKENS tokens
+          (defaults to DETECTOR_TAGGER_PROCESSES, or up to 4); 1 disables them.
+
+    Returns:
+        - A list with a tuple of tags per sentence.
+    """
+    tagger = tagger or selected_tagger()
+    processes = processes if processes is not None else selected_processes()
+    n_tokens = sum(len(sent) for sent in sentences)
+    if processes <= 1 or n_tokens < PARALLEL_MIN_TOKENS:
+        return _tag_chunk(sentences, tagger)
+
+    chunks = list(_chunks(sentences, max(MIN_CHUNK_TOKENS, n_tokens // (processes * 4))))
+    try:
+        pool = _get_pool(processes)
+        results = pool.map(_tag_chunk, chunks, [tagger] * len(chunks))
+        return [tags for chunk_tags in results for tags in chunk_tags]
+    except Exception:
+        # A broken or unavailable pool (e.g. no /dev/shm) must not fail the analysis
+        return _tag_chunk(sentences, tagger)
+
+
+def agreement(sentences: list, reference: str = "perceptron", candidate: str = "fast"):
+    """
+    Compares two backends on the same tokenized sentences.
+
+    Returns:
+        - A dictionary with the token-level tag agreement, the category-level agreement and the largest
+          difference (in percentage points) of any category in the stylometry POS distribution.
+    """
+    ref = [tag for tags in _tag_chunk(sentences, reference) for tag in tags]
+    cand = [tag for tags in _tag_chunk(sentences, candidate) for tag in tags]
+    n = len(ref)
+    if not n:
+        return {"tokens": 0, "tag_agreement": 1.0, "category_agreement": 1.0, "max_pos_dist_diff": 0.0}
+    ref_counts, cand_counts = category_counts(ref), category_counts(cand)
+    return {
+        "tokens": n,
+        "tag_agreement": sum(a == b for a, b in zip(ref, cand)) / n,
+        "category_agreement": sum(category_of(a) == category_of(b) for a, b in zip(ref, cand)) / n,
+        "max_pos_dist_diff": max(abs(ref_counts[c] - cand_counts[c]) / n * 100 for c in POS_CATEGORIES),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the speed and agreement of the POS-tagging backends.")
+    parser.add_argument("texts", nargs="*", help="Text files to tag (defaults to built-in samples)")
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes for large inputs")
+    args = parser.parse_args(argv)
+
+    from analysis import download_nltk_data
+    from document import parse_document
+    download_nltk_data()
+
+    if args.texts:
+        texts = []
+        for path in args.texts:
+            with open(path, encoding="utf-8") as f:
+                texts.append(f.read())
+    else:
+        from parity_check import SAMPLE_TEXTS
+        texts = SAMPLE_TEXTS * 200
+
+    sentences = [
+        [tok.lower() for tok in toks] for text in texts for toks in parse_document(text).sentence_tokens
+    ]
+    n_tokens = sum(len(s) for s in sentences)
+    for tagger in TAGGERS:
+        start = time.perf_counter()
+        tag_sentences(sentences, tagger, processes=args.processes)
+        elapsed = time.perf_counter() - start
+        print(f"{tagger:>10}: {elapsed:7.3f}s  ({n_tokens / elapsed:,.0f} tokens/s)")
+
+    stats = agreement(sentences)
+    print(f"\nfast vs perceptron on {stats['tokens']:,} tokens:")
+    print(f"  tag agreement:      {stats['tag_agreement']:.2%}")
+    print(f"  category agreement: {stats['category_agreement']:.2%}")
+    print(f"  max POS share diff: {stats['max_pos_dist_diff']:.2f} points")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
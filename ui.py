@@ -48,6 +48,108 @@ def display_sidebar():
         **圖表**: 「語意軌跡散佈圖」通過 PCA 將句子向量降維到 2D 空間，視覺化句子之間語義關係的路徑。
         """)
 
+WARMUP_STEP_LABELS = {
+    "nltk": "NLTK 資料 (NLTK data)",
+    "perplexity_model": "GPT-2 模型 (distilgpt2)",
+    "embedding_model": "句向量模型 (MiniLM)",
+    "warm_inference": "預熱推論 (Warm-up inference)",
+}
+WARMUP_STEP_ICONS = {"pending": "⏸️", "running": "⏳", "done": "✅", "failed": "❌"}
+
+def _render_warmup_status():
+    import warmup
+
+    status = warmup.status()
+    if status["state"] == "idle":
+        st.caption("未預先載入，模型將於首次分析時載入 (Warm-up disabled; models load on first use)")
+        return
+    if status["state"] == "ready":
+        st.success(f"模型已就緒 (Models ready) · {status['seconds']:.1f}s")
+        return
+    if status["state"] == "running":
+        st.info("模型載入中，首次分析可能較慢 (Loading models; the first analysis may be slower)")
+    else:
+        st.warning("部分預載失敗，將於首次使用時重試 (Some warm-up steps failed; they are retried on first use)")
+    for name, step in status["steps"].items():
+        line = f"{WARMUP_STEP_ICONS[step['state']]} {WARMUP_STEP_LABELS[name]}"
+        if step["seconds"] is not None:
+            line += f" · {step['seconds']:.1f}s"
+        st.caption(line)
+        if step["error"]:
+            st.caption(f"　{step['error']}")
+
+# Re-drawn every 2 s while the models are loading, without re-running the rest of the page
+_poll_warmup_status = st.fragment(run_every=2)(_render_warmup_status)
+
+def display_warmup_status():
+    """
+    Shows in the sidebar whether the background warm-up (see warmup.py) has loaded the models yet,
+    how busy the model scheduler (see scheduler.py) is and how full the result cache (see caching.py) is.
+    """
+    import caching
+    import scheduler
+    import warmup
+
+    with st.sidebar:
+        st.title("模型狀態 (Model Status)")
+        if warmup.status()["state"] == "running":
+            _poll_warmup_status()
+        else:
+            _render_warmup_status()
+        stats = scheduler.stats()
+        if stats:
+            st.caption(f"模型排程 (Model scheduler): {stats['slots']} × {stats['threads_per_slot']} threads · "
+                       f"執行中 {stats['running']}，排隊 {stats['queued']} (running / queued) · "
+                       f"平均等待 {stats['mean_wait_s']:.2f}s (mean wait)")
+        cache = caching.memory_cache_stats()
+        st.caption(f"結果快取 (Result cache): {cache['bytes'] / 2**20:.1f} / {cache['max_bytes'] / 2**20:.0f} MB · "
+                   f"{cache['entries']} 筆 (entries) · 已淘汰 {sum(cache['evictions'].values())} 筆 (evicted)")
+
+def display_profiling_panel(trace):
+    """
+    Shows the stages of the last analysis (wall time, CPU time, peak memory) and its cache hits/misses,
+    with process-wide exports in JSON and Prometheus format. Only shown when profiling is enabled.
+    """
+    import caching
+    import profiling
+
+    with st.expander("效能分析 (Profiling)"):
+        data = trace.to_dict()
+        stages = sorted(data["stages"], key=lambda r: r["wall_s"], reverse=True)
+        st.caption("本次分析各階段耗時 (Stages of this analysis, slowest first)")
+        st.dataframe(
+            [
+                {
+                    "stage": r["name"],
+                    "wall (s)": round(r["wall_s"], 4),
+                    "cpu (s)": round(r["cpu_s"], 4),
+                    "peak mem (MB)": None if r["peak_mem_mb"] is None else round(r["peak_mem_mb"], 1),
+                    "thread": r["thread"],
+                }
+                for r in stages
+            ],
+            use_container_width=True,
+        )
+        if data["cache"]:
+            st.caption("快取命中 (Cache hits / misses)")
+            st.dataframe(data["cache"], use_container_width=True)
+        result_cache = caching.memory_cache_stats()
+        if result_cache["functions"]:
+            st.caption("結果快取用量 (Result cache size by function)")
+            st.dataframe(
+                [{"function": r["function"], "entries": r["entries"], "MB": round(r["bytes"] / 2**20, 3)}
+                 for r in result_cache["functions"]],
+                use_container_width=True,
+            )
+
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button("下載 JSON (Download JSON)", profiling.export_json(), file_name="profile.json",
+                               mime="application/json")
+        with col2:
+            st.download_button("下載 Prometheus 格式 (Download Prometheus)", profiling.export_prometheus(),
+                               file_name="metrics.prom", mime="text/plain")
+
 # def display_test_samples():
 #     st.sidebar.title("AI vs. 人類挑戰")
 #     st.sidebar.write("試著猜猜看，下面哪段文字是 AI 生成的？點擊展開閱讀。")
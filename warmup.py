@@ -0,0 +1,127 @@
+# Background warm-up, so the first user after a deploy does not wait for model loading.
+#
+# start() is called when the app process starts. A daemon thread then checks the NLTK data, loads
+# distilgpt2 and MiniLM through the cached loaders in analysis.py (the same objects every session
+# uses) and runs one small inference through each model and the tagger, so lazy initialisation,
+# kernel selection and allocator growth happen before a real request. status() reports progress for
+# the sidebar. Set DETECTOR_WARMUP=0 to skip it (models then load on first use, as before).
+import os
+import threading
+import time
+
+import analysis
+import perplexity
+import profiling
+import scheduler
+
+WARMUP_ENV_VAR = "DETECTOR_WARMUP"
+STEPS = ("nltk", "perplexity_model", "embedding_model", "warm_inference")
+WARMUP_TEXT = (
+    "The committee met on Tuesday to review the budget. After a long debate, members agreed to "
+    "postpone the vote. Several residents voiced concerns about the proposed cuts."
+)
+
+_lock = threading.Lock()
+_thread = None
+_done = threading.Event()
+_steps = {name: {"state": "pending", "seconds": None, "error": None} for name in STEPS}
+_started = None
+_finished = None
+
+
+def enabled():
+    return os.environ.get(WARMUP_ENV_VAR, "1").lower() not in ("0", "false", "no")
+
+
+def _check_nltk():
+    missing = analysis.download_nltk_data()
+    if missing:
+        raise RuntimeError(f"NLTK resources unavailable: {', '.join(missing)}")
+
+
+def _warm_inference():
+    from document import parse_document
+
+    # Punkt and the perceptron tagger load their weights on first use
+    doc = parse_document(WARMUP_TEXT)
+    model, tokenizer = analysis.load_perplexity_model()
+    # No window cache / sentence cache: the warm-up text must not take space from real texts.
+    # Both passes take a scheduler slot like any session's (perplexity_for_texts takes its own), so
+    # the warm-up never runs beyond DETECTOR_MODEL_SLOTS or with the default torch thread count.
+    perplexity.perplexity_for_texts(model, tokenizer, [WARMUP_TEXT])
+    embedding_model = analysis.load_embedding_model()
+    with scheduler.slot():
+        embedding_model.encode(list(doc.sentences))
+
+
+_STEP_FUNCS = {
+    "nltk": _check_nltk,
+    "perplexity_model": lambda: analysis.load_perplexity_model(),
+    "embedding_model": lambda: analysis.load_embedding_model(),
+    "warm_inference": _warm_inference,
+}
+
+
+def _run():
+    global _finished
+    for name in STEPS:
+        with _lock:
+            _steps[name]["state"] = "running"
+        start = time.perf_counter()
+        try:
+            with profiling.stage(f"warmup.{name}"):
+                _STEP_FUNCS[name]()
+        except Exception as exc:
+            # A failed step is retried by the first request that needs it; keep warming the rest
+            state, error = "failed", f"{type(exc).__name__}: {exc}"
+        else:
+            state, error = "done", None
+        with _lock:
+            _steps[name].update(state=state, seconds=time.perf_counter() - start, error=error)
+    _finished = time.time()
+    _done.set()
+
+
+def start():
+    """Starts the warm-up thread once per process; later calls do nothing. Returns False if disabled."""
+    global _thread, _started
+    if not enabled():
+        return False
+    with _lock:
+        if _thread is None:
+            _started = time.time()
+            _thread = threading.Thread(target=_run, name="warmup", daemon=True)
+            _thread.start()
+    return True
+
+
+def wait(timeout: float = None):
+    """Blocks until the warm-up has finished (or `timeout` seconds); returns whether it finished."""
+    return _done.wait(timeout)
+
+
+def ready():
+    """True once every step has succeeded."""
+    with _lock:
+        return all(step["state"] == "done" for step in _steps.values())
+
+
+def status():
+    """
+    Returns:
+        - A dictionary with the overall state ("idle", "running", "ready" or "failed"), the seconds
+          since the warm-up started (until it finished) and each step's state, seconds and error.
+    """
+    with _lock:
+        steps = {name: dict(step) for name, step in _steps.items()}
+        started, finished = _started, _finished
+    if started is None:
+        state = "idle"
+    elif not _done.is_set():
+        state = "running"
+    elif all(step["state"] == "done" for step in steps.values()):
+        state = "ready"
+    else:
+        state = "failed"
+    elapsed = None if started is None else (finished or time.time()) - started
+    return {"state": state, "seconds": elapsed, "steps": steps}